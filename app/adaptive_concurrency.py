@@ -0,0 +1,197 @@
+"""
+Adaptive (AIMD) concurrency limits per (model, key).
+
+Vertex quotas differ per model, region and time of day, so a static limit is
+either too low or too high. Each (model, key) pair, where key is the metrics
+label of an Express key ("express:<index>") or SA project ("sa:<project>"),
+keeps a limit that behaves like a TCP congestion window:
+
+- additive increase: each request that finishes without an overload error
+  raises the limit by AIMD_INCREASE / limit, i.e. about AIMD_INCREASE per
+  limit's worth of successful requests;
+- multiplicative decrease: a 429 / RESOURCE_EXHAUSTED multiplies the limit by
+  AIMD_DECREASE_FACTOR, at most once per AIMD_DECREASE_COOLDOWN seconds, so a
+  burst of 429s from one window only counts once.
+
+Handlers call acquire() before dispatching on a key. A saturated key is
+skipped in favour of the next one, and the last candidate may wait briefly
+for a free slot. A slot is held until the request (including its stream) has
+finished; it is released through lifecycle.on_request_end(). A slot whose
+client cannot be built is handed back at once with release_current().
+"""
+import asyncio
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Deque, Dict, Optional, Tuple
+
+import config as app_config
+import lifecycle
+from metrics import REGISTRY, error_code
+from model_routing import model_label
+
+AIMD_LIMIT = REGISTRY.gauge(
+    "vertex2openai_adaptive_concurrency_limit", "Current AIMD concurrency limit per model and key.", ("model", "key"))
+AIMD_IN_FLIGHT = REGISTRY.gauge(
+    "vertex2openai_adaptive_concurrency_in_flight", "Requests holding an AIMD slot per model and key.", ("model", "key"))
+AIMD_DECREASES_TOTAL = REGISTRY.counter(
+    "vertex2openai_adaptive_concurrency_decreases_total", "Multiplicative decreases triggered by upstream 429s.",
+    ("model", "key"))
+
+_OVERLOAD_CODES = {"429", "RESOURCE_EXHAUSTED"}
+
+
+class ConcurrencyLimitExceeded(Exception):
+    """Every candidate key for the model is at its adaptive limit."""
+
+
+def is_overload_error(error: BaseException) -> bool:
+    return error_code(error) in _OVERLOAD_CODES or "RESOURCE_EXHAUSTED" in str(error)
+
+
+class AIMDLimit:
+    def __init__(self, model: str, key: str):
+        self.model = model
+        self.key = key
+        self.limit = float(app_config.AIMD_INITIAL_LIMIT)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._waiters: Deque[asyncio.Future] = deque()
+        AIMD_LIMIT.set(model, key, value=self.limit)
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def try_acquire(self) -> bool:
+        if self._waiters or not self._has_capacity():
+            return False
+        self.in_flight += 1
+        AIMD_IN_FLIGHT.set(self.model, self.key, value=self.in_flight)
+        return True
+
+    async def acquire(self, timeout: float) -> bool:
+        if self.try_acquire():
+            return True
+        if timeout <= 0:
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if not waiter.done() or waiter.cancelled():
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        # 限额可能在增长后一次放行多个等待者
+        while self._waiters and self._has_capacity():
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+        AIMD_IN_FLIGHT.set(self.model, self.key, value=self.in_flight)
+
+    def on_success(self) -> None:
+        self.limit = min(float(app_config.AIMD_MAX_LIMIT), self.limit + app_config.AIMD_INCREASE / self.limit)
+        AIMD_LIMIT.set(self.model, self.key, value=self.limit)
+        self._wake()
+
+    def on_overload(self) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < app_config.AIMD_DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+        self.limit = max(float(app_config.AIMD_MIN_LIMIT), self.limit * app_config.AIMD_DECREASE_FACTOR)
+        AIMD_LIMIT.set(self.model, self.key, value=self.limit)
+        AIMD_DECREASES_TOTAL.inc(self.model, self.key)
+        print(f"INFO: Upstream overload for {self.model} on {self.key}, concurrency limit lowered to {int(self.limit)}")
+
+
+class _Lease:
+    __slots__ = ("limit", "overloaded", "released")
+
+    def __init__(self, limit: AIMDLimit):
+        self.limit = limit
+        self.overloaded = False
+        self.released = False
+
+    def finish(self) -> None:
+        if self.released:
+            return
+        self.released = True
+        if not self.overloaded:
+            self.limit.on_success()
+        self.limit.release()
+
+    def abandon(self) -> None:
+        # 未真正发往上游：只归还槽位，不计入成功
+        if self.released:
+            return
+        self.released = True
+        self.limit.release()
+
+
+_limits: Dict[Tuple[str, str], AIMDLimit] = {}
+_current_lease: ContextVar[Optional[_Lease]] = ContextVar("vertex2openai_aimd_lease", default=None)
+
+
+def get_limit(model: str, key: str) -> AIMDLimit:
+    limit = _limits.get((model, key))
+    if limit is None:
+        limit = _limits[(model, key)] = AIMDLimit(model, key)
+    return limit
+
+
+async def acquire(model: str, key: str, wait: bool = False) -> bool:
+    """
+    Take a slot on (model, key) for the current request. With ``wait`` the call
+    waits up to AIMD_WAIT_TIMEOUT seconds; otherwise a saturated key returns
+    False at once. Always True when AIMD is disabled or outside a request scope.
+    """
+    if not app_config.AIMD_ENABLED:
+        return True
+    limit = get_limit(model_label(model), key)
+    if not await limit.acquire(app_config.AIMD_WAIT_TIMEOUT if wait else 0):
+        return False
+    lease = _Lease(limit)
+    if not lifecycle.on_request_end(lease.finish):
+        limit.release()
+        return True
+    _current_lease.set(lease)
+    return True
+
+
+def release_current() -> None:
+    """
+    Give back the current request's slot without counting it as a success,
+    e.g. when the client for the acquired key could not be built and the
+    handler moves on to another key.
+    """
+    lease = _current_lease.get()
+    if lease is None:
+        return
+    _current_lease.set(None)
+    lease.abandon()
+
+
+def record_upstream_error(error: BaseException) -> None:
+    """Feed an upstream error back into the current request's (model, key) limit."""
+    lease = _current_lease.get()
+    if lease is None or not is_overload_error(error):
+        return
+    lease.overloaded = True
+    lease.limit.on_overload()
@@ -0,0 +1,396 @@
+"""
+Admission control and load shedding.
+
+Generation requests (POST under /v1/ and /gemini/) must hold a slot before they
+reach a handler, and keep it until the response - including a whole SSE stream -
+has been sent:
+
+- Global limit: at most ADMISSION_MAX_IN_FLIGHT requests run at once. Extra
+  requests wait in a queue of at most ADMISSION_QUEUE_SIZE entries until their
+  deadline; beyond that they get 503.
+- Per-model limit: handlers call admit_model() once the model name is known.
+  Waiting uses the same deadline; rejection is 429.
+- Event-loop lag: while the measured loop lag exceeds ADMISSION_MAX_LOOP_LAG_MS
+  the worker is already too busy to serve what it has, so new requests get 503
+  without queueing.
+
+Every rejection carries Retry-After = (queue depth + 1) / observed completion
+rate, clamped to 1..ADMISSION_RETRY_AFTER_MAX seconds.
+
+Priority classes (interactive, default, batch) come from PRIORITY_API_KEYS for
+the client key, else from the X-Request-Priority header. Waiters are served by
+class first and earliest deadline second. A batch request waits up to
+ADMISSION_BATCH_QUEUE_TIMEOUT seconds, the other classes ADMISSION_QUEUE_TIMEOUT.
+X-Request-Timeout can shorten the wait. When the queue is full, a new request
+evicts the queued request with the lowest class if that class is lower than its
+own. The evicted request gets 503.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Deque, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+from fastapi.responses import JSONResponse
+
+import config as app_config
+import lifecycle
+from metrics import REGISTRY, LATENCY_BUCKETS
+from model_routing import model_label
+
+# 完成速率的统计窗口（秒）
+_DRAIN_RATE_WINDOW = 10.0
+_LOOP_LAG_INTERVAL = 0.1
+
+# 优先级从高到低；数值越小越先调度
+PRIORITY_CLASSES = ("interactive", "default", "batch")
+DEFAULT_PRIORITY = "default"
+_PRIORITY_RANK = {name: rank for rank, name in enumerate(PRIORITY_CLASSES)}
+
+ADMISSION_REJECTED_TOTAL = REGISTRY.counter(
+    "vertex2openai_admission_rejected_total", "Requests rejected by admission control, by limiter, priority class and reason.",
+    ("limiter", "priority", "reason"))
+ADMISSION_QUEUE_WAIT = REGISTRY.histogram(
+    "vertex2openai_admission_queue_wait_seconds", "Time queued requests spent waiting for a slot, by priority class.",
+    ("limiter", "priority"), LATENCY_BUCKETS)
+ADMISSION_QUEUE_DEPTH = REGISTRY.gauge(
+    "vertex2openai_admission_queue_depth", "Requests waiting for an admission slot.", ("limiter", "priority"))
+EVENT_LOOP_LAG = REGISTRY.gauge(
+    "vertex2openai_event_loop_lag_seconds", "Smoothed event loop scheduling lag.")
+
+
+class _Waiter:
+    __slots__ = ("key", "priority", "future")
+
+    def __init__(self, key: Tuple[int, float, int], priority: str, future: asyncio.Future):
+        self.key = key
+        self.priority = priority
+        self.future = future
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return self.key < other.key
+
+
+class Limiter:
+    """
+    Concurrency limit with a bounded wait queue ordered by (priority class,
+    deadline). A released slot is handed straight to the first waiter.
+    """
+
+    def __init__(self, name: str, capacity: int, queue_size: int):
+        self.name = name
+        self.capacity = capacity
+        self.queue_size = queue_size
+        self.in_flight = 0
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._completions: Deque[float] = deque()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def drain_rate(self) -> float:
+        """Completed requests per second over the last few seconds."""
+        now = time.monotonic()
+        while self._completions and self._completions[0] < now - _DRAIN_RATE_WINDOW:
+            self._completions.popleft()
+        return len(self._completions) / _DRAIN_RATE_WINDOW
+
+    def retry_after(self) -> int:
+        rate = self.drain_rate()
+        if rate <= 0:
+            return app_config.ADMISSION_RETRY_AFTER_MAX
+        return min(app_config.ADMISSION_RETRY_AFTER_MAX, max(1, math.ceil((self.queue_depth + 1) / rate)))
+
+    def _update_depth(self, priority: str) -> None:
+        ADMISSION_QUEUE_DEPTH.set(self.name, priority,
+                                  value=sum(1 for w in self._waiters if w.priority == priority))
+
+    def _remove(self, waiter: _Waiter) -> None:
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            return
+        heapq.heapify(self._waiters)
+        self._update_depth(waiter.priority)
+
+    def _preempt_for(self, rank: int) -> bool:
+        """Evict the lowest-priority, latest-deadline waiter if its class ranks below ``rank``."""
+        victim = max(self._waiters, default=None)
+        if victim is None or victim.key[0] <= rank:
+            return False
+        self._remove(victim)
+        victim.future.set_result(False)
+        return True
+
+    async def acquire(self, priority: str, deadline: float) -> Optional[str]:
+        """Take a slot, waiting until ``deadline`` at most. Returns None on success, else the rejection reason."""
+        if self.in_flight < self.capacity and not self._waiters:
+            self.in_flight += 1
+            return None
+        rank = _PRIORITY_RANK[priority]
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            return "queue_timeout"
+        if len(self._waiters) >= self.queue_size and not self._preempt_for(rank):
+            return "queue_full" if self.queue_size else "limit"
+        waiter = _Waiter((rank, deadline, next(self._seq)), priority, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiters, waiter)
+        self._update_depth(priority)
+        started = time.monotonic()
+        try:
+            granted = await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            return "queue_timeout"
+        except BaseException:
+            # 客户端断开：如果槽位已经转交给我们，必须还回去
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.result():
+                self.release()
+            raise
+        finally:
+            self._remove(waiter)
+        if not granted:
+            return "preempted"
+        ADMISSION_QUEUE_WAIT.observe(time.monotonic() - started, self.name, priority)
+        return None
+
+    def release(self) -> None:
+        self._completions.append(time.monotonic())
+        while self._waiters:
+            waiter = heapq.heappop(self._waiters)
+            self._update_depth(waiter.priority)
+            if not waiter.future.done():
+                # 槽位直接转交，in_flight 不变
+                waiter.future.set_result(True)
+                return
+        self.in_flight -= 1
+
+
+class AdmissionTicket:
+    """Slots held by one request; released by the middleware after the response has been sent."""
+
+    __slots__ = ("priority", "deadline", "limiters")
+
+    def __init__(self, priority: str, deadline: float):
+        self.priority = priority
+        self.deadline = deadline
+        self.limiters: List[Limiter] = []
+
+    def release(self) -> None:
+        while self.limiters:
+            self.limiters.pop().release()
+
+
+class AdmissionController:
+    def __init__(self):
+        self.global_limiter = Limiter("global", app_config.ADMISSION_MAX_IN_FLIGHT,
+                                      app_config.ADMISSION_QUEUE_SIZE)
+        self.model_limiters: Dict[str, Limiter] = {}
+        self.loop_lag = 0.0
+        self._monitor_task: Optional[asyncio.Task] = None
+
+    def model_limiter(self, model: str) -> Optional[Limiter]:
+        limiter = self.model_limiters.get(model)
+        if limiter is None:
+            capacity = app_config.ADMISSION_MODEL_LIMITS.get(model, app_config.ADMISSION_MAX_IN_FLIGHT_PER_MODEL)
+            if capacity <= 0:
+                return None
+            limiter = self.model_limiters[model] = Limiter(
+                f"model:{model}", capacity, app_config.ADMISSION_QUEUE_SIZE)
+        return limiter
+
+    def overloaded(self) -> bool:
+        threshold = app_config.ADMISSION_MAX_LOOP_LAG_MS
+        return threshold > 0 and self.loop_lag * 1000 > threshold
+
+    async def _monitor_loop_lag(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(_LOOP_LAG_INTERVAL)
+            lag = max(0.0, loop.time() - started - _LOOP_LAG_INTERVAL)
+            # 快升慢降：单次长阻塞立即生效，恢复后逐步回落
+            self.loop_lag = lag if lag > self.loop_lag else self.loop_lag * 0.8 + lag * 0.2
+            EVENT_LOOP_LAG.set(value=self.loop_lag)
+
+    def start(self) -> None:
+        if app_config.ADMISSION_ENABLED and app_config.ADMISSION_MAX_LOOP_LAG_MS > 0 and self._monitor_task is None:
+            self._monitor_task = asyncio.get_running_loop().create_task(self._monitor_loop_lag())
+
+    async def stop(self) -> None:
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+            try:
+                await self._monitor_task
+            except asyncio.CancelledError:
+                pass
+            self._monitor_task = None
+
+
+controller = AdmissionController()
+
+_current_ticket: ContextVar[Optional[AdmissionTicket]] = ContextVar("vertex2openai_admission_ticket", default=None)
+
+
+# 文件上传与批处理任务管理不是生成请求，不受准入控制
+_UNGOVERNED_PREFIXES = ("/v1/files", "/v1/batches")
+
+
+def _is_governed(scope) -> bool:
+    path = scope.get("path", "")
+    return (scope.get("method") == "POST" and (path.startswith("/v1/") or path.startswith("/gemini/"))
+            and not path.startswith(_UNGOVERNED_PREFIXES))
+
+
+def _headers(scope) -> Dict[bytes, bytes]:
+    return {name.lower(): value for name, value in scope.get("headers", [])}
+
+
+def _client_key(scope, headers: Dict[bytes, bytes]) -> Optional[str]:
+    """Client API key, looked up in the same order as the auth dependencies (?key=, x-goog-api-key, Bearer)."""
+    query_key = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("key")
+    if query_key:
+        return query_key[0]
+    if b"x-goog-api-key" in headers:
+        return headers[b"x-goog-api-key"].decode("latin-1")
+    authorization = headers.get(b"authorization", b"").decode("latin-1")
+    if authorization.startswith("Bearer "):
+        return authorization[len("Bearer "):]
+    return None
+
+
+def classify(scope) -> Tuple[str, float]:
+    """Priority class and queue deadline (monotonic) for a request."""
+    headers = _headers(scope)
+    priority = None
+    client_key = _client_key(scope, headers)
+    if client_key:
+        priority = app_config.PRIORITY_API_KEYS.get(client_key)
+    if priority is None:
+        requested = headers.get(b"x-request-priority", b"").decode("latin-1").strip().lower()
+        priority = requested if requested in _PRIORITY_RANK else DEFAULT_PRIORITY
+    timeout = app_config.ADMISSION_BATCH_QUEUE_TIMEOUT if priority == "batch" else app_config.ADMISSION_QUEUE_TIMEOUT
+    try:
+        # 客户端可以缩短（不能延长）排队时间
+        requested_timeout = float(headers.get(b"x-request-timeout", b""))
+        if requested_timeout > 0:
+            timeout = min(timeout, requested_timeout)
+    except ValueError:
+        pass
+    return priority, time.monotonic() + timeout
+
+
+def _error_content(path: str, status: int, message: str) -> dict:
+    if path.startswith("/gemini/"):
+        status_name = "RESOURCE_EXHAUSTED" if status == 429 else "UNAVAILABLE"
+        return {"error": {"code": status, "message": message, "status": status_name}}
+    error_type = "rate_limit_error" if status == 429 else "server_error"
+    return {"error": {"message": message, "type": error_type, "code": status, "param": None}}
+
+
+def _reject(limiter: Limiter, priority: str, reason: str) -> int:
+    ADMISSION_REJECTED_TOTAL.inc(limiter.name, priority, reason)
+    return limiter.retry_after()
+
+
+async def admit_model(model: str, path: str = "/v1/") -> Optional[JSONResponse]:
+    """
+    Take a per-model slot for the current request. Returns None when admitted,
+    otherwise a 429 response to return from the handler.
+    """
+    ticket = _current_ticket.get()
+    if ticket is None:
+        return None
+    # 未知模型共用一个限流器，避免任意模型名无限增加限流器与指标
+    limiter = controller.model_limiter(model_label(model))
+    if limiter is None:
+        return None
+    reason = await limiter.acquire(ticket.priority, ticket.deadline)
+    if reason is None:
+        ticket.limiters.append(limiter)
+        return None
+    retry_after = _reject(limiter, ticket.priority, reason)
+    return JSONResponse(
+        status_code=429,
+        content=_error_content(path, 429, f"Too many concurrent requests for model '{model}', retry later"),
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+async def admit_background(priority: str = "batch") -> bool:
+    """
+    Take a global slot for work started outside an HTTP request (batch jobs).
+    Must run inside lifecycle.request_scope(); the slot is released when the
+    scope ends. Returns False when the work should be retried later.
+    """
+    if not app_config.ADMISSION_ENABLED:
+        return True
+    limiter = controller.global_limiter
+    if controller.overloaded():
+        ADMISSION_REJECTED_TOTAL.inc(limiter.name, priority, "loop_lag")
+        return False
+    timeout = app_config.ADMISSION_BATCH_QUEUE_TIMEOUT if priority == "batch" else app_config.ADMISSION_QUEUE_TIMEOUT
+    ticket = AdmissionTicket(priority, time.monotonic() + timeout)
+    if limiter.capacity > 0:
+        reason = await limiter.acquire(priority, ticket.deadline)
+        if reason is not None:
+            ADMISSION_REJECTED_TOTAL.inc(limiter.name, priority, reason)
+            return False
+        ticket.limiters.append(limiter)
+    _current_ticket.set(ticket)
+    lifecycle.on_request_end(ticket.release)
+    return True
+
+
+class AdmissionMiddleware:
+    """Pure ASGI middleware applying the global limit and loop-lag shedding to generation requests."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _is_governed(scope):
+            await self.app(scope, receive, send)
+            return
+
+        limiter = controller.global_limiter
+        priority, deadline = classify(scope)
+        if controller.overloaded():
+            await self._send_rejection(scope, send, _reject(limiter, priority, "loop_lag"),
+                                       "Server is overloaded, retry later")
+            return
+
+        ticket = AdmissionTicket(priority, deadline)
+        if limiter.capacity > 0:
+            reason = await limiter.acquire(priority, deadline)
+            if reason is not None:
+                await self._send_rejection(scope, send, _reject(limiter, priority, reason),
+                                           "Server is at capacity, retry later")
+                return
+            ticket.limiters.append(limiter)
+
+        token = _current_ticket.set(ticket)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_ticket.reset(token)
+            ticket.release()
+
+    @staticmethod
+    async def _send_rejection(scope, send, retry_after: int, message: str) -> None:
+        body = JSONResponse(content=_error_content(scope.get("path", ""), 503, message)).body
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(retry_after).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
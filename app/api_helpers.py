@@ -2,10 +2,13 @@ import json
 import time
 import math
 import asyncio
+import hashlib
 from typing import List, Dict, Any, Callable, Union, Optional
 
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from google.auth.transport.requests import Request as AuthRequest
+from google import genai
 from google.genai import types
 from google.genai.errors import ClientError
 from openai import AsyncOpenAI
@@ -13,6 +16,10 @@ from openai import AsyncOpenAI
 
 from models import OpenAIRequest, OpenAIMessage
 from message_processing import (
+    create_gemini_prompt,
+    create_encrypted_gemini_prompt,
+    create_encrypted_full_gemini_prompt,
+    ENCRYPTION_INSTRUCTIONS,
     convert_to_openai_format,
     convert_chunk_to_openai,
     extract_reasoning_by_tags,
@@ -20,7 +27,17 @@ from message_processing import (
     extract_system_instruction
 )
 import config as app_config
-from config import VERTEX_REASONING_TAG
+from config import VERTEX_REASONING_TAG, VERTEX_API_BASE
+from model_routing import ModelRoute, compile_model_route, model_capabilities, PROMPT_AUTO, PROMPT_ENCRYPT, PROMPT_ENCRYPT_FULL
+from project_id_discovery import discover_project_id
+import metrics
+import tracing
+import lifecycle
+import adaptive_concurrency
+import compression
+import image_fetch
+import image_preprocessing
+import image_transcoding
 
 
 def is_retryable_error(error: Exception) -> bool:
@@ -50,6 +67,8 @@ async def retry_with_backoff(
             return await func(*args, **kwargs)
         except Exception as e:
             last_exception = e
+            metrics.record_upstream_error(e)
+            adaptive_concurrency.record_upstream_error(e)
             
             if not is_retryable_error(e):
                 print(f"ERROR: Non-retryable error, failing immediately: {type(e).__name__} - {str(e)}")
@@ -58,6 +77,7 @@ async def retry_with_backoff(
             if attempt < max_retries - 1:
                 print(f"WARNING: Attempt {attempt + 1}/{max_retries} failed: {type(e).__name__} - {str(e)[:200]}")
                 print(f"INFO: Retrying in {delay}s...")
+                metrics.record_retry("generate_content")
                 await asyncio.sleep(delay)
             else:
                 print(f"ERROR: All {max_retries} attempts failed")
@@ -148,24 +168,139 @@ class StreamingReasoningProcessor:
         self.tag_buffer, self.reasoning_buffer = "", ""
         return remaining_content, remaining_reasoning
 
+# 本 worker 复用的 genai 客户端：构造一个 Client 要花约 100ms CPU，不应每个请求重复。
+# 键为 ("express", api_key, base_url) 或 ("sa", project_id, location, service account)；
+# 客户端均经 lifecycle.track_client 登记，关闭时由 close_clients 统一关闭。
+_client_pool: Dict[tuple, genai.Client] = {}
+
+
+async def _clear_client_pool() -> None:
+    _client_pool.clear()
+
+
+lifecycle.on_shutdown(_clear_client_pool)
+
+
+async def create_express_client(api_key: str, model_name: str) -> genai.Client:
+    """Express Key 的复用客户端；需要项目端点的模型（见 model_routing 能力表）走 projects/{id}/locations/global"""
+    project_endpoint = model_capabilities(model_name).express_project_endpoint
+    if project_endpoint:
+        project_id = await discover_project_id(api_key)
+        base_url = f"{VERTEX_API_BASE}/v1/projects/{project_id}/locations/global"
+    else:
+        base_url = f"{VERTEX_API_BASE}/"
+    pool_key = ("express", api_key, base_url)
+    client = _client_pool.get(pool_key)
+    if client is None:
+        with tracing.span("genai.Client", phase="client_init", auth_path="express"):
+            client = genai.Client(vertexai=True, api_key=api_key, http_options=types.HttpOptions(base_url=base_url))
+            if project_endpoint:
+                client._api_client._http_options.api_version = None
+        client = _client_pool[pool_key] = lifecycle.track_client(client)
+    return client
+
+
+def get_sa_client(credentials, project_id: str, location: str = "global") -> genai.Client:
+    """SA 凭证的复用客户端；同一项目/区域/服务账号只构造一次，之后沿用首次的凭证对象（自行刷新 token）"""
+    pool_key = ("sa", project_id, location, getattr(credentials, "service_account_email", None))
+    client = _client_pool.get(pool_key)
+    if client is None:
+        with tracing.span("genai.Client", phase="client_init", auth_path="sa"):
+            client = genai.Client(vertexai=True, credentials=credentials, project=project_id, location=location)
+        client = _client_pool[pool_key] = lifecycle.track_client(client)
+    return client
+
+
+async def select_client(app, route: ModelRoute, location: str = "global") -> genai.Client:
+    """SA credentials unless the model is [EXPRESS] or only Express keys exist; honours AIMD limits."""
+    credential_manager = app.state.credential_manager
+    express_key_manager = app.state.express_key_manager
+    has_sa_creds = credential_manager.get_total_credentials() > 0
+    has_express_key = express_key_manager.get_total_keys() > 0
+
+    if route.express or not has_sa_creds:
+        if not has_express_key:
+            raise ValueError(f"No credentials available for model '{route.base_model}'")
+        total_keys = express_key_manager.get_total_keys()
+        for attempt in range(total_keys):
+            key_tuple = express_key_manager.get_express_api_key()
+            if not key_tuple:
+                break
+            key_idx, key_val = key_tuple
+            if await adaptive_concurrency.acquire(route.base_model, f"express:{key_idx}", wait=attempt == total_keys - 1):
+                metrics.set_request_labels(auth_path="express", key=f"express:{key_idx}")
+                try:
+                    return await create_express_client(key_val, route.base_model)
+                except Exception:
+                    adaptive_concurrency.release_current()
+                    raise
+        raise adaptive_concurrency.ConcurrencyLimitExceeded(
+            f"All Express keys for model '{route.base_model}' are at their adaptive concurrency limit")
+
+    credentials, project_id = credential_manager.get_credentials()
+    if not credentials or not project_id:
+        raise ValueError("No SA credentials available")
+    if not await adaptive_concurrency.acquire(route.base_model, f"sa:{project_id}", wait=True):
+        raise adaptive_concurrency.ConcurrencyLimitExceeded(
+            f"SA project for model '{route.base_model}' is at its adaptive concurrency limit")
+    metrics.set_request_labels(auth_path="sa", key=f"sa:{project_id}")
+    try:
+        return get_sa_client(credentials, project_id, location)
+    except Exception:
+        adaptive_concurrency.release_current()
+        raise
+
+
+class PrecomputedJSONBody:
+    """JSON body serialized once per data version and served as ready bytes with a strong ETag."""
+
+    def __init__(self):
+        self.version: Any = None
+        self.body = b""
+        self.etag = ""
+
+    def get(self, version: Any, build: Callable[[], Any]) -> "PrecomputedJSONBody":
+        if version != self.version or not self.body:
+            self.body = json.dumps(build(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            self.etag = f'"{hashlib.blake2b(self.body, digest_size=16).hexdigest()}"'
+            self.version = version
+        return self
+
+    def response(self, request: Request) -> Response:
+        headers = {"ETag": self.etag, "Cache-Control": f"private, max-age={app_config.MODELS_RESPONSE_MAX_AGE}"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            # 压缩中间件会给编码后的响应加上后缀（"abc-br"），比较时忽略
+            matched = compression.matching_etag(if_none_match, self.etag)
+            if matched is not None:
+                return Response(status_code=304, headers={**headers, "ETag": matched})
+        return Response(content=self.body, media_type="application/json", headers=headers)
+
+
 def create_openai_error_response(status_code: int, message: str, error_type: str) -> Dict[str, Any]:
     return {"error": {"message": message, "type": error_type, "code": status_code, "param": None}}
 
 def create_generation_config(request: OpenAIRequest) -> Dict[str, Any]:
     config: Dict[str, Any] = {}
     
-    # Check for -2k or -4k suffix to add image generation capabilities
-    model_name = request.model
-    if model_name.endswith('-2k'):
-        # Add image generation config for 2k resolution
-        config["responseModalities"] = ["TEXT", "IMAGE"]
-        config["imageConfig"] = {"imageSize": "2k"}
-        print(f"Detected -2k suffix, adding image generation config with 2k resolution")
-    elif model_name.endswith('-4k'):
-        # Add image generation config for 4k resolution
+    route = compile_model_route(request.model)
+
+    # -2k / -4k suffix adds image generation capabilities
+    image_size = route.image_size
+    if image_size:
         config["responseModalities"] = ["TEXT", "IMAGE"]
-        config["imageConfig"] = {"imageSize": "4k"}
-        print(f"Detected -4k suffix, adding image generation config with 4k resolution")
+        config["imageConfig"] = {"imageSize": image_size}
+        print(f"Detected -{image_size} suffix, adding image generation config with {image_size} resolution")
+
+    # 别名模型注入 thinking_level；思考模型默认返回思考过程
+    if route.thinking_level or route.include_thoughts is not None:
+        thinking_config = config.setdefault("thinking_config", {})
+        if route.thinking_level:
+            thinking_config["thinking_level"] = route.thinking_level
+        if route.include_thoughts is not None:
+            thinking_config["include_thoughts"] = route.include_thoughts
+        if route.thinking_budget is not None:
+            thinking_config["thinking_budget"] = route.thinking_budget
     
     if request.temperature is not None: config["temperature"] = request.temperature
     if request.max_tokens is not None: config["max_output_tokens"] = request.max_tokens
@@ -268,6 +403,8 @@ async def _chunk_openai_response_dict_for_sse(
     model_name_override: Optional[str] = None
 ):
     resp_id = response_id_override or openai_response_dict.get("id", f"chatcmpl-fakestream-{int(time.time())}")
+    # 分块间隔默认 0：结果一到就连续写出，不人为增加延迟
+    pause = app_config.FAKE_STREAMING_CHUNK_DELAY_SECONDS
     model_name = model_name_override or openai_response_dict.get("model", "unknown")
     created_time = openai_response_dict.get("created", int(time.time()))
     
@@ -293,7 +430,7 @@ async def _chunk_openai_response_dict_for_sse(
                     }]
                 }
                 yield f"data: {json.dumps({'id': resp_id, 'object': 'chat.completion.chunk', 'created': created_time, 'model': model_name, 'choices': [{'index': choice_idx, 'delta': delta_tc_start, 'finish_reason': None}]})}\n\n"
-                await asyncio.sleep(0.01) 
+                if pause: await asyncio.sleep(pause)
 
                 delta_tc_args = {
                     "tool_calls": [{
@@ -303,7 +440,7 @@ async def _chunk_openai_response_dict_for_sse(
                     }]
                 }
                 yield f"data: {json.dumps({'id': resp_id, 'object': 'chat.completion.chunk', 'created': created_time, 'model': model_name, 'choices': [{'index': choice_idx, 'delta': delta_tc_args, 'finish_reason': None}]})}\n\n"
-                await asyncio.sleep(0.01)
+                if pause: await asyncio.sleep(pause)
         
         elif message.get("content") is not None or message.get("reasoning_content") is not None : 
             reasoning_content = message.get("reasoning_content", "")
@@ -312,23 +449,43 @@ async def _chunk_openai_response_dict_for_sse(
             if reasoning_content:
                 delta_reasoning = {"reasoning_content": reasoning_content}
                 yield f"data: {json.dumps({'id': resp_id, 'object': 'chat.completion.chunk', 'created': created_time, 'model': model_name, 'choices': [{'index': choice_idx, 'delta': delta_reasoning, 'finish_reason': None}]})}\n\n"
-                if actual_content is not None: await asyncio.sleep(0.05)
+                if actual_content is not None and pause: await asyncio.sleep(pause)
 
             content_to_chunk = actual_content if actual_content is not None else ""
             if actual_content is not None:
-                chunk_size = max(1, math.ceil(len(content_to_chunk) / 10)) if content_to_chunk else 1
+                chunk_size = max(1, math.ceil(len(content_to_chunk) / max(1, app_config.FAKE_STREAMING_CHUNKS))) if content_to_chunk else 1
                 if not content_to_chunk and not reasoning_content : 
                     yield f"data: {json.dumps({'id': resp_id, 'object': 'chat.completion.chunk', 'created': created_time, 'model': model_name, 'choices': [{'index': choice_idx, 'delta': {'content': ''}, 'finish_reason': None}]})}\n\n"
                 else:
                     for i in range(0, len(content_to_chunk), chunk_size):
                         yield f"data: {json.dumps({'id': resp_id, 'object': 'chat.completion.chunk', 'created': created_time, 'model': model_name, 'choices': [{'index': choice_idx, 'delta': {'content': content_to_chunk[i:i+chunk_size]}, 'finish_reason': None}]})}\n\n"
-                        if len(content_to_chunk) > chunk_size: await asyncio.sleep(0.05)
+                        if pause and i + chunk_size < len(content_to_chunk): await asyncio.sleep(pause)
         
         yield f"data: {json.dumps({'id': resp_id, 'object': 'chat.completion.chunk', 'created': created_time, 'model': model_name, 'choices': [{'index': choice_idx, 'delta': {}, 'finish_reason': final_finish_reason}]})}\n\n"
 
     yield "data: [DONE]\n\n"
 
 
+def _keep_alive_frame(model: str) -> str:
+    """SSE keep-alive chunk for fake streaming, encoded once per stream."""
+    keep_alive_data = {"id": "chatcmpl-keepalive", "object": "chat.completion.chunk", "created": int(time.time()), "model": model, "choices": [{"delta": {"content": ""}, "index": 0, "finish_reason": None}]}
+    return f"data: {json.dumps(keep_alive_data)}\n\n"
+
+
+async def _keep_alive_until_done(api_call_task: asyncio.Task, frame: str):
+    """
+    Yield ``frame`` at once and then every FAKE_STREAMING_INTERVAL_SECONDS while
+    ``api_call_task`` runs. Waits on the task itself, so the caller resumes as
+    soon as the upstream result arrives instead of at the next interval tick.
+    """
+    interval = app_config.FAKE_STREAMING_INTERVAL_SECONDS
+    if interval <= 0:
+        return
+    while not api_call_task.done():
+        yield frame
+        await asyncio.wait((api_call_task,), timeout=interval)
+
+
 async def gemini_fake_stream_generator( 
     gemini_client_instance: Any, 
     model_for_api_call: str, 
@@ -340,6 +497,7 @@ async def gemini_fake_stream_generator(
     model_name_for_log = getattr(gemini_client_instance, 'model_name', 'unknown_gemini_model_object')
     print(f"FAKE STREAMING (Gemini): Prep for '{request_obj.model}' (API model string: '{model_for_api_call}', client obj: '{model_name_for_log}')")
     
+    upstream_span = tracing.start_span("upstream.generate_content", phase="upstream", model=model_for_api_call, fake_stream=True)
     api_call_task = asyncio.create_task(
         gemini_client_instance.aio.models.generate_content(
             model=model_for_api_call, 
@@ -347,16 +505,15 @@ async def gemini_fake_stream_generator(
             config=gen_config_dict_for_api_call # Pass the dictionary directly
         )
     )
+    api_call_task.add_done_callback(lambda _: upstream_span.end())
 
-    outer_keep_alive_interval = app_config.FAKE_STREAMING_INTERVAL_SECONDS
-    if outer_keep_alive_interval > 0:
-        while not api_call_task.done():
-            keep_alive_data = {"id": "chatcmpl-keepalive", "object": "chat.completion.chunk", "created": int(time.time()), "model": request_obj.model, "choices": [{"delta": {"content": ""}, "index": 0, "finish_reason": None}]}
-            yield f"data: {json.dumps(keep_alive_data)}\n\n"
-            await asyncio.sleep(outer_keep_alive_interval)
-    
     try:
+        async for keep_alive in _keep_alive_until_done(api_call_task, _keep_alive_frame(request_obj.model)):
+            yield keep_alive
+
         raw_gemini_response = await api_call_task 
+        await image_transcoding.transcode_images(raw_gemini_response)
+        metrics.record_output_tokens(metrics.output_tokens_from_usage(getattr(raw_gemini_response, 'usage_metadata', None)))
         openai_response_dict = convert_to_openai_format(raw_gemini_response, request_obj.model)
         
         if hasattr(raw_gemini_response, 'prompt_feedback') and \
@@ -376,6 +533,8 @@ async def gemini_fake_stream_generator(
     except Exception as e_outer_gemini:
         err_msg_detail = f"Error in gemini_fake_stream_generator (model: '{request_obj.model}'): {type(e_outer_gemini).__name__} - {str(e_outer_gemini)}"
         print(f"ERROR: {err_msg_detail}")
+        metrics.record_upstream_error(e_outer_gemini)
+        adaptive_concurrency.record_upstream_error(e_outer_gemini)
         sse_err_msg_display = str(e_outer_gemini)
         if len(sse_err_msg_display) > 512: sse_err_msg_display = sse_err_msg_display[:512] + "..."
         err_resp_sse = create_openai_error_response(500, sse_err_msg_display, "server_error")
@@ -384,6 +543,10 @@ async def gemini_fake_stream_generator(
             yield f"data: {json_payload_error}\n\n"
             yield "data: [DONE]\n\n"
         if is_auto_attempt: raise
+    finally:
+        # 客户端提前断开时不再等待上游结果
+        if not api_call_task.done():
+            api_call_task.cancel()
 
 
 async def openai_fake_stream_generator( 
@@ -402,17 +565,16 @@ async def openai_fake_stream_generator(
         params_for_call['stream'] = False 
         return await openai_client.chat.completions.create(**params_for_call, extra_body=openai_extra_body)
 
+    upstream_span = tracing.start_span("upstream.chat_completions", phase="upstream", model=api_model_name, fake_stream=True)
     api_call_task = asyncio.create_task(_openai_api_call_task())
-    outer_keep_alive_interval = app_config.FAKE_STREAMING_INTERVAL_SECONDS
-    if outer_keep_alive_interval > 0:
-        while not api_call_task.done():
-            keep_alive_data = {"id": "chatcmpl-keepalive", "object": "chat.completion.chunk", "created": int(time.time()), "model": request_obj.model, "choices": [{"delta": {"content": ""}, "index": 0, "finish_reason": None}]}
-            yield f"data: {json.dumps(keep_alive_data)}\n\n"
-            await asyncio.sleep(outer_keep_alive_interval)
-
+    api_call_task.add_done_callback(lambda _: upstream_span.end())
     try:
+        async for keep_alive in _keep_alive_until_done(api_call_task, _keep_alive_frame(request_obj.model)):
+            yield keep_alive
+
         raw_response_obj = await api_call_task 
         openai_response_dict = raw_response_obj.model_dump(exclude_unset=True, exclude_none=True)
+        metrics.record_output_tokens((openai_response_dict.get("usage") or {}).get("completion_tokens") or 0)
 
         if app_config.SAFETY_SCORE and hasattr(raw_response_obj, "choices") and raw_response_obj.choices:
             for i, choice_obj in enumerate(raw_response_obj.choices):
@@ -449,6 +611,8 @@ async def openai_fake_stream_generator(
     except Exception as e_outer: 
         err_msg_detail = f"Error in openai_fake_stream_generator (model: '{request_obj.model}'): {type(e_outer).__name__} - {str(e_outer)}"
         print(f"ERROR: {err_msg_detail}")
+        metrics.record_upstream_error(e_outer)
+        adaptive_concurrency.record_upstream_error(e_outer)
         sse_err_msg_display = str(e_outer)
         if len(sse_err_msg_display) > 512: sse_err_msg_display = sse_err_msg_display[:512] + "..."
         err_resp_sse = create_openai_error_response(500, sse_err_msg_display, "server_error")
@@ -457,6 +621,9 @@ async def openai_fake_stream_generator(
             yield f"data: {json_payload_error}\n\n"
             yield "data: [DONE]\n\n"
         if is_auto_attempt: raise
+    finally:
+        if not api_call_task.done():
+            api_call_task.cancel()
 
 
 async def execute_gemini_call(
@@ -478,7 +645,10 @@ async def execute_gemini_call(
             gen_config_dict["system_instruction"] = system_instruction
         print(f"INFO: Extracted system instruction (length: {len(system_instruction)} chars)")
     
-    actual_prompt_for_call = prompt_func(request_obj.messages)
+    await image_fetch.prefetch_messages(request_obj.messages)
+    with tracing.span("create_gemini_prompt", phase="prompt_conversion", messages=len(request_obj.messages)):
+        actual_prompt_for_call = prompt_func(request_obj.messages)
+    actual_prompt_for_call = await image_preprocessing.preprocessor.preprocess_contents(actual_prompt_for_call, model_to_call)
     client_model_name_for_log = getattr(current_client, 'model_name', 'unknown_direct_client_object')
     print(f"INFO: execute_gemini_call for requested API model '{model_to_call}', using client object with internal name '{client_model_name_for_log}'. Original request model: '{request_obj.model}'")
     
@@ -497,18 +667,42 @@ async def execute_gemini_call(
                 max_retries = 10
                 retry_delay = 1.0
                 for attempt in range(max_retries):
+                    upstream_span = tracing.start_span("upstream.stream_generate_content", model=model_to_call, attempt=attempt + 1)
+                    stream_started = time.perf_counter()
+                    conversion_ms = 0.0
+                    chunk_count = 0
                     try:
                         stream_gen_obj = await current_client.aio.models.generate_content_stream(
                             model=model_to_call,
                             contents=actual_prompt_for_call,
                             config=gen_config_dict
                         )
+                        last_usage_metadata = None
                         async for chunk_item_call in stream_gen_obj:
-                            yield convert_chunk_to_openai(chunk_item_call, request_obj.model, response_id_for_stream, 0)
+                            chunk_received = time.perf_counter()
+                            if chunk_count == 0:
+                                ttft_ms = (chunk_received - stream_started) * 1000
+                                upstream_span.set_attribute("upstream.ttft_ms", ttft_ms)
+                                tracing.add_phase_time("upstream_ttft", ttft_ms)
+                            chunk_count += 1
+                            last_usage_metadata = getattr(chunk_item_call, 'usage_metadata', None) or last_usage_metadata
+                            await image_transcoding.transcode_images(chunk_item_call)
+                            sse_chunk = convert_chunk_to_openai(chunk_item_call, request_obj.model, response_id_for_stream, 0)
+                            conversion_ms += (time.perf_counter() - chunk_received) * 1000
+                            yield sse_chunk
+                        metrics.record_output_tokens(metrics.output_tokens_from_usage(last_usage_metadata))
+                        upstream_span.set_attribute("stream.chunks", chunk_count)
+                        upstream_span.set_attribute("chunk_conversion_ms", conversion_ms)
+                        tracing.add_phase_time("chunk_conversion", conversion_ms)
+                        upstream_span.end()
                         yield "data: [DONE]\n\n"
                         return  # 成功完成，退出
                     except Exception as e_stream_call:
+                        upstream_span.record_error(e_stream_call)
+                        upstream_span.end()
                         err_msg_detail_stream = f"Streaming Error (Gemini API, model string: '{model_to_call}'): {type(e_stream_call).__name__} - {str(e_stream_call)}"
+                        metrics.record_upstream_error(e_stream_call)
+                        adaptive_concurrency.record_upstream_error(e_stream_call)
                         
                         if not is_retryable_error(e_stream_call):
                             print(f"ERROR: {err_msg_detail_stream} (non-retryable)")
@@ -523,6 +717,7 @@ async def execute_gemini_call(
                         if attempt < max_retries - 1:  # 还有重试机会
                             print(f"WARNING: {err_msg_detail_stream} (attempt {attempt + 1}/{max_retries})")
                             print(f"INFO: Retrying stream in {retry_delay}s...")
+                            metrics.record_retry("stream")
                             await asyncio.sleep(retry_delay)
                         else:
                             print(f"ERROR: {err_msg_detail_stream} (all {max_retries} retries exhausted)")
@@ -542,7 +737,9 @@ async def execute_gemini_call(
                 config=gen_config_dict
             )
         
-        response_obj_call = await retry_with_backoff(_non_stream_call, max_retries=10, delay=1.0)
+        with tracing.span("upstream.generate_content", phase="upstream", model=model_to_call):
+            response_obj_call = await retry_with_backoff(_non_stream_call, max_retries=10, delay=1.0)
+        metrics.record_output_tokens(metrics.output_tokens_from_usage(getattr(response_obj_call, 'usage_metadata', None)))
         if hasattr(response_obj_call, 'prompt_feedback') and \
            hasattr(response_obj_call.prompt_feedback, 'block_reason') and \
            response_obj_call.prompt_feedback.block_reason:
@@ -573,5 +770,75 @@ async def execute_gemini_call(
                 error_details += f"Response type: {type(response_obj_call).__name__}"
             raise ValueError(error_details)
         
-        openai_response_content = convert_to_openai_format(response_obj_call, request_obj.model)
-        return JSONResponse(content=openai_response_content)
\ No newline at end of file
+        await image_transcoding.transcode_images(response_obj_call)
+        with tracing.span("convert_to_openai_format", phase="response_conversion"):
+            openai_response_content = convert_to_openai_format(response_obj_call, request_obj.model)
+        return JSONResponse(content=openai_response_content)
+
+
+async def dispatch_gemini_request(client: Any, route, request_obj: OpenAIRequest, gen_config_dict: Dict[str, Any]):
+    """
+    Run a chat request on an already selected Gemini client using the route's
+    prompt strategy (auto fallbacks, encryption, search tool). Shared by the
+    chat completions endpoint and the batch runner.
+    """
+    if route.prompt_strategy == PROMPT_AUTO:
+        print(f"Processing auto model: {request_obj.model}")
+        attempts = [
+            {"name": "base", "model": route.base_model, "prompt_func": create_gemini_prompt, "config_modifier": lambda c: c},
+            {"name": "encrypt", "model": route.base_model, "prompt_func": create_encrypted_gemini_prompt, "config_modifier": lambda c: {**c, "system_instruction": ENCRYPTION_INSTRUCTIONS}},
+            {"name": "old_format", "model": route.base_model, "prompt_func": create_encrypted_full_gemini_prompt, "config_modifier": lambda c: c}
+        ]
+        last_err = None
+        for attempt in attempts:
+            print(f"Auto-mode attempting: '{attempt['name']}' for model {attempt['model']}")
+            # Apply modifier to the dictionary. Ensure modifier returns a dict.
+            current_gen_config_dict = attempt["config_modifier"](gen_config_dict.copy())
+            try:
+                # Pass is_auto_attempt=True for auto-mode calls
+                result = await execute_gemini_call(client, attempt["model"], attempt["prompt_func"], current_gen_config_dict, request_obj, is_auto_attempt=True)
+                return result
+            except Exception as e_auto:
+                last_err = e_auto
+                print(f"Auto-attempt '{attempt['name']}' for model {attempt['model']} failed: {e_auto}")
+                metrics.record_fallback("auto_mode")
+                await asyncio.sleep(1)
+
+        print(f"All auto attempts failed. Last error: {last_err}")
+        err_msg = f"All auto-mode attempts failed for model {request_obj.model}. Last error: {str(last_err)}"
+        if not request_obj.stream and last_err:
+             return JSONResponse(status_code=500, content=create_openai_error_response(500, err_msg, "server_error"))
+        elif request_obj.stream:
+            # This is the final error handling for auto-mode if all attempts fail AND it was a streaming request
+            async def final_auto_error_stream():
+                err_content = create_openai_error_response(500, err_msg, "server_error")
+                json_payload_final_auto_error = json.dumps(err_content)
+                # Log the final error being sent to client after all auto-retries failed
+                print(f"DEBUG: Auto-mode all attempts failed. Yielding final error JSON: {json_payload_final_auto_error}")
+                yield f"data: {json_payload_final_auto_error}\n\n"
+                yield "data: [DONE]\n\n"
+            return StreamingResponse(final_auto_error_stream(), media_type="text/event-stream")
+        return JSONResponse(status_code=500, content=create_openai_error_response(500, "All auto-mode attempts failed without specific error.", "server_error"))
+
+    else: # Not an auto model
+        current_prompt_func = create_gemini_prompt
+
+        if "google_search" in route.tools:
+            search_tool = types.Tool(google_search=types.GoogleSearch())
+            # Add or update the 'tools' key in the gen_config_dict
+            if "tools" in gen_config_dict and isinstance(gen_config_dict["tools"], list):
+                gen_config_dict["tools"].append(search_tool)
+            else:
+                gen_config_dict["tools"] = [search_tool]
+
+        # For encrypted models, add encryption instructions to system_instruction
+        if route.prompt_strategy in (PROMPT_ENCRYPT, PROMPT_ENCRYPT_FULL):
+            # 加密与加密全模式都需要加密指令
+            current_prompt_func = create_encrypted_gemini_prompt if route.prompt_strategy == PROMPT_ENCRYPT else create_encrypted_full_gemini_prompt
+            if "system_instruction" in gen_config_dict and gen_config_dict["system_instruction"]:
+                gen_config_dict["system_instruction"] = f"{ENCRYPTION_INSTRUCTIONS}\n\n{gen_config_dict['system_instruction']}"
+            else:
+                gen_config_dict["system_instruction"] = ENCRYPTION_INSTRUCTIONS
+        # thinking_config (include_thoughts / -nothinking / -max budget) was applied by create_generation_config
+
+        return await execute_gemini_call(client, route.base_model, current_prompt_func, gen_config_dict, request_obj)
\ No newline at end of file
@@ -1,10 +1,11 @@
 from fastapi import HTTPException, Header, Depends
 from fastapi.security import APIKeyHeader
 from typing import Optional
-from config import API_KEY, HUGGINGFACE_API_KEY, HUGGINGFACE # Import API_KEY, HUGGINGFACE_API_KEY, HUGGINGFACE
+from config import API_KEY, HUGGINGFACE_API_KEY, HUGGINGFACE, PRIORITY_API_KEYS # Import API_KEY, HUGGINGFACE_API_KEY, HUGGINGFACE
 import os
 import json
 import base64
+import tracing
 
 # Function to validate API key (moved from config.py)
 def validate_api_key(api_key_to_validate: str) -> bool:
@@ -15,7 +16,8 @@ def validate_api_key(api_key_to_validate: str) -> bool:
         # If no API key is configured, authentication is disabled (or treat as invalid)
         # Depending on desired behavior, for now, let's assume if API_KEY is not set, all keys are invalid unless it's an empty string match
         return False # Or True if you want to disable auth when API_KEY is not set
-    return api_key_to_validate == API_KEY
+    # PRIORITY_API_KEYS 中的客户端 key 同样有效（只影响准入控制的优先级）
+    return api_key_to_validate == API_KEY or api_key_to_validate in PRIORITY_API_KEYS
 
 # API Key security scheme
 api_key_header = APIKeyHeader(name="Authorization", auto_error=False)
@@ -64,6 +66,7 @@ async def get_api_key(
         elif error_in_token is None:  # JSON 'null' is Python's None
             # If error is null, auth is successful. Now check if HUGGINGFACE_API_KEY is configured.
             print(f"HuggingFace authentication successful via x-ip-token (error field was null).")
+            tracing.mark_authenticated()
             return HUGGINGFACE_API_KEY # Return the configured HUGGINGFACE_API_KEY
         else:
             # Any other non-null, non-"InvalidAccessToken" value in 'error' field
@@ -100,4 +103,5 @@ async def get_api_key(
                 detail="Invalid API key"
             )
         
+        tracing.mark_authenticated()
         return api_key
\ No newline at end of file
@@ -0,0 +1,570 @@
+"""
+OpenAI-compatible batch jobs (/v1/files + /v1/batches).
+
+A batch is a JSONL file of chat completion requests, one per line:
+    {"custom_id": "...", "method": "POST", "url": "/v1/chat/completions", "body": {...}}
+
+Files and jobs live on local disk under BATCH_DIR:
+    files/<file_id>.jsonl        uploaded input, or result lines appended while a job runs
+    files/<file_id>.json         file object (filename, purpose, created_at)
+    batches/<batch_id>.json      batch object, rewritten at each checkpoint
+    batches/<batch_id>.cancel    cancel marker (any worker may set it)
+    batches/<batch_id>.lock      flock held by the worker that runs the job
+
+Requests go through the same pipeline as /v1/chat/completions (route
+compilation, generation config, dispatch_gemini_request / OpenAI Direct). Each
+request gets the next SA credential or Express key from one rotation over both
+pools. A job runs up to BATCH_MAX_CONCURRENCY requests at a time, and that limit
+is shared by all jobs in the worker. With admission control enabled, every
+request also takes a global slot at "batch" priority, so interactive traffic is
+queued ahead of it and may evict it. A request turned away by admission
+control or the adaptive limits is retried after BATCH_RETRY_DELAY seconds and
+is not counted as failed.
+
+Every finished request is appended to the output file (any HTTP status) or the
+error file (exception). On restart a job skips the custom_ids already present
+in those files, so a job is resumed and not repeated.
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows：单进程运行，不需要跨进程锁
+    fcntl = None
+
+import config as app_config
+import admission
+import adaptive_concurrency
+import lifecycle
+import shared_state
+from api_helpers import create_generation_config, create_express_client, dispatch_gemini_request, get_sa_client
+from metrics import REGISTRY
+from model_routing import compile_model_route
+from models import OpenAIRequest
+from openai_handler import OpenAIDirectHandler
+
+SUPPORTED_ENDPOINTS = ("/v1/chat/completions",)
+COMPLETION_WINDOWS = {"24h": 24 * 3600}
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+BATCH_REQUESTS_TOTAL = REGISTRY.counter(
+    "vertex2openai_batch_requests_total", "Batch requests executed, by outcome.", ("outcome",))
+
+
+class BatchError(Exception):
+    """Client error for the files/batches API (mapped to an OpenAI error response)."""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+class _RetryLater(Exception):
+    """The request was turned away by local admission / adaptive limits; try again later."""
+
+
+def _write_json_atomic(path: str, value: Dict[str, Any]) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(value, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class FileStore:
+    def __init__(self, root: str):
+        self.root = root
+
+    def _ensure_dir(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+
+    def data_path(self, file_id: str) -> str:
+        return os.path.join(self.root, f"{file_id}.jsonl")
+
+    def _meta_path(self, file_id: str) -> str:
+        return os.path.join(self.root, f"{file_id}.json")
+
+    def create(self, filename: str, purpose: str, data: bytes = b"") -> Dict[str, Any]:
+        self._ensure_dir()
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        with open(self.data_path(file_id), "wb") as f:
+            f.write(data)
+        meta = {"id": file_id, "object": "file", "filename": filename, "purpose": purpose,
+                "created_at": int(time.time())}
+        _write_json_atomic(self._meta_path(file_id), meta)
+        return self.get(file_id)
+
+    def upload_path(self) -> str:
+        """Temporary path in the store directory for an upload being received; see create_from_path()."""
+        self._ensure_dir()
+        return os.path.join(self.root, f".upload-{uuid.uuid4().hex}.part")
+
+    def create_from_path(self, filename: str, purpose: str, path: str) -> Dict[str, Any]:
+        """Like create(), but takes ownership of a file already written under upload_path()."""
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        os.replace(path, self.data_path(file_id))
+        meta = {"id": file_id, "object": "file", "filename": filename, "purpose": purpose,
+                "created_at": int(time.time())}
+        _write_json_atomic(self._meta_path(file_id), meta)
+        return self.get(file_id)
+
+    def get(self, file_id: str) -> Optional[Dict[str, Any]]:
+        if not file_id.startswith("file-") or os.sep in file_id:
+            return None
+        meta = _read_json(self._meta_path(file_id))
+        if meta is None:
+            return None
+        try:
+            meta["bytes"] = os.path.getsize(self.data_path(file_id))
+        except OSError:
+            meta["bytes"] = 0
+        return meta
+
+    def list(self, purpose: Optional[str] = None) -> List[Dict[str, Any]]:
+        if not os.path.isdir(self.root):
+            return []
+        files = [self.get(name[:-len(".json")]) for name in os.listdir(self.root) if name.endswith(".json")]
+        files = [f for f in files if f is not None and (purpose is None or f["purpose"] == purpose)]
+        return sorted(files, key=lambda f: f["created_at"], reverse=True)
+
+    def delete(self, file_id: str) -> bool:
+        if self.get(file_id) is None:
+            return False
+        for path in (self.data_path(file_id), self._meta_path(file_id)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return True
+
+
+class BatchStore:
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, batch_id: str, suffix: str) -> str:
+        return os.path.join(self.root, f"{batch_id}{suffix}")
+
+    def save(self, batch: Dict[str, Any]) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        _write_json_atomic(self._path(batch["id"], ".json"), batch)
+
+    def get(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        if not batch_id.startswith("batch_") or os.sep in batch_id:
+            return None
+        batch = _read_json(self._path(batch_id, ".json"))
+        if batch is not None and batch["status"] not in TERMINAL_STATUSES and self.cancel_requested(batch_id):
+            batch["status"] = "cancelling"
+        return batch
+
+    def list(self) -> List[Dict[str, Any]]:
+        if not os.path.isdir(self.root):
+            return []
+        batches = [self.get(name[:-len(".json")]) for name in os.listdir(self.root) if name.endswith(".json")]
+        return sorted((b for b in batches if b is not None), key=lambda b: b["created_at"], reverse=True)
+
+    def request_cancel(self, batch_id: str) -> None:
+        with open(self._path(batch_id, ".cancel"), "w") as f:
+            f.write(str(int(time.time())))
+
+    def cancel_requested(self, batch_id: str) -> bool:
+        return os.path.exists(self._path(batch_id, ".cancel"))
+
+    def try_lock(self, batch_id: str) -> Optional[Any]:
+        """Claim a job for this worker; returns the open lock file, or None if another worker holds it."""
+        os.makedirs(self.root, exist_ok=True)
+        lock_file = open(self._path(batch_id, ".lock"), "w")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return None
+        return lock_file
+
+
+def _validate_input(path: str, endpoint: str) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Parse the input JSONL; returns (items, errors) where errors follow OpenAI's batch error shape."""
+    items: List[Dict[str, Any]] = []
+    errors: List[Dict[str, Any]] = []
+    seen: Set[str] = set()
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                errors.append({"code": "invalid_json_line", "message": "Line is not valid JSON.", "line": line_no})
+                continue
+            if not isinstance(entry, dict) or not isinstance(entry.get("custom_id"), str):
+                errors.append({"code": "missing_required_parameter", "message": "custom_id is required.", "line": line_no})
+                continue
+            if entry["custom_id"] in seen:
+                errors.append({"code": "duplicate_custom_id", "message": f"Duplicate custom_id '{entry['custom_id']}'.",
+                               "line": line_no})
+                continue
+            if entry.get("method", "POST") != "POST" or entry.get("url", endpoint) != endpoint:
+                errors.append({"code": "invalid_url", "message": f"Only POST {endpoint} requests are supported.",
+                               "line": line_no})
+                continue
+            body = entry.get("body")
+            if not isinstance(body, dict) or "model" not in body or "messages" not in body:
+                errors.append({"code": "invalid_request", "message": "body must contain model and messages.",
+                               "line": line_no})
+                continue
+            seen.add(entry["custom_id"])
+            items.append({"custom_id": entry["custom_id"], "body": body})
+            if len(items) > app_config.BATCH_MAX_REQUESTS:
+                errors.append({"code": "too_many_requests",
+                               "message": f"A batch may contain at most {app_config.BATCH_MAX_REQUESTS} requests.",
+                               "line": line_no})
+                break
+    if not items and not errors:
+        errors.append({"code": "empty_file", "message": "The input file contains no requests.", "line": None})
+    return items, errors
+
+
+def _finished_ids(*paths: str) -> Tuple[Set[str], int, int]:
+    """custom_ids already written to the result files, plus (completed, failed) counts. Repairs torn last lines."""
+    done: Set[str] = set()
+    completed = failed = 0
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                # 进程在写一行的中途退出：截掉不完整的最后一行
+                f.truncate(data.rfind(b"\n") + 1)
+                data = data[:data.rfind(b"\n") + 1]
+        for line in data.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            done.add(record["custom_id"])
+            response = record.get("response")
+            if response is not None and response.get("status_code") == 200:
+                completed += 1
+            else:
+                failed += 1
+    return done, completed, failed
+
+
+def _append_line(path: str, record: Dict[str, Any]) -> None:
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+class BatchRunner:
+    def __init__(self):
+        self.files = FileStore(os.path.join(app_config.BATCH_DIR, "files"))
+        self.batches = BatchStore(os.path.join(app_config.BATCH_DIR, "batches"))
+        self._app = None
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._scanner: Optional[asyncio.Task] = None
+
+    # ---- API operations -------------------------------------------------
+
+    async def create(self, input_file_id: str, endpoint: str, completion_window: str,
+                     metadata: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        if endpoint not in SUPPORTED_ENDPOINTS:
+            raise BatchError(400, f"Unsupported endpoint '{endpoint}'. Supported: {', '.join(SUPPORTED_ENDPOINTS)}")
+        if completion_window not in COMPLETION_WINDOWS:
+            raise BatchError(400, f"Unsupported completion_window '{completion_window}'. Supported: 24h")
+        input_file = await asyncio.to_thread(self.files.get, input_file_id)
+        if input_file is None:
+            raise BatchError(404, f"No such file: {input_file_id}")
+        if input_file["purpose"] != "batch":
+            raise BatchError(400, f"File {input_file_id} has purpose '{input_file['purpose']}', expected 'batch'")
+
+        output_file = await asyncio.to_thread(self.files.create, f"{input_file_id}_output.jsonl", "batch_output")
+        error_file = await asyncio.to_thread(self.files.create, f"{input_file_id}_error.jsonl", "batch_output")
+        now = int(time.time())
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": endpoint,
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "output_file_id": output_file["id"],
+            "error_file_id": error_file["id"],
+            "created_at": now,
+            "in_progress_at": None,
+            "expires_at": now + COMPLETION_WINDOWS[completion_window],
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "expired_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": metadata,
+        }
+        await asyncio.to_thread(self.batches.save, batch)
+        self._launch(batch["id"])
+        return batch
+
+    async def get(self, batch_id: str) -> Dict[str, Any]:
+        batch = await asyncio.to_thread(self.batches.get, batch_id)
+        if batch is None:
+            raise BatchError(404, f"No such batch: {batch_id}")
+        return batch
+
+    async def cancel(self, batch_id: str) -> Dict[str, Any]:
+        batch = await self.get(batch_id)
+        if batch["status"] in TERMINAL_STATUSES:
+            raise BatchError(400, f"Batch {batch_id} is already {batch['status']} and cannot be cancelled")
+        await asyncio.to_thread(self.batches.request_cancel, batch_id)
+        batch["status"] = "cancelling"
+        batch["cancelling_at"] = batch["cancelling_at"] or int(time.time())
+        # 运行该任务的 worker 会在下一个请求前看到取消标记；如果没有 worker 在运行，这里直接结束
+        self._launch(batch_id)
+        return batch
+
+    # ---- lifecycle ------------------------------------------------------
+
+    def start(self, app) -> None:
+        self._app = app
+        self._semaphore = asyncio.Semaphore(max(1, app_config.BATCH_MAX_CONCURRENCY))
+        self._scanner = asyncio.get_running_loop().create_task(self._scan_loop())
+
+    async def stop(self) -> None:
+        tasks = [t for t in [self._scanner, *self._tasks.values()] if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._scanner = None
+
+    async def _scan_loop(self) -> None:
+        # 认领未结束的任务：本进程重启后恢复，或接手已退出的 worker 留下的任务
+        while True:
+            try:
+                for batch in await asyncio.to_thread(self.batches.list):
+                    if batch["status"] not in TERMINAL_STATUSES:
+                        self._launch(batch["id"])
+            except Exception as e:
+                print(f"WARNING: Batch scan failed: {e}")
+            await asyncio.sleep(app_config.BATCH_SCAN_INTERVAL)
+
+    def _launch(self, batch_id: str) -> None:
+        if self._app is None or batch_id in self._tasks:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(batch_id))
+        self._tasks[batch_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(batch_id, None))
+
+    async def _run(self, batch_id: str) -> None:
+        lock = await asyncio.to_thread(self.batches.try_lock, batch_id)
+        if lock is None:
+            return
+        try:
+            await self._execute(batch_id)
+        except asyncio.CancelledError:
+            print(f"INFO: Batch {batch_id} paused at shutdown; it resumes on the next start")
+            raise
+        except Exception as e:
+            print(f"ERROR: Batch {batch_id} failed: {e}")
+        finally:
+            lock.close()
+
+    # ---- execution ------------------------------------------------------
+
+    async def _save(self, batch: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self.batches.save, batch)
+
+    async def _execute(self, batch_id: str) -> None:
+        batch = await asyncio.to_thread(self.batches.get, batch_id)
+        if batch is None or batch["status"] in TERMINAL_STATUSES:
+            return
+        input_path = self.files.data_path(batch["input_file_id"])
+        output_path = self.files.data_path(batch["output_file_id"])
+        error_path = self.files.data_path(batch["error_file_id"])
+
+        if batch["status"] == "cancelling" and batch["in_progress_at"] is None:
+            batch.update(status="cancelled", cancelled_at=int(time.time()))
+            await self._save(batch)
+            return
+
+        try:
+            items, errors = await asyncio.to_thread(_validate_input, input_path, batch["endpoint"])
+        except OSError as e:
+            items, errors = [], [{"code": "file_not_found", "message": str(e), "line": None}]
+        if errors:
+            batch.update(status="failed", failed_at=int(time.time()), errors={"object": "list", "data": errors[:100]})
+            await self._save(batch)
+            print(f"WARNING: Batch {batch_id} failed validation with {len(errors)} error(s)")
+            return
+
+        done, completed, failed = await asyncio.to_thread(_finished_ids, output_path, error_path)
+        pending = [item for item in items if item["custom_id"] not in done]
+        batch["request_counts"] = {"total": len(items), "completed": completed, "failed": failed}
+        if batch["status"] == "validating":
+            batch.update(status="in_progress", in_progress_at=int(time.time()))
+        await self._save(batch)
+        print(f"INFO: Batch {batch_id} running: {len(pending)} of {len(items)} request(s) pending")
+
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in pending:
+            queue.put_nowait(item)
+        write_lock = asyncio.Lock()
+        last_checkpoint = time.monotonic()
+
+        def should_stop() -> bool:
+            if batch["status"] != "cancelling" and self.batches.cancel_requested(batch_id):
+                batch.update(status="cancelling", cancelling_at=batch["cancelling_at"] or int(time.time()))
+            return batch["status"] == "cancelling" or time.time() >= batch["expires_at"]
+
+        async def worker() -> None:
+            nonlocal last_checkpoint
+            while not should_stop():
+                try:
+                    item = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                async with self._semaphore:
+                    record = await self._execute_item(item, should_stop)
+                if record is None:
+                    queue.put_nowait(item)
+                    return
+                ok = record["response"] is not None and record["response"]["status_code"] == 200
+                async with write_lock:
+                    await asyncio.to_thread(_append_line, output_path if record["response"] else error_path, record)
+                    batch["request_counts"]["completed" if ok else "failed"] += 1
+                    if time.monotonic() - last_checkpoint >= app_config.BATCH_CHECKPOINT_INTERVAL:
+                        last_checkpoint = time.monotonic()
+                        await self._save(batch)
+                BATCH_REQUESTS_TOTAL.inc("completed" if ok else "failed")
+
+        await asyncio.gather(*(worker() for _ in range(max(1, app_config.BATCH_MAX_CONCURRENCY))))
+
+        now = int(time.time())
+        if batch["status"] == "cancelling":
+            batch.update(status="cancelled", cancelled_at=now)
+        elif not queue.empty():
+            # 超出 completion_window：剩余请求写入错误文件
+            remaining = []
+            while not queue.empty():
+                remaining.append(queue.get_nowait())
+            for item in remaining:
+                await asyncio.to_thread(_append_line, error_path, self._error_record(
+                    item, "batch_expired", "This request could not be executed before the completion window expired."))
+            batch["request_counts"]["failed"] += len(remaining)
+            batch.update(status="expired", expired_at=now)
+        else:
+            batch.update(status="finalizing", finalizing_at=now)
+            await self._save(batch)
+            batch.update(status="completed", completed_at=int(time.time()))
+        await self._save(batch)
+        counts = batch["request_counts"]
+        print(f"INFO: Batch {batch_id} {batch['status']}: {counts['completed']} completed, {counts['failed']} failed")
+
+    @staticmethod
+    def _error_record(item: Dict[str, Any], code: str, message: str) -> Dict[str, Any]:
+        return {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": item["custom_id"], "response": None,
+                "error": {"code": code, "message": message}}
+
+    async def _execute_item(self, item: Dict[str, Any], should_stop: Callable[[], bool]) -> Optional[Dict[str, Any]]:
+        """Run one request; returns its result record, or None if the job stopped while it was waiting."""
+        while not should_stop():
+            # 每个请求一个 request scope：准入槽位与自适应并发槽位在请求结束时释放
+            with lifecycle.request_scope():
+                try:
+                    status_code, body = await self._dispatch(item["body"])
+                except _RetryLater:
+                    pass
+                except Exception as e:
+                    print(f"WARNING: Batch request '{item['custom_id']}' failed: {e}")
+                    return self._error_record(item, "request_failed", str(e))
+                else:
+                    return {
+                        "id": f"batch_req_{uuid.uuid4().hex}",
+                        "custom_id": item["custom_id"],
+                        "response": {"status_code": status_code, "request_id": f"req_{uuid.uuid4().hex}", "body": body},
+                        "error": None,
+                    }
+            await asyncio.sleep(app_config.BATCH_RETRY_DELAY)
+        return None
+
+    async def _dispatch(self, body: Dict[str, Any]) -> Tuple[int, Any]:
+        request = OpenAIRequest(**body)
+        request.stream = False
+        route = compile_model_route(request.model)
+        if not await admission.admit_background():
+            raise _RetryLater()
+        if await admission.admit_model(route.base_model) is not None:
+            raise _RetryLater()
+        gen_config_dict = create_generation_config(request)
+
+        if route.is_openai_direct:
+            if route.express:
+                handler = OpenAIDirectHandler(express_key_manager=self._app.state.express_key_manager)
+            else:
+                handler = OpenAIDirectHandler(credential_manager=self._app.state.credential_manager)
+            response = await handler.process_request(request, route.base_model, is_express=route.express,
+                                                     is_openai_search=route.openai_search)
+        else:
+            client = await self._select_client(route)
+            response = await dispatch_gemini_request(client, route, request, gen_config_dict)
+        return response.status_code, json.loads(response.body)
+
+    async def _select_client(self, route) -> Any:
+        """Next credential from one rotation over SA credentials and Express keys ([EXPRESS] models: keys only)."""
+        credential_manager = self._app.state.credential_manager
+        express_key_manager = self._app.state.express_key_manager
+        sa_total = 0 if route.express else credential_manager.get_total_credentials()
+        express_total = express_key_manager.get_total_keys()
+        total = sa_total + express_total
+        if total == 0:
+            raise RuntimeError(f"No credentials available for model '{route.model}'")
+        saturated = False
+        for attempt in range(total):
+            slot = shared_state.backend.next_index("batch:credential", total)
+            last = attempt == total - 1
+            if slot < sa_total:
+                credentials, project_id = credential_manager.get_credentials()
+                if not credentials or not project_id:
+                    continue
+                if not await adaptive_concurrency.acquire(route.base_model, f"sa:{project_id}", wait=last):
+                    saturated = True
+                    continue
+                try:
+                    return get_sa_client(credentials, project_id)
+                except Exception:
+                    adaptive_concurrency.release_current()
+                    raise
+            key_tuple = express_key_manager.get_express_api_key()
+            if not key_tuple:
+                continue
+            key_idx, key_val = key_tuple
+            if not await adaptive_concurrency.acquire(route.base_model, f"express:{key_idx}", wait=last):
+                saturated = True
+                continue
+            try:
+                return await create_express_client(key_val, route.base_model)
+            except Exception:
+                adaptive_concurrency.release_current()
+                raise
+        if saturated:
+            raise _RetryLater()
+        raise RuntimeError(f"No usable credentials for model '{route.model}'")
+
+
+runner = BatchRunner()
@@ -0,0 +1,447 @@
+"""
+HTTP compression in both directions.
+
+Responses: the encoding is negotiated from Accept-Encoding (q-values honoured),
+picking the first acceptable one in COMPRESSION_ENCODINGS (default
+zstd, br, gzip). Only textual types are compressed (JSON, SSE, text/*);
+images and files served with their own encoding are passed through.
+
+- Complete bodies under COMPRESSION_MIN_BYTES are sent as is. Large bodies are
+  compressed in a worker thread so a multi-megabyte response does not stall
+  the event loop.
+- Streaming bodies (SSE) are compressed as a stream and every ASGI message is
+  flushed (Z_SYNC_FLUSH / brotli flush / zstd block flush), so each event
+  reaches the client as soon as it is produced. COMPRESSION_SSE=false leaves
+  event streams uncompressed.
+- Every response whose encoding is negotiable carries Vary: Accept-Encoding,
+  also when it is sent uncompressed (under the threshold, or to a client that
+  accepts no supported encoding). A strong ETag on a compressed response gets
+  the encoding as suffix ("abc" -> "abc-br"); matching_etag() ignores the
+  suffix when evaluating If-None-Match.
+
+Requests: a body sent with Content-Encoding gzip, deflate, br or zstd is
+decompressed before it reaches the app, and the Content-Encoding and
+Content-Length headers are removed. Decompression is incremental as the body
+arrives, with a cap of COMPRESSION_MAX_REQUEST_MB on the decompressed size
+(413 beyond it), so a small compressed body cannot expand without bound.
+Unknown encodings get 415, corrupt bodies 400.
+
+gzip/deflate use zlib; br needs the ``brotli`` package and zstd the
+``zstandard`` package. Encodings whose package is missing are not offered
+for responses and are rejected in requests.
+"""
+import asyncio
+import zlib
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:  # 可选依赖
+    brotli = None
+try:
+    import zstandard
+except ImportError:  # 可选依赖
+    zstandard = None
+
+from fastapi.responses import JSONResponse
+
+import config as app_config
+from metrics import REGISTRY
+
+COMPRESSION_BYTES_TOTAL = REGISTRY.counter(
+    "vertex2openai_compression_bytes_total",
+    "Bytes passed through HTTP compression, by direction, encoding and stage (identity / encoded).",
+    ("direction", "encoding", "stage"))
+
+_COMPRESSIBLE_TYPES = ("text/", "application/json", "application/x-ndjson", "application/jsonl",
+                       "application/javascript", "application/xml", "image/svg+xml")
+_EVENT_STREAM = "text/event-stream"
+# 超过该大小的完整响应体在线程池中压缩
+_OFFLOAD_BYTES = 256 * 1024
+# 解压时单步输出上限：压缩炸弹在分配大块内存之前就会被大小上限拦下
+_DECODE_MAX_OUTPUT = 64 * 1024
+
+_ETAG_SUFFIXES = ("-gzip", "-br", "-zstd")
+
+
+def encoded_etag(etag: bytes, encoding: str) -> bytes:
+    """Strong ETag of the encoded representation: "abc" -> "abc-br". Weak ETags are shared across encodings."""
+    if len(etag) >= 2 and etag.startswith(b'"') and etag.endswith(b'"'):
+        return etag[:-1] + b"-" + encoding.encode() + b'"'
+    return etag
+
+
+def matching_etag(if_none_match: str, etag: str) -> Optional[str]:
+    """
+    The If-None-Match entry that matches ``etag`` (weak comparison, ignoring the
+    encoding suffix added by encoded_etag()), or None. A 304 should echo it so the
+    client keeps the validator of the representation it has cached.
+    """
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return etag
+        opaque = tag.removeprefix("W/")
+        for suffix in _ETAG_SUFFIXES:
+            if opaque.endswith(suffix + '"'):
+                opaque = opaque[:-len(suffix) - 1] + '"'
+                break
+        if opaque == etag:
+            return tag
+    return None
+
+
+def available_encodings() -> List[str]:
+    available = {"gzip"}
+    if brotli is not None:
+        available.add("br")
+    if zstandard is not None:
+        available.add("zstd")
+    return [encoding for encoding in app_config.COMPRESSION_ENCODINGS if encoding in available]
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """First encoding from COMPRESSION_ENCODINGS the client accepts (q > 0), or None."""
+    accepted: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    for encoding in available_encodings():
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > 0:
+            return encoding
+    return None
+
+
+# --- response encoders ---
+
+class _Encoder:
+    """Streaming encoder: compress() returns everything produced so far, flushed to a byte boundary."""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self._obj = zlib.compressobj(app_config.COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+        elif encoding == "br":
+            self._obj = brotli.Compressor(quality=app_config.COMPRESSION_BROTLI_QUALITY)
+        else:
+            self._obj = zstandard.ZstdCompressor(level=app_config.COMPRESSION_ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes, flush: bool) -> bytes:
+        if self.encoding == "gzip":
+            out = self._obj.compress(data)
+            return out + self._obj.flush(zlib.Z_SYNC_FLUSH) if flush else out
+        if self.encoding == "br":
+            out = self._obj.process(data)
+            return out + self._obj.flush() if flush else out
+        out = self._obj.compress(data)
+        return out + self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK) if flush else out
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._obj.finish()
+        return self._obj.flush()
+
+
+def compress_body(data: bytes, encoding: str) -> bytes:
+    encoder = _Encoder(encoding)
+    return encoder.compress(data, flush=False) + encoder.finish()
+
+
+# --- request decoders ---
+
+class RequestBodyError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class _ZstdSink:
+    """Output side of the zstd stream writer: receives at most _DECODE_MAX_OUTPUT bytes per write."""
+
+    def __init__(self, decoder: "_Decoder"):
+        self._decoder = decoder
+        self.pieces: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._decoder.count(len(data))
+        self.pieces.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+
+class _Decoder:
+    """Incremental request body decoder that raises 413 once the output passes ``limit`` bytes."""
+
+    def __init__(self, encoding: str, limit: int):
+        self.encoding = encoding
+        self.limit = limit
+        self.total = 0
+        self._zlib = encoding in ("gzip", "x-gzip", "deflate")
+        if self._zlib:
+            # wbits=47：自动识别 gzip 与 zlib 头
+            self._obj = zlib.decompressobj(47)
+        elif encoding == "br" and brotli is not None:
+            self._obj = brotli.Decompressor()
+        elif encoding == "zstd" and zstandard is not None:
+            self._sink = _ZstdSink(self)
+            self._obj = zstandard.ZstdDecompressor().stream_writer(self._sink, write_size=_DECODE_MAX_OUTPUT)
+        else:
+            raise RequestBodyError(415, f"Unsupported Content-Encoding '{encoding}'")
+
+    def count(self, size: int) -> None:
+        self.total += size
+        if self.total > self.limit:
+            raise RequestBodyError(
+                413, f"Decompressed request body exceeds {app_config.COMPRESSION_MAX_REQUEST_MB} MB")
+
+    def feed(self, data: bytes) -> Iterator[bytes]:
+        """Yield decompressed pieces of at most _DECODE_MAX_OUTPUT bytes each, checked against the limit."""
+        if self._zlib:
+            pending = data
+            while pending:
+                piece = self._obj.decompress(pending, _DECODE_MAX_OUTPUT)
+                self.count(len(piece))
+                yield piece
+                pending = self._obj.unconsumed_tail
+        elif self.encoding == "br":
+            piece = self._obj.process(data, output_buffer_limit=_DECODE_MAX_OUTPUT)
+            # 输出达到上限时解压器会保留剩余输入与输出，需以空输入继续取出，直到不再产生输出
+            while piece:
+                self.count(len(piece))
+                yield piece
+                if self._obj.is_finished():
+                    break
+                piece = self._obj.process(b"", output_buffer_limit=_DECODE_MAX_OUTPUT)
+        else:
+            # 上限由 _ZstdSink 在每次写出时检查
+            self._obj.write(data)
+            pieces, self._sink.pieces = self._sink.pieces, []
+            yield from pieces
+
+    def finish(self) -> bytes:
+        if not self._zlib:
+            return b""
+        piece = self._obj.flush()
+        self.count(len(piece))
+        return piece
+
+
+def _header(headers: List[Tuple[bytes, bytes]], name: bytes) -> Optional[bytes]:
+    for key, value in headers:
+        if key == name:
+            return value
+    return None
+
+
+class CompressionMiddleware:
+    """Pure ASGI middleware: decompresses request bodies and compresses responses."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = scope.get("headers", [])
+        content_encoding = _header(headers, b"content-encoding")
+        if content_encoding and content_encoding.strip().lower() != b"identity":
+            try:
+                body = await self._read_decompressed(receive, content_encoding.decode("latin-1").strip().lower())
+            except RequestBodyError as e:
+                await self._send_error(scope, send, e.status, str(e))
+                return
+            scope = dict(scope)
+            scope["headers"] = [(k, v) for k, v in headers if k not in (b"content-encoding", b"content-length")] \
+                + [(b"content-length", str(len(body)).encode())]
+            receive = self._replay(body, receive)
+
+        encoding = negotiate((_header(headers, b"accept-encoding") or b"").decode("latin-1"))
+        if scope.get("method") == "HEAD":
+            encoding = None
+        # 未压缩的响应也经过 _ResponseCompressor，以便加上 Vary: Accept-Encoding
+        await self.app(scope, receive, _ResponseCompressor(send, encoding).send)
+
+    @staticmethod
+    async def _send_error(scope, send, status: int, message: str) -> None:
+        if scope.get("path", "").startswith("/gemini/"):
+            content = {"error": {"code": status, "message": message, "status": "INVALID_ARGUMENT"}}
+        else:
+            content = {"error": {"message": message, "type": "invalid_request_error", "code": status, "param": None}}
+        body = JSONResponse(status_code=status, content=content).body
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    @staticmethod
+    async def _read_decompressed(receive, encoding: str) -> bytes:
+        decoder = _Decoder(encoding, int(app_config.COMPRESSION_MAX_REQUEST_MB * 1024 * 1024))
+        chunks: List[bytes] = []
+        received = 0
+        more_body = True
+        try:
+            while more_body:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    raise RequestBodyError(400, "Client disconnected while sending the request body")
+                data = message.get("body", b"")
+                more_body = message.get("more_body", False)
+                received += len(data)
+                if data:
+                    chunks.extend(decoder.feed(data))
+                if not more_body:
+                    chunks.append(decoder.finish())
+        except RequestBodyError:
+            raise
+        except Exception as e:
+            raise RequestBodyError(400, f"Could not decode {encoding} request body: {e}")
+        COMPRESSION_BYTES_TOTAL.inc("request", encoding, "encoded", amount=received)
+        COMPRESSION_BYTES_TOTAL.inc("request", encoding, "identity", amount=decoder.total)
+        return b"".join(chunks)
+
+    @staticmethod
+    def _replay(body: bytes, receive) -> Callable:
+        sent = False
+
+        async def replay_receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # 请求体已读完：之后只会收到断开等消息
+            return await receive()
+
+        return replay_receive
+
+
+class _ResponseCompressor:
+    def __init__(self, send, encoding: Optional[str]):
+        self._send = send
+        self.encoding = encoding
+        self._start: Optional[dict] = None
+        self._encoder: Optional[_Encoder] = None
+        self._passthrough = False
+        self._identity_bytes = 0
+        self._encoded_bytes = 0
+
+    @staticmethod
+    def _negotiable(start: dict) -> bool:
+        """Whether the representation depends on Accept-Encoding (whatever this client sent)."""
+        if start["status"] == 304:
+            return True
+        if start["status"] < 200 or start["status"] in (204, 206):
+            return False
+        headers = start.get("headers", [])
+        if _header(headers, b"content-encoding") is not None:
+            return False
+        content_type = (_header(headers, b"content-type") or b"").decode("latin-1").lower()
+        if content_type.startswith(_EVENT_STREAM):
+            return app_config.COMPRESSION_SSE
+        return content_type.startswith(_COMPRESSIBLE_TYPES)
+
+    @staticmethod
+    def _with_vary(start: dict) -> dict:
+        # 无论本次是否压缩、是否低于阈值，可协商的响应都带 Vary，避免共享缓存把一种编码发给所有客户端
+        headers = list(start.get("headers", []))
+        for index, (key, value) in enumerate(headers):
+            if key == b"vary":
+                if b"accept-encoding" not in value.lower() and value.strip() != b"*":
+                    headers[index] = (key, value + b", Accept-Encoding")
+                return {**start, "headers": headers}
+        headers.append((b"vary", b"Accept-Encoding"))
+        return {**start, "headers": headers}
+
+    def _encoded_start(self, start: dict, content_length: Optional[int]) -> dict:
+        headers = []
+        for key, value in start.get("headers", []):
+            if key == b"content-length":
+                continue
+            if key == b"etag":
+                # 编码后的表示与原始字节不同，强 ETag 需要区分编码
+                value = encoded_etag(value, self.encoding)
+            headers.append((key, value))
+        headers.append((b"content-encoding", self.encoding.encode()))
+        if content_length is not None:
+            headers.append((b"content-length", str(content_length).encode()))
+        return self._with_vary({**start, "headers": headers})
+
+    def _record(self) -> None:
+        COMPRESSION_BYTES_TOTAL.inc("response", self.encoding, "identity", amount=self._identity_bytes)
+        COMPRESSION_BYTES_TOTAL.inc("response", self.encoding, "encoded", amount=self._encoded_bytes)
+
+    async def send(self, message: dict) -> None:
+        if message["type"] == "http.response.start":
+            negotiable = self._negotiable(message)
+            if negotiable:
+                message = self._with_vary(message)
+            self._start = message
+            self._passthrough = self.encoding is None or not negotiable or message["status"] == 304
+            if self._passthrough:
+                await self._send(message)
+            return
+        if message["type"] != "http.response.body" or self._passthrough:
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self._encoder is None and self._start is not None:
+            start, self._start = self._start, None
+            if not more_body:
+                # 完整响应体：小于阈值时原样发送
+                if len(body) < app_config.COMPRESSION_MIN_BYTES:
+                    await self._send(start)
+                    await self._send(message)
+                    return
+                if len(body) > _OFFLOAD_BYTES:
+                    encoded = await asyncio.to_thread(compress_body, body, self.encoding)
+                else:
+                    encoded = compress_body(body, self.encoding)
+                if len(encoded) >= len(body):
+                    await self._send(start)
+                    await self._send(message)
+                    return
+                self._identity_bytes, self._encoded_bytes = len(body), len(encoded)
+                self._record()
+                await self._send(self._encoded_start(start, len(encoded)))
+                await self._send({"type": "http.response.body", "body": encoded, "more_body": False})
+                return
+            content_length = _header(start.get("headers", []), b"content-length")
+            if content_length is not None and content_length.isdigit() \
+                    and int(content_length) < app_config.COMPRESSION_MIN_BYTES:
+                self._passthrough = True
+                await self._send(start)
+                await self._send(message)
+                return
+            # 流式响应：逐条压缩并立即 flush，SSE 事件不会被缓冲
+            self._encoder = _Encoder(self.encoding)
+            await self._send(self._encoded_start(start, None))
+
+        self._identity_bytes += len(body)
+        if more_body:
+            encoded = self._encoder.compress(body, flush=True) if body else b""
+        else:
+            encoded = self._encoder.compress(body, flush=False) + self._encoder.finish()
+            self._record()
+        self._encoded_bytes += len(encoded)
+        if encoded or not more_body:
+            await self._send({"type": "http.response.body", "body": encoded, "more_body": more_body})
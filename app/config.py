@@ -23,9 +23,150 @@ else:
 # Fake streaming settings for debugging/testing
 FAKE_STREAMING_ENABLED = os.environ.get("FAKE_STREAMING", "false").lower() == "true"
 FAKE_STREAMING_INTERVAL_SECONDS = float(os.environ.get("FAKE_STREAMING_INTERVAL", "1.0"))
+# Fake-stream pacing: the final content is split into FAKE_STREAMING_CHUNKS deltas with
+# FAKE_STREAMING_CHUNK_DELAY seconds between them (defaults send it at once)
+FAKE_STREAMING_CHUNKS = int(os.environ.get("FAKE_STREAMING_CHUNKS", "1"))
+FAKE_STREAMING_CHUNK_DELAY_SECONDS = float(os.environ.get("FAKE_STREAMING_CHUNK_DELAY", "0"))
 
 # URL for the remote JSON file containing model lists
 MODELS_CONFIG_URL = os.environ.get("MODELS_CONFIG_URL", "https://raw.githubusercontent.com/gzzhongqi/vertex2openai/refs/heads/main/vertexModels.json")
+# Multi-process launcher (launcher.py)
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = int(os.environ.get("PORT", "8050"))
+WORKERS = int(os.environ.get("WORKERS", "1"))
+WORKER_MODE = os.environ.get("WORKER_MODE", "prefork").lower()  # prefork | reuseport
+WORKER_MAX_REQUESTS = int(os.environ.get("WORKER_MAX_REQUESTS", "0"))  # 0 = never recycle by request count
+WORKER_MAX_REQUESTS_JITTER = int(os.environ.get("WORKER_MAX_REQUESTS_JITTER", "0"))
+WORKER_MAX_RSS_MB = int(os.environ.get("WORKER_MAX_RSS_MB", "0"))  # 0 = never recycle by memory
+WORKER_RSS_CHECK_INTERVAL = float(os.environ.get("WORKER_RSS_CHECK_INTERVAL", "10"))
+WORKER_GRACEFUL_TIMEOUT = int(os.environ.get("WORKER_GRACEFUL_TIMEOUT", "30"))
+# Per-worker warmup hooks run at startup before the worker accepts traffic (app/warmup.py)
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "true").lower() == "true"
+WARMUP_TIMEOUT = float(os.environ.get("WARMUP_TIMEOUT", "15"))
+
+# Graceful shutdown: seconds to keep serving after /ready turns 503, and max seconds to wait for in-flight requests
+DRAIN_READINESS_DELAY = float(os.environ.get("DRAIN_READINESS_DELAY", "0"))
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", "30"))
+
+# Admission control / load shedding for generation requests (app/admission.py)
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "false").lower() == "true"
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", "256"))  # 0 = no global limit
+ADMISSION_MAX_IN_FLIGHT_PER_MODEL = int(os.environ.get("ADMISSION_MAX_IN_FLIGHT_PER_MODEL", "0"))  # 0 = no per-model limit
+# Per-model overrides, e.g. "gemini-2.5-pro=8,gemini-2.5-flash=32"
+ADMISSION_MODEL_LIMITS = {
+    name.strip(): int(limit)
+    for name, _, limit in (item.partition("=") for item in os.environ.get("ADMISSION_MODEL_LIMITS", "").split(","))
+    if name.strip() and limit.strip()
+}
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "5"))
+ADMISSION_BATCH_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_BATCH_QUEUE_TIMEOUT", "60"))
+ADMISSION_MAX_LOOP_LAG_MS = float(os.environ.get("ADMISSION_MAX_LOOP_LAG_MS", "500"))  # 0 = no lag-based shedding
+ADMISSION_RETRY_AFTER_MAX = int(os.environ.get("ADMISSION_RETRY_AFTER_MAX", "30"))
+# Extra client API keys with a fixed priority class (interactive | default | batch), e.g. "key1=interactive,key2=batch".
+# These keys are accepted in addition to API_KEY; other requests may pick a class with the X-Request-Priority header.
+PRIORITY_API_KEYS = {
+    key.strip(): priority.strip().lower()
+    for key, _, priority in (item.partition("=") for item in os.environ.get("PRIORITY_API_KEYS", "").split(","))
+    if key.strip() and priority.strip().lower() in ("interactive", "default", "batch")
+}
+
+# Adaptive per-(model, key) concurrency limits driven by upstream 429s (app/adaptive_concurrency.py)
+AIMD_ENABLED = os.environ.get("AIMD_ENABLED", "false").lower() == "true"
+AIMD_INITIAL_LIMIT = int(os.environ.get("AIMD_INITIAL_LIMIT", "8"))
+AIMD_MIN_LIMIT = int(os.environ.get("AIMD_MIN_LIMIT", "1"))
+AIMD_MAX_LIMIT = int(os.environ.get("AIMD_MAX_LIMIT", "64"))
+AIMD_INCREASE = float(os.environ.get("AIMD_INCREASE", "1"))
+AIMD_DECREASE_FACTOR = float(os.environ.get("AIMD_DECREASE_FACTOR", "0.5"))
+AIMD_DECREASE_COOLDOWN = float(os.environ.get("AIMD_DECREASE_COOLDOWN", "1"))
+AIMD_WAIT_TIMEOUT = float(os.environ.get("AIMD_WAIT_TIMEOUT", "5"))
+
+# Batch API (/v1/files, /v1/batches): job storage and execution limits (app/batches.py)
+BATCH_DIR = os.environ.get("BATCH_DIR", "batches")
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "4"))
+BATCH_MAX_FILE_MB = int(os.environ.get("BATCH_MAX_FILE_MB", "100"))
+BATCH_MAX_REQUESTS = int(os.environ.get("BATCH_MAX_REQUESTS", "50000"))
+BATCH_CHECKPOINT_INTERVAL = float(os.environ.get("BATCH_CHECKPOINT_INTERVAL", "5"))
+BATCH_RETRY_DELAY = float(os.environ.get("BATCH_RETRY_DELAY", "2"))
+BATCH_SCAN_INTERVAL = float(os.environ.get("BATCH_SCAN_INTERVAL", "30"))
+
+# Cross-worker shared state (round-robin positions, project IDs, model catalog): "memory" or "sqlite"
+SHARED_STATE_BACKEND = os.environ.get("SHARED_STATE_BACKEND", "memory").lower()
+SHARED_STATE_PATH = os.environ.get("SHARED_STATE_PATH", "/tmp/vertex2openai-state.db")
+# Counter values each worker reserves from the sqlite backend per statement (1 = one write per rotation)
+SHARED_STATE_COUNTER_BLOCK = int(os.environ.get("SHARED_STATE_COUNTER_BLOCK", "16"))
+# Model catalog refresh interval in seconds; stale lists are served while a background refresh runs (0 disables)
+MODELS_REFRESH_INTERVAL = float(os.environ.get("MODELS_REFRESH_INTERVAL", "3600"))
+# Cache-Control max-age (seconds) for the /v1/models and Gemini /models list responses
+MODELS_RESPONSE_MAX_AGE = int(os.environ.get("MODELS_RESPONSE_MAX_AGE", "60"))
+# Max number of parsed model strings kept in the routing cache (app/model_routing.py)
+MODEL_ROUTE_CACHE_SIZE = int(os.environ.get("MODEL_ROUTE_CACHE_SIZE", "1024"))
+# Gemini :countTokens: "upstream" proxies to Vertex, "estimate" answers locally without an upstream call
+COUNT_TOKENS_MODE = os.environ.get("COUNT_TOKENS_MODE", "upstream").lower()
+# Max number of upstream token counts cached per content hash (app/token_counting.py, 0 disables)
+COUNT_TOKENS_CACHE_SIZE = int(os.environ.get("COUNT_TOKENS_CACHE_SIZE", "4096"))
+
+# Embeddings (/v1/embeddings, Gemini :embedContent / :batchEmbedContents): concurrent inputs are merged
+# into upstream batches for up to EMBEDDING_BATCH_WINDOW_MS (app/embeddings.py)
+EMBEDDING_BATCH_WINDOW_MS = float(os.environ.get("EMBEDDING_BATCH_WINDOW_MS", "5"))
+EMBEDDING_MAX_BATCH_SIZE = int(os.environ.get("EMBEDDING_MAX_BATCH_SIZE", "250"))
+# Vertex region used for embedding calls with SA credentials
+EMBEDDING_LOCATION = os.environ.get("EMBEDDING_LOCATION", "us-central1")
+
+# Generated images: "inline" (base64 data URLs / inlineData) or "url" (stored under IMAGE_STORE_DIR and
+# linked from /v1/files/images/...); the X-Image-Response header overrides it per request (app/image_store.py)
+IMAGE_RESPONSE_MODE = os.environ.get("IMAGE_RESPONSE_MODE", "inline").lower()
+IMAGE_STORE_DIR = os.environ.get("IMAGE_STORE_DIR", "images")
+IMAGE_STORE_TTL = float(os.environ.get("IMAGE_STORE_TTL", "86400"))
+IMAGE_STORE_MEMORY_MB = int(os.environ.get("IMAGE_STORE_MEMORY_MB", "64"))
+# Base URL for image links (e.g. https://proxy.example.com); empty uses the scheme/host of the request
+IMAGE_STORE_PUBLIC_URL = os.environ.get("IMAGE_STORE_PUBLIC_URL", "")
+
+# Input image preprocessing: downscale and re-encode inline images before upload (app/image_preprocessing.py, needs Pillow)
+IMAGE_PREPROCESS_ENABLED = os.environ.get("IMAGE_PREPROCESS_ENABLED", "false").lower() == "true"
+IMAGE_PREPROCESS_MAX_SIDE = int(os.environ.get("IMAGE_PREPROCESS_MAX_SIDE", "1536"))
+# Per-model overrides, e.g. "gemini-2.5-flash-lite=768,gemini-2.5-pro=2048"
+IMAGE_PREPROCESS_MODEL_MAX_SIDE = {
+    name.strip(): int(side)
+    for name, _, side in (item.partition("=") for item in os.environ.get("IMAGE_PREPROCESS_MODEL_MAX_SIDE", "").split(","))
+    if name.strip() and side.strip()
+}
+IMAGE_PREPROCESS_FORMAT = os.environ.get("IMAGE_PREPROCESS_FORMAT", "webp").lower()  # webp | jpeg
+IMAGE_PREPROCESS_QUALITY = int(os.environ.get("IMAGE_PREPROCESS_QUALITY", "85"))
+IMAGE_PREPROCESS_MIN_KB = int(os.environ.get("IMAGE_PREPROCESS_MIN_KB", "64"))
+IMAGE_PREPROCESS_WORKERS = int(os.environ.get("IMAGE_PREPROCESS_WORKERS", "2"))
+IMAGE_PREPROCESS_CACHE_MB = int(os.environ.get("IMAGE_PREPROCESS_CACHE_MB", "64"))
+
+# Generated image format: original | webp | avif | png (lossless recompression); the X-Image-Format header
+# and -webp / -avif / -png model suffixes override it per request (app/image_transcoding.py, needs Pillow)
+IMAGE_OUTPUT_FORMAT = os.environ.get("IMAGE_OUTPUT_FORMAT", "original").lower()
+IMAGE_OUTPUT_QUALITY = int(os.environ.get("IMAGE_OUTPUT_QUALITY", "85"))
+IMAGE_TRANSCODE_WORKERS = int(os.environ.get("IMAGE_TRANSCODE_WORKERS", "2"))
+
+# Remote image_url parts (http/https) are downloaded before prompt conversion (app/image_fetch.py)
+IMAGE_FETCH_ENABLED = os.environ.get("IMAGE_FETCH_ENABLED", "true").lower() == "true"
+IMAGE_FETCH_TIMEOUT = float(os.environ.get("IMAGE_FETCH_TIMEOUT", "10"))
+IMAGE_FETCH_MAX_MB = float(os.environ.get("IMAGE_FETCH_MAX_MB", "20"))
+IMAGE_FETCH_MAX_CONNECTIONS = int(os.environ.get("IMAGE_FETCH_MAX_CONNECTIONS", "32"))
+IMAGE_FETCH_CACHE_MB = int(os.environ.get("IMAGE_FETCH_CACHE_MB", "128"))
+IMAGE_FETCH_CACHE_TTL = float(os.environ.get("IMAGE_FETCH_CACHE_TTL", "300"))
+# Allow URLs that resolve to private / loopback addresses (off by default to avoid SSRF)
+IMAGE_FETCH_ALLOW_PRIVATE = os.environ.get("IMAGE_FETCH_ALLOW_PRIVATE", "false").lower() == "true"
+
+# /v1/images/generations: model used when the request has none, and the largest n accepted (app/image_generation.py)
+IMAGES_DEFAULT_MODEL = os.environ.get("IMAGES_DEFAULT_MODEL", "gemini-2.5-flash-image")
+IMAGES_MAX_N = int(os.environ.get("IMAGES_MAX_N", "10"))
+
+# HTTP compression (app/compression.py): responses negotiated via Accept-Encoding, request bodies with
+# Content-Encoding are decompressed. br needs the brotli package, zstd the zstandard package.
+COMPRESSION_ENABLED = os.environ.get("COMPRESSION_ENABLED", "true").lower() == "true"
+COMPRESSION_ENCODINGS = [e.strip().lower() for e in os.environ.get("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",") if e.strip()]
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", "1024"))
+COMPRESSION_SSE = os.environ.get("COMPRESSION_SSE", "true").lower() == "true"
+COMPRESSION_GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get("COMPRESSION_BROTLI_QUALITY", "4"))
+COMPRESSION_ZSTD_LEVEL = int(os.environ.get("COMPRESSION_ZSTD_LEVEL", "3"))
+COMPRESSION_MAX_REQUEST_MB = float(os.environ.get("COMPRESSION_MAX_REQUEST_MB", "64"))
 
 # Constant for the Vertex reasoning tag
 VERTEX_REASONING_TAG = "vertex_think_tag"
@@ -37,6 +178,31 @@ ROUNDROBIN = os.environ.get("ROUNDROBIN", "false").lower() == "true"
 SAFETY_SCORE = os.environ.get("SAFETY_SCORE", "false").lower() == "true"
 # Validation logic moved to app/auth.py
 
+# Vertex AI API base URL (override to point at a local stand-in, e.g. benchmarks/stub_vertex.py)
+VERTEX_API_BASE = os.environ.get("VERTEX_API_BASE", "https://aiplatform.googleapis.com").rstrip("/")
+
 # Proxy settings
 PROXY_URL = os.environ.get("PROXY_URL")
-SSL_CERT_FILE = os.environ.get("SSL_CERT_FILE")
\ No newline at end of file
+SSL_CERT_FILE = os.environ.get("SSL_CERT_FILE")
+
+# Prometheus metrics (/metrics endpoint)
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+
+# Request tracing (OpenTelemetry-compatible spans + Server-Timing header)
+# TRACING_EXPORTER: none | otlp | jsonl | memory
+TRACING_EXPORTER = os.environ.get("TRACING_EXPORTER", "none").lower()
+TRACING_OTLP_ENDPOINT = os.environ.get("TRACING_OTLP_ENDPOINT", "http://localhost:4318")
+TRACING_JSONL_PATH = os.environ.get("TRACING_JSONL_PATH", "traces/spans.jsonl")
+TRACING_SAMPLE_RATE = float(os.environ.get("TRACING_SAMPLE_RATE", "1.0"))
+SERVER_TIMING_ENABLED = os.environ.get("SERVER_TIMING_ENABLED", "false").lower() == "true"
+
+# Traffic capture to rotating JSONL files (input for benchmarks/replay.py)
+CAPTURE_ENABLED = os.environ.get("CAPTURE_ENABLED", "false").lower() == "true"
+CAPTURE_DIR = os.environ.get("CAPTURE_DIR", "captures")
+CAPTURE_SAMPLE_RATE = float(os.environ.get("CAPTURE_SAMPLE_RATE", "1.0"))
+CAPTURE_REDACT_CONTENT = os.environ.get("CAPTURE_REDACT_CONTENT", "false").lower() == "true"
+CAPTURE_MAX_BODY_KB = int(os.environ.get("CAPTURE_MAX_BODY_KB", "1024"))
+CAPTURE_MAX_FILE_MB = int(os.environ.get("CAPTURE_MAX_FILE_MB", "64"))
+CAPTURE_MAX_FILES = int(os.environ.get("CAPTURE_MAX_FILES", "20"))
+CAPTURE_QUEUE_SIZE = int(os.environ.get("CAPTURE_QUEUE_SIZE", "10000"))
+CAPTURE_EXCLUDE_PATHS = [p.strip() for p in os.environ.get("CAPTURE_EXCLUDE_PATHS", "/metrics,/health,/ready").split(",") if p.strip()]
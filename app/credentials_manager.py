@@ -6,6 +6,8 @@ from typing import List, Dict, Any
 from google.auth.transport.requests import Request as AuthRequest
 from google.oauth2 import service_account
 import config as app_config # Changed from relative
+import tracing
+import shared_state
 
 # Helper function to parse multiple JSONs from a string
 def parse_multiple_json_credentials(json_str: str) -> List[Dict[str, Any]]:
@@ -81,8 +83,7 @@ class CredentialManager:
         self.project_id = None
         # New: Store credentials loaded directly from JSON objects
         self.in_memory_credentials: List[Dict[str, Any]] = []
-        # Round-robin index for tracking position
-        self.round_robin_index = 0
+        # Round-robin position is kept in shared_state (counter "sa_credential_round_robin")
         self.load_credentials_list() # Load file-based credentials initially
 
     def add_credential_from_json(self, credentials_info: Dict[str, Any]) -> bool:
@@ -283,15 +284,9 @@ class CredentialManager:
         
         print(f"DEBUG: Using round-robin credential selection strategy.")
         
-        # Ensure round_robin_index is within bounds
-        if self.round_robin_index >= len(all_sources):
-            self.round_robin_index = 0
-        
-        # Create ordered list starting from round_robin_index
-        ordered_sources = all_sources[self.round_robin_index:] + all_sources[:self.round_robin_index]
-        
-        # Move to next index for next call
-        self.round_robin_index = (self.round_robin_index + 1) % len(all_sources)
+        # Create ordered list starting from the shared round-robin position
+        start = shared_state.backend.next_index("sa_credential_round_robin", len(all_sources))
+        ordered_sources = all_sources[start:] + all_sources[:start]
         
         # Try credentials in round-robin order
         for source_info in ordered_sources:
@@ -308,7 +303,10 @@ class CredentialManager:
         Checks ROUNDROBIN config and calls the appropriate method.
         Returns (credentials, project_id) tuple or (None, None) if all fail.
         """
-        if app_config.ROUNDROBIN:
-            return self.get_roundrobin_credentials()
-        else:
-            return self.get_random_credentials()
\ No newline at end of file
+        with tracing.span("CredentialManager.get_credentials", phase="credentials") as cred_span:
+            if app_config.ROUNDROBIN:
+                credentials, project_id = self.get_roundrobin_credentials()
+            else:
+                credentials, project_id = self.get_random_credentials()
+            cred_span.set_attribute("credentials.found", credentials is not None)
+            return credentials, project_id
\ No newline at end of file
@@ -0,0 +1,142 @@
+"""
+Embeddings with cross-request micro-batching.
+
+Embedding calls are small and latency-insensitive at the millisecond scale, so
+inputs that arrive within EMBEDDING_BATCH_WINDOW_MS of each other for the same
+(model, auth path, task type, title, dimensions) are merged into one upstream
+call. A batch is sent as soon as it reaches the model's upstream limit
+(ModelCapabilities.embedding_batch_size, capped by EMBEDDING_MAX_BATCH_SIZE);
+models that only take one input per call are sent immediately.
+
+Vectors are kept as contiguous ``array('d')`` buffers rather than lists of
+Python floats; encode_embedding() turns one into a JSON list or into OpenAI's
+base64 format (little-endian float32).
+"""
+import asyncio
+import base64
+import sys
+from array import array
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from google.genai import types
+
+import config as app_config
+import lifecycle
+import tracing
+from api_helpers import retry_with_backoff, select_client
+from model_routing import ModelRoute, compile_model_route
+from metrics import REGISTRY
+from token_counting import estimate_text_tokens
+
+EMBEDDING_BATCH_SIZE = REGISTRY.histogram(
+    "vertex2openai_embedding_batch_size", "Inputs per upstream embedding call.", ("model",),
+    (1, 2, 4, 8, 16, 32, 64, 128, 250))
+
+# (vector, prompt token count)
+EmbeddingResult = Tuple[array, int]
+
+
+def encode_embedding(values: array, encoding_format: Optional[str] = None) -> Union[List[float], str]:
+    if encoding_format == "base64":
+        packed = array("f", values)
+        if sys.byteorder != "little":
+            packed.byteswap()
+        return base64.b64encode(packed.tobytes()).decode("ascii")
+    return values.tolist()
+
+
+class _Batch:
+    __slots__ = ("key", "route", "app", "config", "texts", "futures", "timer")
+
+    def __init__(self, key: tuple, route: ModelRoute, app, config: types.EmbedContentConfig):
+        self.key = key
+        self.route = route
+        self.app = app
+        self.config = config
+        self.texts: List[str] = []
+        self.futures: List[asyncio.Future] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class EmbeddingBatcher:
+    def __init__(self):
+        self._open: Dict[tuple, _Batch] = {}
+        self._tasks = set()
+
+    async def embed(self, app, model: str, texts: Sequence[str], task_type: Optional[str] = None,
+                    title: Optional[str] = None, dimensions: Optional[int] = None) -> List[EmbeddingResult]:
+        """Embed ``texts`` in order; inputs may share upstream calls with other requests."""
+        route = compile_model_route(model)
+        max_size = max(1, min(app_config.EMBEDDING_MAX_BATCH_SIZE, route.capabilities.embedding_batch_size or 1))
+        key = (route.base_model, route.express, task_type, title, dimensions)
+        loop = asyncio.get_running_loop()
+        futures = []
+        for text in texts:
+            batch = self._open.get(key)
+            if batch is None:
+                config = types.EmbedContentConfig(task_type=task_type, title=title, output_dimensionality=dimensions)
+                batch = self._open[key] = _Batch(key, route, app, config)
+                if max_size > 1 and app_config.EMBEDDING_BATCH_WINDOW_MS > 0:
+                    batch.timer = loop.call_later(app_config.EMBEDDING_BATCH_WINDOW_MS / 1000, self._flush, batch)
+            future = loop.create_future()
+            batch.texts.append(text)
+            batch.futures.append(future)
+            futures.append(future)
+            if len(batch.texts) >= max_size:
+                self._flush(batch)
+        # 未启用合并窗口时，本请求自身的输入仍按批发送
+        batch = self._open.get(key)
+        if batch is not None and batch.timer is None:
+            self._flush(batch)
+
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def _flush(self, batch: _Batch) -> None:
+        if self._open.get(batch.key) is batch:
+            del self._open[batch.key]
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+        task = asyncio.get_running_loop().create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: _Batch) -> None:
+        # 有可能整批的调用方都已断开
+        if all(future.done() for future in batch.futures):
+            return
+        model = batch.route.base_model
+        EMBEDDING_BATCH_SIZE.observe(len(batch.texts), model)
+        try:
+            # 每次上游调用自成一个 request scope，AIMD 槽位在调用结束时释放
+            with lifecycle.request_scope():
+                client = await select_client(batch.app, batch.route, app_config.EMBEDDING_LOCATION)
+
+                async def _embed_call():
+                    return await client.aio.models.embed_content(model=model, contents=batch.texts, config=batch.config)
+
+                with tracing.span("upstream.embed_content", phase="upstream", model=model, batch_size=len(batch.texts)):
+                    response = await retry_with_backoff(_embed_call, max_retries=3, delay=1.0)
+            embeddings = response.embeddings or []
+            if len(embeddings) != len(batch.texts):
+                raise RuntimeError(f"Upstream returned {len(embeddings)} embeddings for {len(batch.texts)} inputs")
+        except Exception as e:
+            print(f"ERROR: Embedding batch of {len(batch.texts)} input(s) for {model} failed: {e}")
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, text, embedding in zip(batch.futures, batch.texts, embeddings):
+            if future.done():
+                continue
+            statistics = embedding.statistics
+            token_count = int(statistics.token_count) if statistics and statistics.token_count else estimate_text_tokens(text)
+            future.set_result((array("d", embedding.values or ()), token_count))
+
+
+batcher = EmbeddingBatcher()
@@ -1,6 +1,7 @@
 import random
 from typing import List, Optional, Tuple
 import config as app_config
+import shared_state
 
 
 class ExpressKeyManager:
@@ -12,7 +13,6 @@ class ExpressKeyManager:
     def __init__(self):
         """Initialize the Express Key Manager with API keys from config."""
         self.express_keys: List[str] = app_config.VERTEX_EXPRESS_API_KEY_VAL
-        self.round_robin_index: int = 0
         
     def get_total_keys(self) -> int:
         """Get the total number of available Express API keys."""
@@ -49,16 +49,9 @@ class ExpressKeyManager:
             
         print(f"DEBUG: Using round-robin Express API key selection strategy.")
         
-        # Ensure round_robin_index is within bounds
-        if self.round_robin_index >= len(self.express_keys):
-            self.round_robin_index = 0
-            
-        # Get the key at current index
-        key = self.express_keys[self.round_robin_index]
-        original_idx = self.round_robin_index
-        
-        # Move to next index for next call
-        self.round_robin_index = (self.round_robin_index + 1) % len(self.express_keys)
+        # 轮询位置保存在共享状态中，多 worker 时整体保持轮询公平
+        original_idx = shared_state.backend.next_index("express_key_round_robin", len(self.express_keys))
+        key = self.express_keys[original_idx]
         
         return (original_idx, key)
     
@@ -87,7 +80,4 @@ class ExpressKeyManager:
         This allows for dynamic updates if the config is reloaded.
         """
         self.express_keys = app_config.VERTEX_EXPRESS_API_KEY_VAL
-        # Reset round-robin index if keys changed
-        if self.round_robin_index >= len(self.express_keys):
-            self.round_robin_index = 0
         print(f"INFO: Express API keys refreshed. Total keys: {self.get_total_keys()}")
\ No newline at end of file
@@ -0,0 +1,329 @@
+"""
+Fetching of remote (http/https) image_url parts.
+
+create_gemini_prompt() is synchronous and only understands data: URLs and
+image store links. prefetch_messages() runs before it: it collects every
+remote image URL in the request's messages, downloads them concurrently over
+one shared connection pool and keeps the results for this request, where
+_image_url_to_part() picks them up.
+
+- Limits: at most IMAGE_FETCH_MAX_MB per image (Content-Length is checked
+  first, the body is streamed and aborted once it grows past the limit) and
+  IMAGE_FETCH_TIMEOUT seconds per download; at most
+  IMAGE_FETCH_MAX_CONNECTIONS connections in total.
+- Cache: downloaded images are kept in an LRU bounded to IMAGE_FETCH_CACHE_MB.
+  An entry is reused as is for IMAGE_FETCH_CACHE_TTL seconds; after that,
+  entries with an ETag are revalidated with If-None-Match (a 304 keeps the
+  cached bytes), others are fetched again. Concurrent requests for the same
+  URL share one download.
+- Image store links (/v1/files/images/...) are read from the local store by
+  message_processing and never fetched over the network.
+- Addresses: hosts (including redirect targets) resolving to private,
+  loopback or link-local addresses are refused unless IMAGE_FETCH_ALLOW_PRIVATE
+  is set (needed to test against a local HTTP server). The check runs in the
+  connection pool's network backend: the host is resolved once, every address
+  is vetted and the socket is opened to the vetted address, so a second DNS
+  answer cannot swap in an internal one (DNS rebinding). URL, Host header and
+  TLS SNI / certificate check keep the host name. Downloads therefore connect
+  directly and ignore HTTP(S)_PROXY.
+
+An image that cannot be fetched is logged and left out of the prompt, as
+before.
+"""
+import asyncio
+import ipaddress
+import socket
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import httpcore
+import httpx
+
+import config as app_config
+import image_store
+import lifecycle
+import tracing
+from metrics import REGISTRY
+from models import ContentPartImage, OpenAIMessage
+
+IMAGE_FETCH_TOTAL = REGISTRY.counter(
+    "vertex2openai_image_fetch_total", "Remote image_url fetches by outcome.", ("outcome",))
+IMAGE_FETCH_SECONDS = REGISTRY.histogram(
+    "vertex2openai_image_fetch_seconds", "Time to download one remote image.", (),
+    (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+
+# (data, mime type)
+FetchedImage = Tuple[bytes, str]
+
+_MAX_REDIRECTS = 3
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+# 按文件头识别图片类型（服务器未返回 image/* Content-Type 时）
+_MAGIC = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+)
+
+
+class ImageFetchError(Exception):
+    def __init__(self, message: str, outcome: str = "error"):
+        super().__init__(message)
+        self.outcome = outcome
+
+
+def _sniff_mime_type(data: bytes) -> Optional[str]:
+    for magic, mime_type in _MAGIC:
+        if data.startswith(magic):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:12] in (b"ftypavif", b"ftypheic", b"ftypheix", b"ftypmif1"):
+        return "image/avif" if data[8:12] == b"avif" else "image/heic"
+    return None
+
+
+def is_remote_url(url: str) -> bool:
+    return url.startswith(("http://", "https://"))
+
+
+async def _resolve_public(host: str, port: int) -> str:
+    """Address to connect to for ``host``; raises ImageFetchError if any of its addresses is not public."""
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise ImageFetchError(f"cannot resolve {host}: {e}")
+    if not infos:
+        raise ImageFetchError(f"cannot resolve {host}")
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split("%", 1)[0])
+        if not address.is_global:
+            raise ImageFetchError(f"{host} resolves to non-public address {address}", outcome="blocked")
+    return infos[0][4][0]
+
+
+class _PublicAddressBackend(httpcore.AsyncNetworkBackend):
+    """Network backend that connects only to vetted public addresses (see the module docstring)."""
+
+    def __init__(self):
+        self._backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        if not app_config.IMAGE_FETCH_ALLOW_PRIVATE:
+            # 校验与连接使用同一次解析结果
+            host = await _resolve_public(host, port)
+        return await self._backend.connect_tcp(
+            host, port, timeout=timeout, local_address=local_address, socket_options=socket_options)
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        raise ImageFetchError("unix sockets are not supported")
+
+    async def sleep(self, seconds: float) -> None:
+        await self._backend.sleep(seconds)
+
+
+class _PublicAddressTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, limits: httpx.Limits):
+        super().__init__(limits=limits)
+        # 与 httpx 默认连接池参数相同，只替换网络后端
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=_PublicAddressBackend(),
+        )
+
+
+class _Entry:
+    __slots__ = ("data", "mime_type", "etag", "fetched_at")
+
+    def __init__(self, data: bytes, mime_type: str, etag: Optional[str], fetched_at: float):
+        self.data = data
+        self.mime_type = mime_type
+        self.etag = etag
+        self.fetched_at = fetched_at
+
+
+class RemoteImageFetcher:
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+        self._cache: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        lifecycle.on_shutdown(self.close)
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            limits = httpx.Limits(max_connections=app_config.IMAGE_FETCH_MAX_CONNECTIONS,
+                                  max_keepalive_connections=app_config.IMAGE_FETCH_MAX_CONNECTIONS)
+            self._client = httpx.AsyncClient(
+                transport=_PublicAddressTransport(limits),
+                timeout=app_config.IMAGE_FETCH_TIMEOUT,
+                headers={"User-Agent": "vertex2openai-image-fetch", "Accept": "image/*"},
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    # --- cache ---
+
+    def _cache_get(self, url: str) -> Optional[_Entry]:
+        with self._lock:
+            entry = self._cache.get(url)
+            if entry is not None:
+                self._cache.move_to_end(url)
+            return entry
+
+    def _cache_put(self, url: str, entry: _Entry) -> None:
+        limit = app_config.IMAGE_FETCH_CACHE_MB * 1024 * 1024
+        if len(entry.data) > limit:
+            return
+        with self._lock:
+            previous = self._cache.pop(url, None)
+            if previous is not None:
+                self._cache_bytes -= len(previous.data)
+            self._cache[url] = entry
+            self._cache_bytes += len(entry.data)
+            while self._cache_bytes > limit:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_bytes -= len(evicted.data)
+
+    # --- fetching ---
+
+    async def _download(self, url: str, cached: Optional[_Entry]) -> Tuple[_Entry, str]:
+        max_bytes = int(app_config.IMAGE_FETCH_MAX_MB * 1024 * 1024)
+        headers = {"If-None-Match": cached.etag} if cached is not None and cached.etag else {}
+        started = time.perf_counter()
+        target = url
+        # 手动跟随重定向；每一跳新建的连接都由 _PublicAddressBackend 检查目标地址
+        for _ in range(_MAX_REDIRECTS + 1):
+            async with self._get_client().stream("GET", target, headers=headers) as response:
+                if response.status_code in _REDIRECT_STATUSES:
+                    location = response.headers.get("location")
+                    if not location:
+                        raise ImageFetchError(f"HTTP {response.status_code} without Location")
+                    target = str(response.url.join(location))
+                    if not is_remote_url(target):
+                        raise ImageFetchError(f"redirect to unsupported URL {target}")
+                    continue
+                if response.status_code == 304 and cached is not None:
+                    return _Entry(cached.data, cached.mime_type, cached.etag, time.time()), "revalidated"
+                if response.status_code != 200:
+                    raise ImageFetchError(f"HTTP {response.status_code}")
+                content_length = response.headers.get("content-length")
+                if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+                    raise ImageFetchError(f"image is {content_length} bytes, limit is {max_bytes}", outcome="too_large")
+                chunks = []
+                received = 0
+                async for chunk in response.aiter_bytes():
+                    received += len(chunk)
+                    if received > max_bytes:
+                        raise ImageFetchError(f"image exceeds {max_bytes} bytes", outcome="too_large")
+                    chunks.append(chunk)
+                data = b"".join(chunks)
+                content_type = response.headers.get("content-type", "").split(";", 1)[0].strip().lower()
+                mime_type = content_type if content_type.startswith("image/") else _sniff_mime_type(data)
+                if not mime_type:
+                    raise ImageFetchError(f"not an image (Content-Type '{content_type or 'missing'}')")
+                IMAGE_FETCH_SECONDS.observe(time.perf_counter() - started)
+                return _Entry(data, mime_type, response.headers.get("etag"), time.time()), "fetched"
+        raise ImageFetchError(f"more than {_MAX_REDIRECTS} redirects")
+
+    async def _fetch_and_cache(self, url: str, cached: Optional[_Entry]) -> _Entry:
+        entry, outcome = await asyncio.wait_for(self._download(url, cached), timeout=app_config.IMAGE_FETCH_TIMEOUT)
+        IMAGE_FETCH_TOTAL.inc(outcome)
+        self._cache_put(url, entry)
+        return entry
+
+    async def fetch(self, url: str) -> Optional[FetchedImage]:
+        """(bytes, mime type) of a remote image, or None if it cannot be fetched within the limits."""
+        cached = self._cache_get(url)
+        if cached is not None and time.time() - cached.fetched_at <= app_config.IMAGE_FETCH_CACHE_TTL:
+            IMAGE_FETCH_TOTAL.inc("cached")
+            return cached.data, cached.mime_type
+        if cached is not None and not cached.etag:
+            cached = None
+
+        task = self._inflight.get(url)
+        if task is None:
+            # 并发请求同一 URL 时共用一次下载；shield 避免单个调用方取消影响其他调用方
+            task = self._inflight[url] = asyncio.ensure_future(self._fetch_and_cache(url, cached))
+            task.add_done_callback(lambda _: self._inflight.pop(url, None))
+        try:
+            entry = await asyncio.shield(task)
+        except asyncio.TimeoutError:
+            IMAGE_FETCH_TOTAL.inc("timeout")
+            print(f"WARNING: Timed out fetching image {url} after {app_config.IMAGE_FETCH_TIMEOUT}s")
+            return None
+        except ImageFetchError as e:
+            IMAGE_FETCH_TOTAL.inc(e.outcome)
+            print(f"WARNING: Could not fetch image {url}: {e}")
+            return None
+        except httpx.HTTPError as e:
+            IMAGE_FETCH_TOTAL.inc("error")
+            print(f"WARNING: Could not fetch image {url}: {e}")
+            return None
+        return entry.data, entry.mime_type
+
+    async def fetch_all(self, urls: Iterable[str]) -> Dict[str, FetchedImage]:
+        unique = list(dict.fromkeys(urls))
+        if not unique:
+            return {}
+        with tracing.span("image_fetch", phase="prompt_conversion", images=len(unique)):
+            results = await asyncio.gather(*(self.fetch(url) for url in unique))
+        return {url: result for url, result in zip(unique, results) if result is not None}
+
+
+fetcher = RemoteImageFetcher()
+
+# 当前请求已下载的远程图片：url -> (bytes, mime type)
+_fetched: ContextVar[Optional[Dict[str, FetchedImage]]] = ContextVar("vertex2openai_fetched_images", default=None)
+
+
+def _image_urls(messages: List[OpenAIMessage]) -> List[str]:
+    urls = []
+    for message in messages:
+        if not isinstance(message.content, list):
+            continue
+        for part_item in message.content:
+            if isinstance(part_item, ContentPartImage):
+                url = part_item.image_url.url
+            elif isinstance(part_item, dict) and part_item.get("type") == "image_url":
+                image_url = part_item.get("image_url")
+                url = image_url.get("url", "") if isinstance(image_url, dict) else ""
+            else:
+                continue
+            # 本服务自己的图片存储链接由 image_store 直接读取，不走网络
+            if is_remote_url(url) and not image_store.STORED_URL_RE.search(url):
+                urls.append(url)
+    return urls
+
+
+async def prefetch_messages(messages: List[OpenAIMessage]) -> None:
+    """Download the remote image_url parts of ``messages`` for the prompt conversion that follows."""
+    if not app_config.IMAGE_FETCH_ENABLED:
+        return
+    urls = _image_urls(messages)
+    if not urls:
+        return
+    fetched = await fetcher.fetch_all(urls)
+    previous = _fetched.get()
+    _fetched.set({**previous, **fetched} if previous else fetched)
+
+
+def lookup(url: str) -> Optional[FetchedImage]:
+    """Image prefetched for this request, or None."""
+    fetched = _fetched.get()
+    if not fetched:
+        return None
+    return fetched.get(url)
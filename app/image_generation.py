@@ -0,0 +1,142 @@
+"""
+Image generation for the OpenAI-compatible /v1/images/generations endpoint.
+
+Gemini image models return one image per call, so a request for ``n`` images
+becomes ``n`` concurrent generate_content calls. Each call selects its own
+client (Express keys rotate, SA projects rotate) and holds its own AIMD slot
+only for the duration of that call, so the images of one request spread
+across the available keys instead of queueing on one.
+
+The OpenAI ``size`` is mapped to the nearest aspect ratio Gemini supports;
+-2k / -4k model suffixes set the output resolution as in chat completions.
+Each image's latency and outcome is recorded on /metrics and as its own
+trace span.
+"""
+import asyncio
+import math
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from google.genai import types
+
+import lifecycle
+import tracing
+import image_transcoding
+from api_helpers import retry_with_backoff, select_client
+from metrics import REGISTRY
+from model_routing import ModelRoute, model_label
+
+IMAGE_GENERATION_SECONDS = REGISTRY.histogram(
+    "vertex2openai_image_generation_seconds", "Time to generate one image (one upstream call).", ("model",),
+    (1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90, 120))
+IMAGES_GENERATED_TOTAL = REGISTRY.counter(
+    "vertex2openai_images_generated_total", "Images requested from /v1/images/generations by outcome.",
+    ("model", "outcome"))
+
+# Gemini 图片模型支持的宽高比
+_ASPECT_RATIOS = ("1:1", "2:3", "3:2", "3:4", "4:3", "4:5", "5:4", "9:16", "16:9", "21:9")
+
+
+class GeneratedImage:
+    __slots__ = ("data", "mime_type", "text", "usage", "seconds")
+
+    def __init__(self, data: bytes, mime_type: str, text: str, usage: Any, seconds: float):
+        self.data = data
+        self.mime_type = mime_type
+        self.text = text
+        self.usage = usage
+        self.seconds = seconds
+
+
+def aspect_ratio_for_size(size: Optional[str]) -> Optional[str]:
+    """'1792x1024' -> '16:9' (nearest supported ratio); None / 'auto' -> None. Raises ValueError if malformed."""
+    if not size or size == "auto":
+        return None
+    if size in _ASPECT_RATIOS:
+        return size
+    width, sep, height = size.lower().partition("x")
+    if not sep or not width.isdigit() or not height.isdigit() or not int(width) or not int(height):
+        raise ValueError(f"Invalid size '{size}', expected WIDTHxHEIGHT (e.g. 1024x1024) or auto")
+    target = math.log(int(width) / int(height))
+
+    def distance(ratio: str) -> float:
+        w, _, h = ratio.partition(":")
+        return abs(math.log(int(w) / int(h)) - target)
+
+    return min(_ASPECT_RATIOS, key=distance)
+
+
+def _generation_config(route: ModelRoute, aspect_ratio: Optional[str]) -> Dict[str, Any]:
+    image_config: Dict[str, Any] = {}
+    if aspect_ratio:
+        image_config["aspectRatio"] = aspect_ratio
+    if route.image_size:
+        image_config["imageSize"] = route.image_size
+    config: Dict[str, Any] = {"responseModalities": ["TEXT", "IMAGE"]}
+    if image_config:
+        config["imageConfig"] = image_config
+    return config
+
+
+def _extract_image(response: Any) -> Tuple[Optional[types.Blob], str]:
+    text_parts = []
+    for candidate in getattr(response, "candidates", None) or []:
+        content = getattr(candidate, "content", None)
+        for part in getattr(content, "parts", None) or []:
+            if part.inline_data is not None and (part.inline_data.mime_type or "").startswith("image/") \
+                    and not part.thought:
+                return part.inline_data, "".join(text_parts)
+            if part.text and not part.thought:
+                text_parts.append(part.text)
+    return None, "".join(text_parts)
+
+
+async def _generate_one(app, route: ModelRoute, prompt: str, config: Dict[str, Any], index: int) -> GeneratedImage:
+    model = route.base_model
+    label = model_label(model)
+    started = time.perf_counter()
+    # 每张图片单独占用一个 AIMD 槽位，生成完即释放
+    with lifecycle.request_scope():
+        with tracing.span("upstream.generate_image", phase="upstream", model=model, index=index) as span:
+            client = await select_client(app, route)
+
+            async def _generate_call():
+                return await client.aio.models.generate_content(model=model, contents=prompt, config=config)
+
+            try:
+                response = await retry_with_backoff(_generate_call, max_retries=3, delay=1.0)
+                await image_transcoding.transcode_images(response)
+            except Exception:
+                IMAGES_GENERATED_TOTAL.inc(label, "error")
+                raise
+            seconds = time.perf_counter() - started
+            span.set_attribute("image.seconds", seconds)
+
+    blob, text = _extract_image(response)
+    if blob is None:
+        IMAGES_GENERATED_TOTAL.inc(label, "no_image")
+        finish_reason = None
+        if getattr(response, "candidates", None):
+            finish_reason = response.candidates[0].finish_reason
+        block_reason = getattr(getattr(response, "prompt_feedback", None), "block_reason", None)
+        raise ValueError(f"Model returned no image (finish reason: {block_reason or finish_reason}){': ' + text if text else ''}")
+    IMAGES_GENERATED_TOTAL.inc(label, "ok")
+    IMAGE_GENERATION_SECONDS.observe(seconds, label)
+    return GeneratedImage(blob.data, blob.mime_type, text, getattr(response, "usage_metadata", None), seconds)
+
+
+async def generate_images(app, route: ModelRoute, prompt: str, n: int,
+                          aspect_ratio: Optional[str] = None) -> List[GeneratedImage]:
+    """Generate ``n`` images concurrently. Returns the images that succeeded; raises if none did."""
+    config = _generation_config(route, aspect_ratio)
+    results = await asyncio.gather(
+        *(_generate_one(app, route, prompt, config, index) for index in range(n)), return_exceptions=True)
+    images = [result for result in results if isinstance(result, GeneratedImage)]
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        print(f"WARNING: {len(errors)} of {n} image(s) for {route.base_model} failed: {errors[0]}")
+    if not images:
+        raise errors[0]
+    print(f"INFO: Generated {len(images)} image(s) with {route.base_model} in "
+          f"{', '.join(f'{image.seconds:.1f}s' for image in images)}")
+    return images
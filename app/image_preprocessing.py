@@ -0,0 +1,209 @@
+"""
+Optional downscaling and re-encoding of input images before upload.
+
+Clients often send full-resolution PNG screenshots. Vertex bills images by
+768x768 tile, so a 3000x2000 PNG costs both megabytes of upload and a dozen
+tiles' worth of tokens, while a 1536px WebP is a fraction of either and still
+readable for the model. With IMAGE_PREPROCESS_ENABLED each inline image part of
+a prompt is:
+
+- rotated according to its EXIF orientation, then stripped of all metadata;
+- scaled down so that its longer side is at most IMAGE_PREPROCESS_MAX_SIDE
+  (IMAGE_PREPROCESS_MODEL_MAX_SIDE overrides it per model);
+- re-encoded as IMAGE_PREPROCESS_FORMAT (webp | jpeg) at IMAGE_PREPROCESS_QUALITY.
+
+The original is kept when the result would not be smaller and no resize was
+needed. Small images (< IMAGE_PREPROCESS_MIN_KB) and GIFs are passed through.
+
+Pillow does its decoding, resizing and encoding without holding the GIL, so
+the work runs in a thread pool of IMAGE_PREPROCESS_WORKERS threads and does not
+block the event loop. Results are cached by input hash, since the same images
+are resent with every turn of a conversation. Bytes and estimated image tokens
+before and after are exported on /metrics and logged per request.
+
+Requires Pillow; without it the stage is disabled with a warning.
+"""
+import asyncio
+import hashlib
+import io
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow 为可选依赖
+    Image = None
+    ImageOps = None
+
+from google.genai import types
+
+import config as app_config
+import tracing
+from metrics import REGISTRY
+from token_counting import estimate_image_tokens
+
+IMAGE_PREPROCESS_BYTES_TOTAL = REGISTRY.counter(
+    "vertex2openai_image_preprocess_bytes_total", "Input image bytes before and after preprocessing.", ("stage",))
+IMAGE_PREPROCESS_TOKENS_TOTAL = REGISTRY.counter(
+    "vertex2openai_image_preprocess_tokens_total", "Estimated input image tokens before and after preprocessing.",
+    ("stage",))
+IMAGE_PREPROCESS_IMAGES_TOTAL = REGISTRY.counter(
+    "vertex2openai_image_preprocess_images_total", "Input images seen by the preprocessing stage, by outcome.",
+    ("outcome",))
+
+_PROCESSABLE_MIME_TYPES = {"image/png", "image/jpeg", "image/webp", "image/bmp", "image/tiff"}
+_FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+
+# (data, mime type, original tokens, processed tokens)
+_Result = Tuple[bytes, str, int, int]
+
+
+def _transcode(data: bytes, max_side: int, fmt: str, quality: int) -> Optional[_Result]:
+    """Runs in the worker pool. Returns None when the original should be kept."""
+    with Image.open(io.BytesIO(data)) as original:
+        original_size = original.size
+        image = ImageOps.exif_transpose(original)
+        width, height = image.size
+        resized = max(width, height) > max_side
+        if resized:
+            scale = max_side / max(width, height)
+            image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+
+        pil_format, mime_type = _FORMATS[fmt]
+        if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+            # JPEG 不支持透明通道：合成到白色背景
+            rgba = image.convert("RGBA")
+            background = Image.new("RGB", rgba.size, (255, 255, 255))
+            background.paste(rgba, mask=rgba.split()[-1])
+            image = background
+        elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+
+        out = io.BytesIO()
+        # 不传 exif/icc_profile 等参数即去除元数据
+        if pil_format == "WEBP":
+            image.save(out, format=pil_format, quality=quality, method=4)
+        else:
+            image.save(out, format=pil_format, quality=quality, optimize=True)
+        encoded = out.getvalue()
+
+    if not resized and len(encoded) >= len(data):
+        return None
+    return encoded, mime_type, estimate_image_tokens(*original_size), estimate_image_tokens(*image.size)
+
+
+class ImagePreprocessor:
+    def __init__(self):
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._cache: "OrderedDict[Tuple[str, int, str, int], Optional[_Result]]" = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+        self.enabled = app_config.IMAGE_PREPROCESS_ENABLED
+        if self.enabled and Image is None:
+            print("WARNING: IMAGE_PREPROCESS_ENABLED is set but Pillow is not installed; input images are sent unchanged")
+            self.enabled = False
+        if self.enabled and app_config.IMAGE_PREPROCESS_FORMAT not in _FORMATS:
+            print(f"WARNING: Unsupported IMAGE_PREPROCESS_FORMAT '{app_config.IMAGE_PREPROCESS_FORMAT}', using webp")
+
+    @staticmethod
+    def _format() -> str:
+        fmt = app_config.IMAGE_PREPROCESS_FORMAT
+        return fmt if fmt in _FORMATS else "webp"
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=max(1, app_config.IMAGE_PREPROCESS_WORKERS),
+                                                thread_name_prefix="image-preprocess")
+        return self._executor
+
+    def _cache_get(self, key) -> Tuple[bool, Optional[_Result]]:
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return True, self._cache[key]
+        return False, None
+
+    def _cache_put(self, key, result: Optional[_Result]) -> None:
+        size = len(result[0]) if result else 0
+        limit = app_config.IMAGE_PREPROCESS_CACHE_MB * 1024 * 1024
+        if size > limit:
+            return
+        with self._lock:
+            # 并发处理同一张图片时可能重复写入：先扣除旧条目的字节数
+            if key in self._cache:
+                previous = self._cache.pop(key)
+                self._cache_bytes -= len(previous[0]) if previous else 0
+            self._cache[key] = result
+            self._cache_bytes += size
+            while self._cache_bytes > limit:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_bytes -= len(evicted[0]) if evicted else 0
+
+    async def _process(self, data: bytes, max_side: int) -> Tuple[str, Optional[_Result]]:
+        fmt, quality = self._format(), app_config.IMAGE_PREPROCESS_QUALITY
+        key = (hashlib.blake2b(data, digest_size=16).hexdigest(), max_side, fmt, quality)
+        hit, result = self._cache_get(key)
+        if hit:
+            return "cached", result
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self._pool(), _transcode, data, max_side, fmt, quality)
+        except Exception as e:
+            print(f"WARNING: Could not preprocess input image ({len(data)} bytes): {e}")
+            return "error", None
+        self._cache_put(key, result)
+        return "processed", result
+
+    async def preprocess_contents(self, contents: List[types.Content], model: str) -> List[types.Content]:
+        """Replace inline image parts of ``contents`` in place with preprocessed versions."""
+        if not self.enabled:
+            return contents
+        targets = [
+            part for content in contents for part in (content.parts or [])
+            if part.inline_data is not None and part.inline_data.mime_type in _PROCESSABLE_MIME_TYPES
+            and isinstance(part.inline_data.data, bytes)
+            and len(part.inline_data.data) >= app_config.IMAGE_PREPROCESS_MIN_KB * 1024
+        ]
+        if not targets:
+            return contents
+
+        max_side = app_config.IMAGE_PREPROCESS_MODEL_MAX_SIDE.get(model, app_config.IMAGE_PREPROCESS_MAX_SIDE)
+        started = time.perf_counter()
+        with tracing.span("image_preprocess", phase="prompt_conversion", images=len(targets)) as span:
+            outcomes = await asyncio.gather(*(self._process(part.inline_data.data, max_side) for part in targets))
+            bytes_before = bytes_after = tokens_before = tokens_after = 0
+            for part, (outcome, result) in zip(targets, outcomes):
+                original_size = len(part.inline_data.data)
+                if result is None:
+                    IMAGE_PREPROCESS_IMAGES_TOTAL.inc("unchanged" if outcome != "error" else "error")
+                    continue
+                data, mime_type, original_tokens, processed_tokens = result
+                part.inline_data = types.Blob(data=data, mime_type=mime_type)
+                IMAGE_PREPROCESS_IMAGES_TOTAL.inc(outcome)
+                bytes_before += original_size
+                bytes_after += len(data)
+                tokens_before += original_tokens
+                tokens_after += processed_tokens
+            span.set_attribute("image.bytes_before", bytes_before)
+            span.set_attribute("image.bytes_after", bytes_after)
+
+        if bytes_before:
+            IMAGE_PREPROCESS_BYTES_TOTAL.inc("original", amount=bytes_before)
+            IMAGE_PREPROCESS_BYTES_TOTAL.inc("processed", amount=bytes_after)
+            IMAGE_PREPROCESS_TOKENS_TOTAL.inc("original", amount=tokens_before)
+            IMAGE_PREPROCESS_TOKENS_TOTAL.inc("processed", amount=tokens_after)
+            print(f"INFO: Preprocessed {len(targets)} input image(s) for {model} in "
+                  f"{(time.perf_counter() - started) * 1000:.0f}ms: {bytes_before} -> {bytes_after} bytes, "
+                  f"~{tokens_before} -> ~{tokens_after} image tokens")
+        return contents
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+preprocessor = ImagePreprocessor()
@@ -0,0 +1,235 @@
+"""
+Content-addressed store for generated images.
+
+Image models return multi-megabyte PNGs. Inlined as base64 they inflate every
+response and SSE frame by a third and are sent back again with every later
+turn of the conversation. In URL mode an image is stored once under the hash
+of its bytes and the response carries a short link instead:
+
+    OpenAI format:  ![Image](https://host/v1/files/images/img-<hash>.png)
+    Gemini format:  {"fileData": {"mimeType": "image/png", "fileUri": "https://host/v1/files/images/img-<hash>.png"}}
+
+Links are capability URLs (128-bit content hash) and are served without an
+API key so that markdown renderers can load them. When a link comes back in a
+later request (image_url part, markdown image or Gemini fileData), it is
+resolved to the stored bytes instead of being fetched or decoded.
+
+Images live on disk under IMAGE_STORE_DIR, with an LRU of recently used images
+in memory (IMAGE_STORE_MEMORY_MB). Files older than IMAGE_STORE_TTL seconds
+are removed by a periodic sweep.
+
+The mode is chosen per request: the X-Image-Response header (url | inline),
+else IMAGE_RESPONSE_MODE. Links use IMAGE_STORE_PUBLIC_URL as base, or the
+scheme and host the request came in on.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Optional, Tuple
+
+from fastapi import Request
+
+import config as app_config
+
+IMAGE_PATH_PREFIX = "/v1/files/images/"
+
+_EXTENSIONS = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/webp": "webp",
+    "image/gif": "gif",
+    "image/avif": "avif",
+    "image/heic": "heic",
+    "image/heif": "heif",
+}
+_MIME_TYPES = {ext: mime for mime, ext in _EXTENSIONS.items()}
+_NAME_RE = re.compile(r"^img-[0-9a-f]{32}\.[a-z0-9]+$")
+STORED_URL_RE = re.compile(re.escape(IMAGE_PATH_PREFIX) + r"(img-[0-9a-f]{32}\.[a-z0-9]+)")
+
+_SWEEP_INTERVAL_SECONDS = 600
+
+
+def mime_type_for(name: str) -> str:
+    return _MIME_TYPES.get(name.rsplit(".", 1)[-1], "application/octet-stream")
+
+
+class ImageStore:
+    def __init__(self, root: str, ttl_seconds: float, memory_bytes: int):
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        self.memory_bytes = memory_bytes
+        # name -> (data, stored_at)；路由在线程池里读盘，需要加锁
+        self._memory: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+        self._memory_used = 0
+        self._lock = threading.Lock()
+        self._sweeper: Optional[asyncio.Task] = None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def _remember(self, name: str, data: bytes, stored_at: float) -> None:
+        if len(data) > self.memory_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(name, None)
+            if previous is not None:
+                self._memory_used -= len(previous[0])
+            self._memory[name] = (data, stored_at)
+            self._memory_used += len(data)
+            while self._memory_used > self.memory_bytes:
+                _, (evicted, _) = self._memory.popitem(last=False)
+                self._memory_used -= len(evicted)
+
+    def _write(self, name: str, data: bytes) -> None:
+        path = self._path(name)
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            if os.path.exists(path):
+                # 同一内容再次生成：只刷新过期时间
+                os.utime(path)
+                return
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"WARNING: Could not write image {name} to {self.root}: {e}")
+
+    def put(self, data: bytes, mime_type: str) -> str:
+        """Store ``data`` and return its name. The disk write runs in a worker thread when a loop is running."""
+        name = f"img-{hashlib.blake2b(data, digest_size=16).hexdigest()}.{_EXTENSIONS.get(mime_type, 'bin')}"
+        self._remember(name, data, time.time())
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self._write, name, data)
+        except RuntimeError:
+            self._write(name, data)
+        return name
+
+    def get(self, name: str) -> Optional[bytes]:
+        if not _NAME_RE.match(name):
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(name)
+            if entry is not None:
+                if now - entry[1] <= self.ttl_seconds:
+                    self._memory.move_to_end(name)
+                    return entry[0]
+                self._memory.pop(name)
+                self._memory_used -= len(entry[0])
+        path = self._path(name)
+        try:
+            stored_at = os.path.getmtime(path)
+            if now - stored_at > self.ttl_seconds:
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        self._remember(name, data, stored_at)
+        return data
+
+    def sweep(self) -> int:
+        """Delete expired images; returns the number of files removed."""
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            for name in [n for n, (_, stored_at) in self._memory.items() if stored_at < cutoff]:
+                data, _ = self._memory.pop(name)
+                self._memory_used -= len(data)
+        removed = 0
+        if not os.path.isdir(self.root):
+            return 0
+        for name in os.listdir(self.root):
+            path = self._path(name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(_SWEEP_INTERVAL_SECONDS)
+            try:
+                removed = await asyncio.to_thread(self.sweep)
+                if removed:
+                    print(f"INFO: Removed {removed} expired image(s) from {self.root}")
+            except Exception as e:
+                print(f"WARNING: Image store sweep failed: {e}")
+
+    def start(self) -> None:
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+
+
+store = ImageStore(app_config.IMAGE_STORE_DIR, app_config.IMAGE_STORE_TTL, app_config.IMAGE_STORE_MEMORY_MB * 1024 * 1024)
+
+# 当前请求的图片链接前缀；""表示内联 base64，None 表示未设置（后台任务等，按全局配置）
+_url_base: ContextVar[Optional[str]] = ContextVar("vertex2openai_image_url_base", default=None)
+
+
+def _request_url_base(request: Request) -> str:
+    base = app_config.IMAGE_STORE_PUBLIC_URL
+    if not base:
+        scheme = request.headers.get("x-forwarded-proto") or request.url.scheme
+        host = request.headers.get("x-forwarded-host") or request.headers.get("host") or request.url.netloc
+        base = f"{scheme}://{host}"
+    return base.rstrip("/")
+
+
+def configure_request(request: Request) -> None:
+    """Pick inline or URL mode for images in this request's response."""
+    mode = (request.headers.get("x-image-response") or app_config.IMAGE_RESPONSE_MODE).lower()
+    _url_base.set(_request_url_base(request) if mode == "url" else "")
+
+
+def stored_image_url(request: Request, data: bytes, mime_type: str) -> str:
+    """Store ``data`` and return its URL regardless of the response mode (e.g. response_format=url)."""
+    return f"{_request_url_base(request)}{IMAGE_PATH_PREFIX}{store.put(data, mime_type)}"
+
+
+def _current_url_base() -> str:
+    base = _url_base.get()
+    if base is None:
+        # 没有请求上下文（如批处理任务）：只有配置了公开地址才能生成可访问的链接
+        if app_config.IMAGE_RESPONSE_MODE == "url" and app_config.IMAGE_STORE_PUBLIC_URL:
+            return app_config.IMAGE_STORE_PUBLIC_URL.rstrip("/")
+        return ""
+    return base
+
+
+def image_url(data: bytes, mime_type: str) -> Optional[str]:
+    """URL of the stored image in URL mode, or None when the image should be inlined."""
+    base = _current_url_base()
+    if not base or not isinstance(data, bytes):
+        return None
+    return f"{base}{IMAGE_PATH_PREFIX}{store.put(data, mime_type)}"
+
+
+def resolve_url(url: str) -> Optional[Tuple[bytes, str]]:
+    """(bytes, mime type) of a link produced by image_url(), or None if it is not ours or has expired."""
+    match = STORED_URL_RE.search(url)
+    if not match:
+        return None
+    name = match.group(1)
+    data = store.get(name)
+    if data is None:
+        print(f"WARNING: Stored image {name} referenced by request is missing or expired")
+        return None
+    return data, mime_type_for(name)
@@ -0,0 +1,179 @@
+"""
+Transcoding of generated images to compact formats.
+
+Image models (gemini-2.5-flash-image, gemini-3-pro-image-preview) return
+lossless PNGs of one to several megabytes. When a client asks for another
+format, image parts of the upstream response are re-encoded before the
+response is converted to OpenAI or Gemini format:
+
+- webp: lossy WebP at IMAGE_OUTPUT_QUALITY;
+- avif: lossy AVIF at IMAGE_OUTPUT_QUALITY (falls back to WebP when Pillow
+  was built without AVIF support);
+- png:  the same pixels, losslessly re-compressed at the highest zlib level;
+- original: unchanged (default).
+
+The format is chosen per request: the X-Image-Format header, else a model
+suffix (-webp / -avif / -png, see model_routing), else IMAGE_OUTPUT_FORMAT.
+The original is kept when the transcoded image would not be smaller.
+
+Encoding takes tens to hundreds of milliseconds per image, so it runs in a
+pool of IMAGE_TRANSCODE_WORKERS threads (Pillow releases the GIL while
+encoding). transcode_images() is awaited on each response or stream chunk
+right before the synchronous converters
+(parse_gemini_response_for_reasoning_and_content via convert_to_openai_format /
+convert_chunk_to_openai, and convert_response_to_gemini_format), which then
+render the transcoded bytes inline or as image store links.
+
+Requires Pillow; without it images are returned unchanged.
+"""
+import asyncio
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Any, List, Optional, Tuple
+
+try:
+    from PIL import Image, features
+except ImportError:  # Pillow 为可选依赖
+    Image = None
+    features = None
+
+from fastapi import Request
+from google.genai import types
+
+import config as app_config
+import tracing
+from metrics import REGISTRY
+
+IMAGE_TRANSCODE_BYTES_TOTAL = REGISTRY.counter(
+    "vertex2openai_image_transcode_bytes_total", "Generated image bytes before and after transcoding.",
+    ("format", "stage"))
+IMAGE_TRANSCODE_SECONDS = REGISTRY.histogram(
+    "vertex2openai_image_transcode_seconds", "Time to transcode one generated image.", ("format",),
+    (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+
+FORMAT_ORIGINAL = "original"
+_ENCODERS = {
+    # format -> (Pillow format, mime type)
+    "webp": ("WEBP", "image/webp"),
+    "avif": ("AVIF", "image/avif"),
+    "png": ("PNG", "image/png"),
+}
+_SOURCE_MIME_TYPES = {"image/png", "image/jpeg", "image/webp"}
+
+_format: ContextVar[Optional[str]] = ContextVar("vertex2openai_image_output_format", default=None)
+_executor: Optional[ThreadPoolExecutor] = None
+_warned: set = set()
+
+
+def _warn_once(message: str) -> None:
+    if message not in _warned:
+        _warned.add(message)
+        print(f"WARNING: {message}")
+
+
+def _normalize(image_format: Optional[str]) -> Optional[str]:
+    if not image_format:
+        return None
+    image_format = image_format.strip().lower()
+    if image_format == FORMAT_ORIGINAL or image_format in _ENCODERS:
+        return image_format
+    _warn_once(f"Unsupported output image format '{image_format}', images are returned unchanged")
+    return FORMAT_ORIGINAL
+
+
+def configure_request(request: Request, suffix_format: Optional[str] = None) -> None:
+    """Pick the output image format for this request (header > model suffix > IMAGE_OUTPUT_FORMAT)."""
+    _format.set(_normalize(request.headers.get("x-image-format")) or suffix_format)
+
+
+def current_format() -> str:
+    return _format.get() or _normalize(app_config.IMAGE_OUTPUT_FORMAT) or FORMAT_ORIGINAL
+
+
+def _encode(data: bytes, image_format: str, quality: int) -> Optional[Tuple[bytes, str]]:
+    """Runs in the worker pool. Returns None when the original should be kept."""
+    pil_format, mime_type = _ENCODERS[image_format]
+    with Image.open(io.BytesIO(data)) as image:
+        if pil_format == "PNG" and image.format == "PNG":
+            # 无损：保留原像素与模式，只提高压缩级别
+            options = {"optimize": True}
+        else:
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+            options = {"optimize": True} if pil_format == "PNG" else {"quality": quality}
+            if pil_format == "WEBP":
+                options["method"] = 4
+        out = io.BytesIO()
+        image.save(out, format=pil_format, **options)
+    encoded = out.getvalue()
+    if len(encoded) >= len(data):
+        return None
+    return encoded, mime_type
+
+
+def _pool() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max(1, app_config.IMAGE_TRANSCODE_WORKERS),
+                                       thread_name_prefix="image-transcode")
+    return _executor
+
+
+def _image_parts(response: Any) -> List[types.Part]:
+    parts = []
+    for candidate in getattr(response, "candidates", None) or []:
+        content = getattr(candidate, "content", None)
+        for part in getattr(content, "parts", None) or []:
+            inline_data = getattr(part, "inline_data", None)
+            if inline_data is not None and inline_data.mime_type in _SOURCE_MIME_TYPES \
+                    and isinstance(inline_data.data, bytes):
+                parts.append(part)
+    return parts
+
+
+async def _transcode_part(part: types.Part, image_format: str) -> None:
+    data = part.inline_data.data
+    started = time.perf_counter()
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(
+            _pool(), _encode, data, image_format, app_config.IMAGE_OUTPUT_QUALITY)
+    except Exception as e:
+        print(f"WARNING: Could not transcode generated image ({len(data)} bytes) to {image_format}: {e}")
+        return
+    IMAGE_TRANSCODE_SECONDS.observe(time.perf_counter() - started, image_format)
+    IMAGE_TRANSCODE_BYTES_TOTAL.inc(image_format, "original", amount=len(data))
+    if result is None:
+        IMAGE_TRANSCODE_BYTES_TOTAL.inc(image_format, "transcoded", amount=len(data))
+        return
+    encoded, mime_type = result
+    IMAGE_TRANSCODE_BYTES_TOTAL.inc(image_format, "transcoded", amount=len(encoded))
+    part.inline_data = types.Blob(data=encoded, mime_type=mime_type)
+
+
+async def transcode_images(response: Any) -> Any:
+    """Re-encode the image parts of a generate_content response (or stream chunk) in place."""
+    image_format = current_format()
+    if image_format == FORMAT_ORIGINAL:
+        return response
+    parts = _image_parts(response)
+    if not parts:
+        return response
+    if Image is None:
+        _warn_once("Output image transcoding requested but Pillow is not installed; images are returned unchanged")
+        return response
+    if image_format == "avif" and not features.check("avif"):
+        _warn_once("Pillow was built without AVIF support; transcoding generated images to WebP instead")
+        image_format = "webp"
+
+    with tracing.span("image_transcode", phase="response_conversion", format=image_format, images=len(parts)):
+        await asyncio.gather(*(_transcode_part(part, image_format) for part in parts))
+    return response
+
+
+def shutdown() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
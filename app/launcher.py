@@ -0,0 +1,189 @@
+"""
+Multi-process launcher.
+
+    python launcher.py [--host 0.0.0.0] [--port 8050] [--workers N]
+
+The master process never imports the app. It starts WORKERS uvicorn worker
+processes and replaces any that exit. uvicorn picks uvloop and httptools
+automatically when they are installed.
+
+Socket modes (WORKER_MODE):
+- prefork (default): the master binds one listening socket and every worker
+  accepts on it.
+- reuseport: each worker binds its own SO_REUSEPORT socket, so the kernel
+  balances connections across workers (Linux/BSD). The worker only starts
+  listening after its startup event has finished (auth init, warmup hooks), so
+  no connection is routed to a worker that is still warming up.
+
+Workers are recycled (graceful exit, then replaced by the master) after
+WORKER_MAX_REQUESTS requests (plus random jitter) or when their RSS exceeds
+WORKER_MAX_RSS_MB.
+"""
+import argparse
+import importlib.util
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+import config as app_config
+
+# 进程启动后很快退出视为崩溃，重启前等待，避免崩溃循环
+_CRASH_WINDOW_SECONDS = 5.0
+_CRASH_BACKOFF_SECONDS = 1.0
+
+
+def _current_rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _watch_rss(server, limit_bytes: int, interval: float) -> None:
+    while not server.should_exit:
+        time.sleep(interval)
+        rss = _current_rss_bytes()
+        if rss is not None and rss > limit_bytes:
+            print(f"WARNING: Worker {os.getpid()} RSS {rss // (1024 * 1024)} MB exceeds "
+                  f"WORKER_MAX_RSS_MB={app_config.WORKER_MAX_RSS_MB}, recycling")
+            server.should_exit = True
+            return
+
+
+def _bind_socket(host: str, port: int, reuse_port: bool) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(host: str, port: int, sock: Optional[socket.socket]) -> None:
+    import uvicorn
+
+    if sock is None:
+        # reuseport 模式：只 bind 不 listen，uvicorn 完成 lifespan 启动后才开始监听
+        sock = _bind_socket(host, port, reuse_port=True)
+
+    max_requests = None
+    if app_config.WORKER_MAX_REQUESTS > 0:
+        max_requests = app_config.WORKER_MAX_REQUESTS + random.randint(0, max(0, app_config.WORKER_MAX_REQUESTS_JITTER))
+
+    config = uvicorn.Config(
+        "main:app",
+        loop="auto",
+        http="auto",
+        limit_max_requests=max_requests,
+        timeout_graceful_shutdown=app_config.WORKER_GRACEFUL_TIMEOUT,
+    )
+    server = uvicorn.Server(config)
+    if app_config.WORKER_MAX_RSS_MB > 0:
+        threading.Thread(
+            target=_watch_rss,
+            args=(server, app_config.WORKER_MAX_RSS_MB * 1024 * 1024, app_config.WORKER_RSS_CHECK_INTERVAL),
+            daemon=True,
+        ).start()
+    server.run(sockets=[sock])
+
+
+class Launcher:
+    def __init__(self, host: str, port: int, workers: int, mode: str):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.mode = mode
+        self._ctx = multiprocessing.get_context("spawn")
+        self._sock: Optional[socket.socket] = None
+        self._processes: Dict[int, multiprocessing.Process] = {}
+        self._started_at: Dict[int, float] = {}
+        self._stopping = threading.Event()
+
+    def _spawn(self, slot: int) -> None:
+        process = self._ctx.Process(target=_run_worker, args=(self.host, self.port, self._sock),
+                                    name=f"worker-{slot}", daemon=False)
+        process.start()
+        self._processes[slot] = process
+        self._started_at[slot] = time.monotonic()
+        print(f"INFO: Started worker {slot} (pid {process.pid})")
+
+    def _handle_signal(self, signum, frame) -> None:
+        self._stopping.set()
+
+    def run(self) -> None:
+        if self.mode == "prefork":
+            self._sock = _bind_socket(self.host, self.port, reuse_port=False)
+            self._sock.listen(2048)
+        loop_impl = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+        http_impl = "httptools" if importlib.util.find_spec("httptools") else "h11"
+        print(f"INFO: Launcher serving {self.host}:{self.port} with {self.workers} worker(s) "
+              f"(mode={self.mode}, loop={loop_impl}, http={http_impl})")
+
+        signal.signal(signal.SIGINT, self._handle_signal)
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        for slot in range(self.workers):
+            self._spawn(slot)
+
+        while not self._stopping.wait(0.5):
+            for slot, process in list(self._processes.items()):
+                if process.is_alive():
+                    continue
+                lifetime = time.monotonic() - self._started_at[slot]
+                print(f"INFO: Worker {slot} (pid {process.pid}) exited with code {process.exitcode} "
+                      f"after {lifetime:.1f}s, restarting")
+                if lifetime < _CRASH_WINDOW_SECONDS and self._stopping.wait(_CRASH_BACKOFF_SECONDS):
+                    break
+                self._spawn(slot)
+        self.shutdown()
+
+    def shutdown(self) -> None:
+        print("INFO: Launcher shutting down workers")
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+        # worker 先排空在途请求（lifecycle.py），再由 uvicorn 优雅退出
+        deadline = (time.monotonic() + app_config.DRAIN_READINESS_DELAY + app_config.DRAIN_TIMEOUT
+                    + (app_config.WORKER_GRACEFUL_TIMEOUT or 30) + 5)
+        for process in self._processes.values():
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                print(f"WARNING: Worker pid {process.pid} did not exit in time, killing")
+                process.kill()
+                process.join()
+        if self._sock is not None:
+            self._sock.close()
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run the adapter with multiple uvicorn worker processes")
+    parser.add_argument("--host", default=app_config.HOST)
+    parser.add_argument("--port", type=int, default=app_config.PORT)
+    parser.add_argument("--workers", type=int, default=app_config.WORKERS)
+    parser.add_argument("--mode", choices=["prefork", "reuseport"], default=app_config.WORKER_MODE)
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.mode == "reuseport" and not hasattr(socket, "SO_REUSEPORT"):
+        print("WARNING: SO_REUSEPORT is not available on this platform, falling back to prefork")
+        args.mode = "prefork"
+    return args
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    # spawn 出的 worker 需要能 import main / config
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    Launcher(args.host, args.port, args.workers, args.mode).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+Readiness and graceful shutdown with connection draining.
+
+On SIGTERM / SIGINT the worker does not exit right away:
+1. /ready starts returning 503, but requests are still served for
+   DRAIN_READINESS_DELAY seconds so load balancers can stop routing here.
+2. New requests are then rejected with 503 + Retry-After + Connection: close,
+   while in-flight requests (including SSE streams) run to completion, for at
+   most DRAIN_TIMEOUT seconds.
+3. Control passes to uvicorn's own exit handling (listeners closed, lifespan
+   shutdown). The shutdown event closes tracked genai clients and pooled HTTP
+   clients, then flushes spans, capture records and logs.
+
+A second signal during the drain skips straight to step 3.
+"""
+import asyncio
+import signal
+import sys
+import time
+import weakref
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, List, Optional
+
+import config as app_config
+
+# 排空期间仍然放行的路径（探针与监控）
+_EXEMPT_PATHS = {"/health", "/ready", "/metrics"}
+
+
+class LifecycleState:
+    def __init__(self):
+        self.ready = True
+        self.accepting = True
+        self.draining = False
+        self.in_flight = 0
+        self.served = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def request_started(self) -> None:
+        self.in_flight += 1
+        self._idle.clear()
+
+    def request_finished(self) -> None:
+        self.in_flight -= 1
+        self.served += 1
+        if self.in_flight == 0:
+            self._idle.set()
+
+    async def wait_idle(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+state = LifecycleState()
+
+# 本进程创建的 genai 客户端（弱引用，请求结束后自动移除）与关闭回调
+_clients: "weakref.WeakSet" = weakref.WeakSet()
+_close_callbacks: List[Callable[[], Awaitable[None]]] = []
+
+
+def track_client(client):
+    """Register a genai client so shutdown can close its connection pools; returns the client."""
+    try:
+        _clients.add(client)
+    except TypeError:
+        pass
+    return client
+
+
+def on_shutdown(callback: Callable[[], Awaitable[None]]) -> Callable[[], Awaitable[None]]:
+    """Register an async close callback for pooled clients (run during the shutdown event)."""
+    _close_callbacks.append(callback)
+    return callback
+
+
+# 当前请求结束（响应全部发送完毕）后要执行的回调，例如释放并发槽位
+_request_end_callbacks: ContextVar[Optional[List[Callable[[], None]]]] = ContextVar(
+    "vertex2openai_request_end_callbacks", default=None)
+
+
+def on_request_end(callback: Callable[[], None]) -> bool:
+    """Run ``callback`` once the current request has finished. Returns False outside a request scope."""
+    callbacks = _request_end_callbacks.get()
+    if callbacks is None:
+        return False
+    callbacks.append(callback)
+    return True
+
+
+@contextmanager
+def request_scope():
+    """Scope for on_request_end callbacks; the middleware opens one per request, background jobs per item."""
+    callbacks: List[Callable[[], None]] = []
+    token = _request_end_callbacks.set(callbacks)
+    try:
+        yield
+    finally:
+        _request_end_callbacks.reset(token)
+        for callback in reversed(callbacks):
+            try:
+                callback()
+            except Exception as e:
+                print(f"WARNING: Request end callback failed: {e}")
+
+
+class LifecycleMiddleware:
+    """Pure ASGI middleware that counts in-flight requests and rejects new ones while draining."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("path") in _EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+        if not state.accepting:
+            await send({
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"retry-after", str(max(1, int(app_config.DRAIN_TIMEOUT))).encode()),
+                    (b"connection", b"close"),
+                ],
+            })
+            await send({
+                "type": "http.response.body",
+                "body": b'{"error":{"code":503,"message":"Server is shutting down","type":"server_error"}}',
+            })
+            return
+        state.request_started()
+        try:
+            with request_scope():
+                await self.app(scope, receive, send)
+        finally:
+            state.request_finished()
+
+
+async def _drain_then_exit(previous_handler, signum: int) -> None:
+    started = time.monotonic()
+    print(f"INFO: Received {signal.Signals(signum).name}, draining ({state.in_flight} request(s) in flight)")
+    if app_config.DRAIN_READINESS_DELAY > 0:
+        await asyncio.sleep(app_config.DRAIN_READINESS_DELAY)
+    state.accepting = False
+    if await state.wait_idle(app_config.DRAIN_TIMEOUT):
+        print(f"INFO: Drain complete after {time.monotonic() - started:.1f}s")
+    else:
+        print(f"WARNING: Drain timeout ({app_config.DRAIN_TIMEOUT}s) reached with {state.in_flight} request(s) still in flight")
+    _hand_over(previous_handler, signum)
+
+
+def _hand_over(previous_handler, signum: int) -> None:
+    if callable(previous_handler):
+        previous_handler(signum, None)
+    else:
+        signal.signal(signum, previous_handler if previous_handler is not None else signal.SIG_DFL)
+        signal.raise_signal(signum)
+
+
+def install_signal_handlers() -> None:
+    """Wrap the server's SIGTERM/SIGINT handlers with the drain sequence (call from the startup event)."""
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        previous_handler = signal.getsignal(signum)
+
+        def handler(sig, frame, previous_handler=previous_handler):
+            if state.draining:
+                # 第二次信号：跳过剩余的排空时间
+                print("WARNING: Second shutdown signal, skipping drain")
+                state.accepting = False
+                _hand_over(previous_handler, sig)
+                return
+            state.draining = True
+            state.ready = False
+            loop.call_soon_threadsafe(lambda: loop.create_task(_drain_then_exit(previous_handler, sig)))
+
+        try:
+            signal.signal(signum, handler)
+        except ValueError:
+            # 不在主线程（例如 TestClient）时无法安装信号处理器
+            return
+
+
+async def close_clients() -> None:
+    # 先取快照：回调可能清空客户端池，快照保证池中的客户端仍会在下面被关闭
+    clients = list(_clients)
+    for callback in _close_callbacks:
+        try:
+            await callback()
+        except Exception as e:
+            print(f"WARNING: Shutdown close callback {getattr(callback, '__name__', callback)} failed: {e}")
+    for client in clients:
+        try:
+            aio = getattr(client, "aio", None)
+            if aio is not None and hasattr(aio, "aclose"):
+                await aio.aclose()
+            if hasattr(client, "close"):
+                client.close()
+        except Exception as e:
+            print(f"WARNING: Failed to close genai client: {e}")
+    if clients:
+        print(f"INFO: Closed {len(clients)} genai client(s)")
+
+
+def flush_logs() -> None:
+    print(f"INFO: Shutdown complete; {state.served} request(s) served, {state.in_flight} still in flight")
+    sys.stdout.flush()
+    sys.stderr.flush()
@@ -1,17 +1,34 @@
 import time
 from fastapi import FastAPI, Depends # Depends might be used by root endpoint
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 
 # Local module imports
 from auth import get_api_key # Potentially for root endpoint
 from credentials_manager import CredentialManager
 from express_key_manager import ExpressKeyManager
 from vertex_ai_init import init_vertex_ai
+import model_loader
+import warmup
+import config as app_config
+from metrics import MetricsMiddleware, render_metrics
+import tracing
+import traffic_capture
+import lifecycle
+import admission
+import batches
+import image_store
+import image_preprocessing
+import image_transcoding
+import compression
 
 # Routers
 from routes import models_api
 from routes import chat_api
 from routes import gemini_api
+from routes import batches_api
+from routes import embeddings_api
+from routes import images_api
 
 app = FastAPI(title="OpenAI to Gemini Adapter")
 
@@ -23,6 +40,27 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 捕获中间件放在 metrics/tracing 内层，才能读到它们的请求上下文
+if traffic_capture.capture_writer is not None:
+    app.add_middleware(traffic_capture.CaptureMiddleware)
+
+# 准入控制在 metrics/tracing 内层：排队时间计入请求延迟，被拒绝的请求也有状态码统计
+if app_config.ADMISSION_ENABLED:
+    app.add_middleware(admission.AdmissionMiddleware)
+
+if app_config.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+if tracing.span_processor is not None or app_config.SERVER_TIMING_ENABLED:
+    app.add_middleware(tracing.TracingMiddleware)
+
+# 压缩在 tracing/metrics/capture 外层：内层看到的都是解压后的请求与未压缩的响应
+if app_config.COMPRESSION_ENABLED:
+    app.add_middleware(compression.CompressionMiddleware)
+
+# 最外层：统计在途请求，关闭排空期间拒绝新请求
+app.add_middleware(lifecycle.LifecycleMiddleware)
+
 credential_manager = CredentialManager()
 app.state.credential_manager = credential_manager # Store manager on app state
 
@@ -33,6 +71,9 @@ app.state.express_key_manager = express_key_manager # Store express key manager
 app.include_router(models_api.router)
 app.include_router(chat_api.router)
 app.include_router(gemini_api.router)
+app.include_router(batches_api.router)
+app.include_router(embeddings_api.router)
+app.include_router(images_api.router)
 
 @app.on_event("startup")
 async def startup_event():
@@ -58,6 +99,43 @@ async def startup_event():
     else:
         print("ERROR: Failed to initialize any authentication method. Both SA credentials and Express API keys are missing. API will fail.")
 
+    # 后台预取并定期刷新模型目录，/v1/models 不再在请求路径上调用 models.list()
+    model_loader.start_catalog_refresher(credential_manager, express_key_manager)
+
+    # 事件循环延迟监测（准入控制的过载判断）
+    admission.controller.start()
+
+    # 预热钩子在 worker 开始接收请求之前执行
+    await warmup.run_startup_hooks(app)
+
+    # 恢复未完成的批处理任务，并定期认领其他 worker 退出后留下的任务
+    batches.runner.start(app)
+
+    # 定期清理过期的生成图片
+    image_store.store.start()
+
+    # SIGTERM/SIGINT 先排空在途请求（含流式响应），再交给 uvicorn 退出
+    lifecycle.install_signal_handlers()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # 关闭后台刷新任务、连接池与 genai 客户端
+    await model_loader.stop_catalog_refresher()
+    await admission.controller.stop()
+    # 暂停批处理任务；已完成的请求都已写入结果文件，下次启动时从断点继续
+    await batches.runner.stop()
+    await image_store.store.stop()
+    image_preprocessing.preprocessor.shutdown()
+    image_transcoding.shutdown()
+    await lifecycle.close_clients()
+    # 导出尚未发送的 trace span
+    if tracing.span_processor is not None:
+        await tracing.span_processor.shutdown()
+    # 写出尚未落盘的流量捕获记录
+    if traffic_capture.capture_writer is not None:
+        await traffic_capture.capture_writer.shutdown()
+    lifecycle.flush_logs()
+
 @app.get("/")
 async def root():
     return {
@@ -73,3 +151,20 @@ async def health_check():
         "status": "healthy",
         "timestamp": time.time()
     }
+
+@app.get("/ready")
+async def readiness_check():
+    """
+    Readiness probe: 503 once a shutdown signal has been received and the worker is draining.
+    """
+    if not lifecycle.state.ready:
+        return JSONResponse(status_code=503, content={"status": "draining", "in_flight": lifecycle.state.in_flight})
+    return {"status": "ready", "in_flight": lifecycle.state.in_flight}
+
+if app_config.METRICS_ENABLED:
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def metrics_endpoint():
+        """
+        Prometheus scrape endpoint. Labels carry key indices only, never key values.
+        """
+        return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
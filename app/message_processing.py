@@ -4,8 +4,10 @@ import json
 import time
 import random # For more unique tool_call_id
 import urllib.parse
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Optional, Tuple
 import config as app_config
+import image_store
+import image_fetch
 
 from google.genai import types
 from models import OpenAIMessage, ContentPartText, ContentPartImage
@@ -64,6 +66,28 @@ def extract_reasoning_by_tags(full_text: str, tag_name: str) -> Tuple[str, str]:
     reasoning_content = "".join(reasoning_parts)
     return reasoning_content.strip(), normal_text.strip()
 
+# Markdown images with data URLs (![alt](data:image/...;base64,...)) or links to the local image store.
+# Only image MIME types are matched to avoid extracting other base64 data.
+MARKDOWN_IMAGE_RE = re.compile(
+    r'!\[[^\]]*\]\((?:data:(image/[^;]+);base64,([^)]+)|([^)\s]*' + re.escape(image_store.IMAGE_PATH_PREFIX) + r'[^)\s]+))\)'
+)
+
+def _image_url_to_part(image_url: str) -> Optional[types.Part]:
+    """image_url 转为 Gemini Part：data: URL 直接解码，本服务的图片链接从图片存储读取，
+    http(s) 图片使用 image_fetch.prefetch_messages() 预先下载的结果；其他 URL 返回 None。"""
+    if image_url.startswith('data:'):
+        mime_match = re.match(r'data:([^;]+);base64,(.+)', image_url)
+        if mime_match:
+            mime_type, b64_data = mime_match.groups()
+            image_bytes = base64.b64decode(b64_data)
+            return types.Part.from_bytes(data=image_bytes, mime_type=mime_type)
+        return None
+    stored = image_store.resolve_url(image_url) or image_fetch.lookup(image_url)
+    if stored is not None:
+        image_bytes, mime_type = stored
+        return types.Part.from_bytes(data=image_bytes, mime_type=mime_type)
+    return None
+
 def _extract_markdown_images_to_parts(text: str) -> Tuple[List[types.Part], str]:
     """
     Extract markdown images from text and convert them to Gemini Parts.
@@ -72,26 +96,22 @@ def _extract_markdown_images_to_parts(text: str) -> Tuple[List[types.Part], str]
     parts = []
     remaining_text = text
     
-    # Pattern to match markdown images with data URLs
-    # Matches: ![alt text](data:image/...;base64,data)
-    # Only matches image MIME types to avoid extracting other base64 data
-    pattern = r'!\[[^\]]*\]\(data:(image/[^;]+);base64,([^)]+)\)'
-    
-    matches = list(re.finditer(pattern, text))
+    matches = list(MARKDOWN_IMAGE_RE.finditer(text))
     
     if matches:
         # Process matches in reverse order to maintain correct text positions
         for match in reversed(matches):
-            mime_type = match.group(1)
-            b64_data = match.group(2)
-            
-            # Validate that it's an image MIME type
-            if not mime_type.startswith('image/'):
-                continue
-            
             try:
-                # Convert base64 to bytes
-                image_bytes = base64.b64decode(b64_data)
+                if match.group(3):
+                    # 本服务返回的图片链接，直接从图片存储读取
+                    stored = image_store.resolve_url(match.group(3))
+                    if stored is None:
+                        continue
+                    image_bytes, mime_type = stored
+                else:
+                    mime_type = match.group(1)
+                    # Convert base64 to bytes
+                    image_bytes = base64.b64decode(match.group(2))
                 # Create Gemini image part
                 parts.append(types.Part.from_bytes(data=image_bytes, mime_type=mime_type))
                 
@@ -189,22 +209,16 @@ def create_gemini_prompt(messages: List[OpenAIMessage]) -> List[types.Content]:
                             elif part_item.get('type') == 'image_url':
                                 image_url_data = part_item.get('image_url', {})
                                 image_url = image_url_data.get('url', '')
-                                if image_url.startswith('data:'):
-                                    mime_match = re.match(r'data:([^;]+);base64,(.+)', image_url)
-                                    if mime_match:
-                                        mime_type, b64_data = mime_match.groups()
-                                        image_bytes = base64.b64decode(b64_data)
-                                        parts.append(types.Part.from_bytes(data=image_bytes, mime_type=mime_type))
+                                image_part = _image_url_to_part(image_url)
+                                if image_part is not None:
+                                    parts.append(image_part)
                         elif isinstance(part_item, ContentPartText):
                              parts.append(types.Part(text=part_item.text))
                         elif isinstance(part_item, ContentPartImage):
                             image_url = part_item.image_url.url
-                            if image_url.startswith('data:'):
-                                mime_match = re.match(r'data:([^;]+);base64,(.+)', image_url)
-                                if mime_match:
-                                    mime_type, b64_data = mime_match.groups()
-                                    image_bytes = base64.b64decode(b64_data)
-                                    parts.append(types.Part.from_bytes(data=image_bytes, mime_type=mime_type))
+                            image_part = _image_url_to_part(image_url)
+                            if image_part is not None:
+                                parts.append(image_part)
             if not parts: 
                 print(f"Skipping assistant message {idx} with empty/invalid tool_calls and no content.")
                 continue
@@ -247,22 +261,16 @@ def create_gemini_prompt(messages: List[OpenAIMessage]) -> List[types.Content]:
                         elif part_item.get('type') == 'image_url':
                             image_url_data = part_item.get('image_url', {})
                             image_url = image_url_data.get('url', '')
-                            if image_url.startswith('data:'):
-                                mime_match = re.match(r'data:([^;]+);base64,(.+)', image_url)
-                                if mime_match:
-                                    mime_type, b64_data = mime_match.groups()
-                                    image_bytes = base64.b64decode(b64_data)
-                                    parts.append(types.Part.from_bytes(data=image_bytes, mime_type=mime_type))
+                            image_part = _image_url_to_part(image_url)
+                            if image_part is not None:
+                                parts.append(image_part)
                     elif isinstance(part_item, ContentPartText):
                         parts.append(types.Part(text=part_item.text))
                     elif isinstance(part_item, ContentPartImage):
                         image_url = part_item.image_url.url
-                        if image_url.startswith('data:'):
-                            mime_match = re.match(r'data:([^;]+);base64,(.+)', image_url)
-                            if mime_match:
-                                mime_type, b64_data = mime_match.groups()
-                                image_bytes = base64.b64decode(b64_data)
-                                parts.append(types.Part.from_bytes(data=image_bytes, mime_type=mime_type))
+                        image_part = _image_url_to_part(image_url)
+                        if image_part is not None:
+                            parts.append(image_part)
             elif message.content is not None: 
                 parts.append(types.Part(text=str(message.content)))
             
@@ -325,7 +333,7 @@ def create_encrypted_gemini_prompt(messages: List[OpenAIMessage]) -> List[types.
                     if isinstance(part_item, dict) and part_item.get('type') == 'text':
                         # Check if text contains markdown images (only image MIME types)
                         text_content = part_item.get('text', '')
-                        if re.search(r'!\[[^\]]*\]\(data:image/[^;]+;base64,[^)]+\)', text_content):
+                        if MARKDOWN_IMAGE_RE.search(text_content):
                             has_images_in_parts = True
                             encoded_parts.append(part_item)  # Keep original if it has images
                         else:
@@ -484,8 +492,11 @@ def deobfuscate_text(text: str) -> str:
     return text
 
 def _convert_image_to_markdown(image_data: bytes, mime_type: str) -> str:
-    """Convert image data to markdown format with base64 encoding."""
+    """Convert image data to markdown: a link to the image store in URL mode, else a base64 data URL."""
     try:
+        stored_url = image_store.image_url(image_data, mime_type)
+        if stored_url:
+            return f"![Image]({stored_url})"
         # Convert bytes to base64 string
         b64_data = base64.b64encode(image_data).decode('utf-8')
         # Create markdown image with data URL
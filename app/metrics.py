@@ -0,0 +1,344 @@
+"""
+Prometheus metrics for the adapter.
+
+Histograms use fixed bucket bounds with array-backed counters, so recording a
+sample on the streaming hot path is one bisect plus two additions. Metrics are
+rendered in the Prometheus text exposition format by the /metrics endpoint.
+
+Per-request labels (model, auth path, stream mode, key index) are attached by
+the route handlers to the RequestMetrics object that MetricsMiddleware puts in
+a context variable; helpers such as record_retry() read it from there so deep
+call sites (retry loops, stream generators) do not need extra parameters.
+"""
+import bisect
+import time
+from array import array
+from contextvars import ContextVar
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+TTFT_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 60.0)
+CHUNK_GAP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0)
+TOKENS_PER_SECOND_BUCKETS = (1.0, 5.0, 10.0, 20.0, 40.0, 60.0, 80.0, 100.0, 150.0, 200.0, 300.0, 500.0)
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape_label_value(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonic counter keyed by a tuple of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def render(self) -> Iterable[str]:
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    """Gauge keyed by a tuple of label values."""
+
+    kind = "gauge"
+
+    def set(self, *labels: str, value: float) -> None:
+        self._values[labels] = value
+
+    def dec(self, *labels: str, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) - amount
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram. Each label set owns an array of per-bucket counts
+    (plus an overflow slot for +Inf); cumulative counts are only computed at
+    render time.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str], buckets: Sequence[float]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [counts array, sum]
+        self._series: Dict[Tuple[str, ...], List[Any]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [array("Q", bytes(8 * (len(self.buckets) + 1))), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def render(self) -> Iterable[str]:
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                label_str = _format_labels(self.label_names, labels, ("le", _format_value(bound)))
+                yield f"{self.name}_bucket{label_str} {cumulative}"
+            label_str = _format_labels(self.label_names, labels)
+            yield f"{self.name}_sum{label_str} {_format_value(total)}"
+            yield f"{self.name}_count{label_str} {cumulative}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[Any] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, label_names: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help_text, label_names))
+
+    def gauge(self, name: str, help_text: str, label_names: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help_text, label_names))
+
+    def histogram(self, name: str, help_text: str, label_names: Sequence[str], buckets: Sequence[float]) -> Histogram:
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+REQUEST_LABELS = ("route", "model", "auth_path", "stream")
+
+REQUESTS_TOTAL = REGISTRY.counter(
+    "vertex2openai_requests_total", "Requests handled, by route, model, auth path, stream mode and HTTP status.",
+    REQUEST_LABELS + ("status",))
+REQUEST_LATENCY = REGISTRY.histogram(
+    "vertex2openai_request_duration_seconds", "End-to-end request latency including the full response stream.",
+    REQUEST_LABELS, LATENCY_BUCKETS)
+TIME_TO_FIRST_TOKEN = REGISTRY.histogram(
+    "vertex2openai_time_to_first_token_seconds", "Time from request arrival to the first streamed body chunk.",
+    ("route", "model", "auth_path"), TTFT_BUCKETS)
+INTER_CHUNK_GAP = REGISTRY.histogram(
+    "vertex2openai_inter_chunk_gap_seconds", "Gap between consecutive streamed body chunks.",
+    ("route", "model", "auth_path"), CHUNK_GAP_BUCKETS)
+OUTPUT_TOKENS_PER_SECOND = REGISTRY.histogram(
+    "vertex2openai_output_tokens_per_second", "Output tokens (from usage metadata) per second of request wall time.",
+    ("route", "model", "auth_path"), TOKENS_PER_SECOND_BUCKETS)
+OUTPUT_TOKENS_TOTAL = REGISTRY.counter(
+    "vertex2openai_output_tokens_total", "Output tokens reported by upstream usage metadata.",
+    ("route", "model", "auth_path"))
+UPSTREAM_ERRORS_TOTAL = REGISTRY.counter(
+    "vertex2openai_upstream_errors_total", "Upstream errors by auth path, key index and error code.",
+    ("auth_path", "key", "code"))
+RETRIES_TOTAL = REGISTRY.counter(
+    "vertex2openai_retries_total", "Upstream call retries.", ("route", "model", "kind"))
+FALLBACKS_TOTAL = REGISTRY.counter(
+    "vertex2openai_fallbacks_total", "Authentication and auto-mode fallbacks.", ("route", "model", "kind"))
+IN_FLIGHT_REQUESTS = REGISTRY.gauge(
+    "vertex2openai_in_flight_requests", "Requests currently being processed.")
+
+
+class RequestMetrics:
+    """Mutable per-request label set and timing marks, filled in by handlers."""
+
+    __slots__ = ("_scope", "_route", "model", "auth_path", "stream", "key", "status",
+                 "is_event_stream", "started_at", "first_chunk_at", "last_chunk_at")
+
+    def __init__(self, scope: Dict[str, Any]):
+        self._scope = scope
+        self._route: Optional[str] = None
+        self.model = ""
+        self.auth_path = ""
+        self.stream = False
+        self.key = ""
+        self.status = 500
+        self.is_event_stream = False
+        self.started_at = time.perf_counter()
+        self.first_chunk_at: Optional[float] = None
+        self.last_chunk_at: Optional[float] = None
+
+    @property
+    def route(self) -> str:
+        # The router fills scope["route"] before the endpoint runs; resolve lazily and cache.
+        if self._route is None:
+            template = _route_template(self._scope)
+            if template == "unmatched":
+                return template
+            self._route = template
+        return self._route
+
+    def labels(self) -> Tuple[str, str, str]:
+        return self.route, self.model, self.auth_path
+
+    def mark_chunk(self) -> None:
+        now = time.perf_counter()
+        if self.first_chunk_at is None:
+            self.first_chunk_at = now
+            if self.is_event_stream:
+                TIME_TO_FIRST_TOKEN.observe(now - self.started_at, *self.labels())
+        elif self.is_event_stream:
+            INTER_CHUNK_GAP.observe(now - self.last_chunk_at, *self.labels())
+        self.last_chunk_at = now
+
+    def finish(self) -> None:
+        stream_label = "true" if self.stream else "false"
+        REQUESTS_TOTAL.inc(self.route, self.model, self.auth_path, stream_label, str(self.status))
+        REQUEST_LATENCY.observe(time.perf_counter() - self.started_at, self.route, self.model, self.auth_path, stream_label)
+
+
+_current_request: ContextVar[Optional[RequestMetrics]] = ContextVar("vertex2openai_request_metrics", default=None)
+
+
+def current_request() -> Optional[RequestMetrics]:
+    return _current_request.get()
+
+
+def set_request_labels(model: Optional[str] = None, auth_path: Optional[str] = None,
+                       stream: Optional[bool] = None, key: Optional[str] = None) -> None:
+    """Attach routing decisions to the current request. No-op outside a request."""
+    ctx = _current_request.get()
+    if ctx is None:
+        return
+    if model is not None:
+        ctx.model = model
+    if auth_path is not None:
+        ctx.auth_path = auth_path
+    if stream is not None:
+        ctx.stream = stream
+    if key is not None:
+        ctx.key = key
+
+
+def _labels_or_defaults() -> Tuple[str, str, str, str]:
+    ctx = _current_request.get()
+    if ctx is None:
+        return "", "", "", ""
+    return ctx.route, ctx.model, ctx.auth_path, ctx.key
+
+
+def error_code(error: BaseException) -> str:
+    """Best-effort HTTP status for an upstream exception, or the exception type name."""
+    for candidate in (getattr(error, "code", None), getattr(error, "status_code", None),
+                      getattr(getattr(error, "response", None), "status_code", None)):
+        if isinstance(candidate, int):
+            return str(candidate)
+    return type(error).__name__
+
+
+def record_upstream_error(error: BaseException) -> None:
+    _, _, auth_path, key = _labels_or_defaults()
+    UPSTREAM_ERRORS_TOTAL.inc(auth_path, key, error_code(error))
+
+
+def record_retry(kind: str) -> None:
+    route, model, _, _ = _labels_or_defaults()
+    RETRIES_TOTAL.inc(route, model, kind)
+
+
+def record_fallback(kind: str) -> None:
+    route, model, _, _ = _labels_or_defaults()
+    FALLBACKS_TOTAL.inc(route, model, kind)
+
+
+def output_tokens_from_usage(usage_metadata: Any) -> int:
+    """Read candidates_token_count from a Gemini usage_metadata object (0 if absent)."""
+    if usage_metadata is None:
+        return 0
+    return getattr(usage_metadata, "candidates_token_count", None) or 0
+
+
+def record_output_tokens(output_tokens: int) -> None:
+    ctx = _current_request.get()
+    if ctx is None or not output_tokens:
+        return
+    OUTPUT_TOKENS_TOTAL.inc(*ctx.labels(), amount=output_tokens)
+    elapsed = time.perf_counter() - ctx.started_at
+    if elapsed > 0:
+        OUTPUT_TOKENS_PER_SECOND.observe(output_tokens / elapsed, *ctx.labels())
+
+
+def _route_template(scope: Dict[str, Any]) -> str:
+    path = getattr(scope.get("route"), "path", None)
+    if path:
+        return path
+    return scope.get("path", "unmatched") if "endpoint" in scope else "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware that times every HTTP request. Because the wrapped app
+    only returns after the last body chunk has been sent, latency covers the
+    whole stream; each non-empty body message counts as a chunk for TTFT and
+    inter-chunk gap histograms.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        ctx = RequestMetrics(scope)
+        token = _current_request.set(ctx)
+        IN_FLIGHT_REQUESTS.inc()
+
+        async def send_with_metrics(message):
+            if message["type"] == "http.response.start":
+                ctx.status = message["status"]
+                for name, value in message.get("headers", []):
+                    if name.lower() == b"content-type" and value.startswith(b"text/event-stream"):
+                        ctx.is_event_stream = True
+                        break
+            elif message["type"] == "http.response.body" and message.get("body"):
+                ctx.mark_chunk()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            IN_FLIGHT_REQUESTS.dec()
+            _current_request.reset(token)
+            ctx.finish()
+
+
+def render_metrics() -> str:
+    return REGISTRY.render()
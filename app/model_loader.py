@@ -2,12 +2,14 @@ import httpx
 import asyncio
 import json
 import os
+import time
 from typing import List, Dict, Optional, Any
 
 from google import genai
 from google.genai import types
 
 import config as app_config
+import shared_state
 
 def _get_local_models_config_path() -> Optional[str]:
     """
@@ -30,9 +32,23 @@ def _get_local_models_config_path() -> Optional[str]:
     
     return None
 
+# 模型目录缓存：配置缓存与原生模型缓存各用一把锁，锁只保护刷新本身，读取从不等待锁
 _model_cache: Optional[Dict[str, List[str]]] = None
 _native_model_cache: Optional[List[str]] = None
-_cache_lock = asyncio.Lock()
+_config_lock = asyncio.Lock()
+_native_lock = asyncio.Lock()
+_config_fetched_at = 0.0
+_native_fetched_at = 0.0
+_config_refresh_task: Optional[asyncio.Task] = None
+_native_refresh_task: Optional[asyncio.Task] = None
+_refresher_task: Optional[asyncio.Task] = None
+# 目录内容每变化一次加一，供依赖目录的派生数据判断是否过期
+_catalog_version = 0
+
+# 远程配置的条件请求校验值（ETag / Last-Modified）与本地文件 mtime
+_remote_validators: Dict[str, str] = {}
+_local_config_mtime: Optional[float] = None
+_http_client: Optional[httpx.AsyncClient] = None
 
 # 默认支持的 Gemini 模型列表（当 API 不可用时使用）
 DEFAULT_GEMINI_MODELS = [
@@ -50,6 +66,13 @@ DEFAULT_GEMINI_MODELS = [
     "gemini-3-pro-preview",
 ]
 
+# 常用的 Vertex 嵌入模型（不在 Gemini 模型列表中）
+DEFAULT_EMBEDDING_MODELS = [
+    "gemini-embedding-001",
+    "text-embedding-005",
+    "text-multilingual-embedding-002",
+]
+
 # 别名模型配置 - 自动注入 thinking 配置
 ALIAS_MODELS = {
     "gemini-3-pro-preview-high": {
@@ -70,35 +93,53 @@ def get_alias_models() -> dict:
     return ALIAS_MODELS
 
 
+def _list_native_models_sync(credentials, project_id) -> List[str]:
+    """在线程中执行：models.list() 是同步分页迭代，会阻塞事件循环"""
+    client = genai.Client(
+        vertexai=True,
+        credentials=credentials,
+        project=project_id,
+        location="global"
+    )
+    models = []
+    for model in client.models.list():
+        model_name = model.name if hasattr(model, 'name') else str(model)
+        if model_name.startswith("models/"):
+            model_name = model_name[7:]
+        if "gemini" in model_name.lower():
+            models.append(model_name)
+    return sorted(set(models))
+
+
+async def _fetch_native_models_from_api(credential_manager) -> Optional[List[str]]:
+    """使用 SA 凭证调用 models.list()；没有可用凭证或调用失败时返回 None"""
+    if not credential_manager or credential_manager.get_total_credentials() == 0:
+        return None
+    credentials, project_id = credential_manager.get_credentials()
+    if not credentials or not project_id:
+        return None
+    try:
+        models = await asyncio.to_thread(_list_native_models_sync, credentials, project_id)
+        print(f"Fetched {len(models)} models using SA credentials")
+        return models
+    except Exception as e:
+        print(f"WARNING: Failed to fetch models with SA credentials: {e}")
+        return None
+
+
 async def fetch_native_models_with_credentials(credential_manager, express_key_manager) -> List[str]:
     """
     使用凭证从 Vertex AI API 获取模型列表，返回模型 ID 列表
     Express API Key 不支持 models.list()，所以优先使用 SA 凭证
     """
-    models = []
-    
     # 优先尝试使用 SA 凭证（因为 Express Key 不支持 models.list）
-    if credential_manager and credential_manager.get_total_credentials() > 0:
-        credentials, project_id = credential_manager.get_credentials()
-        if credentials and project_id:
-            try:
-                client = genai.Client(
-                    vertexai=True,
-                    credentials=credentials,
-                    project=project_id,
-                    location="global"
-                )
-                for model in client.models.list():
-                    model_name = model.name if hasattr(model, 'name') else str(model)
-                    if model_name.startswith("models/"):
-                        model_name = model_name[7:]
-                    if "gemini" in model_name.lower():
-                        models.append(model_name)
-                print(f"Fetched {len(models)} models using SA credentials")
-                return list(set(models))
-            except Exception as e:
-                print(f"WARNING: Failed to fetch models with SA credentials: {e}")
-    
+    models = await _fetch_native_models_from_api(credential_manager)
+    if models is not None:
+        return models
+    return _default_native_models(express_key_manager)
+
+
+def _default_native_models(express_key_manager) -> List[str]:
     # Express API Key 不支持 models.list()，使用默认模型列表
     if express_key_manager and express_key_manager.get_total_keys() > 0:
         print(f"INFO: Express API Key does not support models.list(), using default model list ({len(DEFAULT_GEMINI_MODELS)} models)")
@@ -109,6 +150,17 @@ async def fetch_native_models_with_credentials(credential_manager, express_key_m
     return DEFAULT_GEMINI_MODELS.copy()
 
 
+def _parse_models_config(data: Any) -> Optional[Dict[str, List[str]]]:
+    if isinstance(data, dict) and \
+       "vertex_models" in data and isinstance(data["vertex_models"], list) and \
+       "vertex_express_models" in data and isinstance(data["vertex_express_models"], list):
+        return {
+            "vertex_models": data["vertex_models"],
+            "vertex_express_models": data["vertex_express_models"]
+        }
+    return None
+
+
 def load_local_models_config() -> Optional[Dict[str, List[str]]]:
     """
     从本地 vertexModels.json 文件加载模型配置。
@@ -124,14 +176,10 @@ def load_local_models_config() -> Optional[Dict[str, List[str]]]:
         with open(config_path, 'r', encoding='utf-8') as f:
             data = json.load(f)
         
-        if isinstance(data, dict) and \
-           "vertex_models" in data and isinstance(data["vertex_models"], list) and \
-           "vertex_express_models" in data and isinstance(data["vertex_express_models"], list):
-            print(f"Successfully loaded local model configuration: {len(data['vertex_models'])} vertex models, {len(data['vertex_express_models'])} express models.")
-            return {
-                "vertex_models": data["vertex_models"],
-                "vertex_express_models": data["vertex_express_models"]
-            }
+        parsed = _parse_models_config(data)
+        if parsed is not None:
+            print(f"Successfully loaded local model configuration: {len(parsed['vertex_models'])} vertex models, {len(parsed['vertex_express_models'])} express models.")
+            return parsed
         else:
             print(f"ERROR: Local model configuration has an invalid structure: {data}")
             return None
@@ -143,41 +191,67 @@ def load_local_models_config() -> Optional[Dict[str, List[str]]]:
         return None
 
 
+def _get_http_client() -> httpx.AsyncClient:
+    """复用同一个 httpx 客户端拉取远程配置（保持连接，避免每次刷新重新握手）"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(timeout=30)
+    return _http_client
+
+
 async def fetch_and_parse_models_config() -> Optional[Dict[str, List[str]]]:
     """
     获取模型配置。优先从本地文件加载，如果本地文件不存在且配置了远程 URL 则从远程获取。
     Parses it and returns a dictionary with 'vertex_models' and 'vertex_express_models'.
     Returns None if fetching or parsing fails.
+    本地文件 mtime 未变化、或远程返回 304 Not Modified 时直接返回当前缓存。
     """
+    global _local_config_mtime
     # 优先尝试从本地文件加载
-    local_config = load_local_models_config()
-    if local_config is not None:
-        return local_config
+    local_path = _get_local_models_config_path()
+    if local_path is not None:
+        try:
+            mtime = os.path.getmtime(local_path)
+        except OSError:
+            mtime = None
+        if _model_cache is not None and mtime is not None and mtime == _local_config_mtime:
+            return _model_cache
+        local_config = load_local_models_config()
+        if local_config is not None:
+            _local_config_mtime = mtime
+            return local_config
     
     # 如果本地文件不存在，尝试从远程 URL 获取
     if not app_config.MODELS_CONFIG_URL:
         print("INFO: MODELS_CONFIG_URL is not set and local config not found, will use default model list.")
         return None
 
+    headers = {}
+    if _model_cache is not None:
+        if "etag" in _remote_validators:
+            headers["If-None-Match"] = _remote_validators["etag"]
+        if "last-modified" in _remote_validators:
+            headers["If-Modified-Since"] = _remote_validators["last-modified"]
+
     print(f"Fetching model configuration from remote URL: {app_config.MODELS_CONFIG_URL}")
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(app_config.MODELS_CONFIG_URL)
-            response.raise_for_status()
-            data = response.json()
-            
-            if isinstance(data, dict) and \
-               "vertex_models" in data and isinstance(data["vertex_models"], list) and \
-               "vertex_express_models" in data and isinstance(data["vertex_express_models"], list):
-                print("Successfully fetched and parsed remote model configuration.")
-                return {
-                    "vertex_models": data["vertex_models"],
-                    "vertex_express_models": data["vertex_express_models"]
-                }
-            else:
-                print(f"ERROR: Fetched model configuration has an invalid structure: {data}")
-                return None
-    except httpx.RequestError as e:
+        response = await _get_http_client().get(app_config.MODELS_CONFIG_URL, headers=headers)
+        if response.status_code == 304 and _model_cache is not None:
+            print("INFO: Remote model configuration not modified (304), keeping cached copy.")
+            return _model_cache
+        response.raise_for_status()
+        data = _parse_models_config(response.json())
+        if data is not None:
+            _remote_validators.clear()
+            for name in ("etag", "last-modified"):
+                if name in response.headers:
+                    _remote_validators[name] = response.headers[name]
+            print("Successfully fetched and parsed remote model configuration.")
+            return data
+        else:
+            print(f"ERROR: Fetched model configuration has an invalid structure: {response.text[:500]}")
+            return None
+    except httpx.HTTPError as e:
         print(f"ERROR: HTTP request failed while fetching model configuration: {e}")
         return None
     except json.JSONDecodeError as e:
@@ -188,20 +262,112 @@ async def fetch_and_parse_models_config() -> Optional[Dict[str, List[str]]]:
         return None
 
 
+def catalog_version() -> int:
+    """模型目录版本号，配置或原生模型列表内容变化时递增"""
+    return _catalog_version
+
+
+def known_model_names() -> List[str]:
+    """当前目录中的全部模型名（配置、原生列表、默认列表与别名），用于限定 metrics 标签的取值"""
+    names = DEFAULT_GEMINI_MODELS + DEFAULT_EMBEDDING_MODELS + list(ALIAS_MODELS)
+    if _model_cache:
+        names += _model_cache.get("vertex_models", []) + _model_cache.get("vertex_express_models", [])
+    if _native_model_cache:
+        names += _native_model_cache
+    return names
+
+
+def _is_stale(fetched_at: float) -> bool:
+    interval = app_config.MODELS_REFRESH_INTERVAL
+    return interval > 0 and time.monotonic() - fetched_at >= interval
+
+
+async def _refresh_models_config(force: bool) -> bool:
+    global _model_cache, _config_fetched_at, _catalog_version
+    async with _config_lock:
+        # 冷启动时多个请求同时到达：后进入的直接使用前一个的结果
+        if not force and _model_cache is not None:
+            return True
+        new_config = await fetch_and_parse_models_config()
+        _config_fetched_at = time.monotonic()
+        if new_config is None:
+            return False
+        if new_config != _model_cache:
+            _model_cache = new_config
+            _catalog_version += 1
+        return True
+
+
+async def _refresh_native_models(credential_manager, express_key_manager, force: bool) -> bool:
+    global _native_model_cache, _native_fetched_at, _catalog_version
+    async with _native_lock:
+        if not force and _native_model_cache is not None:
+            return True
+        models = await asyncio.to_thread(_load_shared_native_models)
+        if models is None:
+            models = await _fetch_native_models_from_api(credential_manager)
+            if models:
+                await asyncio.to_thread(_publish_shared_native_models, models)
+        _native_fetched_at = time.monotonic()
+        if models is None or not models:
+            if _native_model_cache:
+                # 刷新失败时继续提供旧列表，而不是退回默认列表
+                print("WARNING: Native model list refresh failed, keeping the previous list.")
+                return False
+            models = _default_native_models(express_key_manager)
+        if models != _native_model_cache:
+            _native_model_cache = models
+            _catalog_version += 1
+        return len(models) > 0
+
+
+def _load_shared_native_models() -> Optional[List[str]]:
+    """其它 worker 在刷新间隔内拉取过的列表（仅共享状态后端）"""
+    if not shared_state.backend.shared:
+        return None
+    cached = shared_state.backend.get("model_catalog", "native_models")
+    if not cached:
+        return None
+    try:
+        return json.loads(cached)
+    except json.JSONDecodeError:
+        return None
+
+
+def _publish_shared_native_models(models: List[str]) -> None:
+    if shared_state.backend.shared:
+        ttl = app_config.MODELS_REFRESH_INTERVAL if app_config.MODELS_REFRESH_INTERVAL > 0 else 3600
+        shared_state.backend.set("model_catalog", "native_models", json.dumps(models), ttl=ttl)
+
+
+def _schedule_config_refresh() -> None:
+    global _config_refresh_task
+    if _config_refresh_task is None or _config_refresh_task.done():
+        _config_refresh_task = asyncio.get_running_loop().create_task(_refresh_models_config(force=True))
+
+
+def _schedule_native_refresh(credential_manager, express_key_manager) -> None:
+    global _native_refresh_task
+    if _native_refresh_task is None or _native_refresh_task.done():
+        _native_refresh_task = asyncio.get_running_loop().create_task(
+            _refresh_native_models(credential_manager, express_key_manager, force=True)
+        )
+
+
 async def get_models_config() -> Dict[str, List[str]]:
     """
     Returns the cached model configuration.
-    If not cached, fetches and caches it.
+    If not cached, fetches and caches it; if stale, returns it and revalidates in the background.
     Returns a default empty structure if fetching fails.
     """
     global _model_cache
-    async with _cache_lock:
-        if _model_cache is None:
-            print("Model cache is empty. Fetching configuration...")
-            _model_cache = await fetch_and_parse_models_config()
-            if _model_cache is None:
-                print("WARNING: Using default empty model configuration due to fetch/parse failure.")
-                _model_cache = {"vertex_models": [], "vertex_express_models": []}
+    if _model_cache is None:
+        print("Model cache is empty. Fetching configuration...")
+        if not await _refresh_models_config(force=False) and _model_cache is None:
+            print("WARNING: Using default empty model configuration due to fetch/parse failure.")
+            _model_cache = {"vertex_models": [], "vertex_express_models": []}
+    elif _is_stale(_config_fetched_at):
+        _schedule_config_refresh()
     return _model_cache
 
 
@@ -218,14 +384,12 @@ async def get_vertex_express_models() -> List[str]:
 async def get_native_models(credential_manager=None, express_key_manager=None) -> List[str]:
     """
     从 Vertex AI API 原生获取模型列表
-    优先使用缓存，如果缓存为空则从 API 获取
+    优先使用缓存（过期时先返回旧数据并在后台刷新），如果缓存为空则从 API 获取
     """
-    global _native_model_cache
-    async with _cache_lock:
-        if _native_model_cache is None:
-            _native_model_cache = await fetch_native_models_with_credentials(
-                credential_manager, express_key_manager
-            )
+    if _native_model_cache is None:
+        await _refresh_native_models(credential_manager, express_key_manager, force=False)
+    elif _is_stale(_native_fetched_at):
+        _schedule_native_refresh(credential_manager, express_key_manager)
     return _native_model_cache or []
 
 
@@ -233,12 +397,7 @@ async def refresh_native_models_cache(credential_manager=None, express_key_manag
     """
     强制刷新原生模型列表缓存
     """
-    global _native_model_cache
-    async with _cache_lock:
-        _native_model_cache = await fetch_native_models_with_credentials(
-            credential_manager, express_key_manager
-        )
-        return len(_native_model_cache) > 0
+    return await _refresh_native_models(credential_manager, express_key_manager, force=True)
 
 
 async def refresh_models_config_cache() -> bool:
@@ -246,14 +405,41 @@ async def refresh_models_config_cache() -> bool:
     Forces a refresh of the model configuration cache.
     Returns True if successful, False otherwise.
     """
-    global _model_cache
     print("Attempting to refresh model configuration cache...")
-    async with _cache_lock:
-        new_config = await fetch_and_parse_models_config()
-        if new_config is not None:
-            _model_cache = new_config
-            print("Model configuration cache refreshed successfully.")
-            return True
-        else:
-            print("ERROR: Failed to refresh model configuration cache.")
-            return False
\ No newline at end of file
+    if await _refresh_models_config(force=True):
+        print("Model configuration cache refreshed successfully.")
+        return True
+    else:
+        print("ERROR: Failed to refresh model configuration cache.")
+        return False
+
+
+async def _catalog_refresh_loop(credential_manager, express_key_manager) -> None:
+    while True:
+        await asyncio.sleep(app_config.MODELS_REFRESH_INTERVAL)
+        try:
+            await _refresh_models_config(force=True)
+            await _refresh_native_models(credential_manager, express_key_manager, force=True)
+        except Exception as e:
+            print(f"WARNING: Background model catalog refresh failed: {e}")
+
+
+def start_catalog_refresher(credential_manager, express_key_manager) -> None:
+    """启动时在后台预取原生模型列表，并按 MODELS_REFRESH_INTERVAL 定期刷新目录"""
+    global _refresher_task
+    _schedule_native_refresh(credential_manager, express_key_manager)
+    if app_config.MODELS_REFRESH_INTERVAL > 0 and (_refresher_task is None or _refresher_task.done()):
+        _refresher_task = asyncio.get_running_loop().create_task(
+            _catalog_refresh_loop(credential_manager, express_key_manager)
+        )
+
+
+async def stop_catalog_refresher() -> None:
+    global _refresher_task, _http_client
+    for task in (_refresher_task, _config_refresh_task, _native_refresh_task):
+        if task is not None and not task.done():
+            task.cancel()
+    _refresher_task = None
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
@@ -0,0 +1,275 @@
+"""
+Model-string routing.
+
+A requested model string such as ``[EXPRESS] gemini-2.5-pro-nothinking`` encodes
+the auth path, prompt strategy and thinking/image/tool options. compile_model_route()
+resolves it once into an immutable ModelRoute; results are kept in a bounded LRU
+cache and shared by the OpenAI-compatible and Gemini-native routers.
+
+Per-model behaviour (thinking budgets, whether thoughts are shown, which Express
+endpoint to use) comes from the capability registry below instead of ad-hoc
+substring checks at each call site.
+
+model_label() maps a base model to the value used for per-model metric labels
+and limiter keys: the model itself if it is in the catalog, else "other", so
+arbitrary client-supplied model strings cannot grow /metrics or the limiter
+tables without bound.
+"""
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import config as app_config
+from model_loader import ALIAS_MODELS, catalog_version, known_model_names
+
+# 模型名前缀/后缀标记
+EXPRESS_PREFIX = "[EXPRESS] "  # Note the space for easier stripping
+PAY_PREFIX = "[PAY]"
+OPENAI_DIRECT_SUFFIX = "-openai"
+OPENAI_SEARCH_SUFFIX = "-openaisearch"
+EXPERIMENTAL_MARKER = "-exp-"
+
+# 后缀 -> variant，顺序即剥离优先级（-encrypt-full 必须在 -encrypt 之前）
+VARIANT_SUFFIXES = (
+    ("-auto", "auto"),
+    ("-search", "search"),
+    ("-encrypt-full", "encrypt_full"),
+    ("-encrypt", "encrypt"),
+    ("-nothinking", "nothinking"),
+    ("-max", "max"),
+    ("-2k", "2k"),
+    ("-4k", "4k"),
+)
+
+# 输出图片格式后缀，最先剥离，可与上面的后缀组合（如 gemini-2.5-flash-image-2k-webp）
+IMAGE_FORMAT_SUFFIXES = (
+    ("-webp", "webp"),
+    ("-avif", "avif"),
+    ("-png", "png"),
+)
+
+# auth_path 取值
+AUTH_OPENAI_DIRECT_EXPRESS = "openai_direct_express"
+AUTH_OPENAI_DIRECT_SA = "openai_direct_sa"
+AUTH_EXPRESS = "express"
+AUTH_SA_WITH_EXPRESS_FALLBACK = "sa_or_express"
+
+# prompt_strategy 取值
+PROMPT_STANDARD = "standard"
+PROMPT_ENCRYPT = "encrypt"
+PROMPT_ENCRYPT_FULL = "encrypt_full"
+PROMPT_AUTO = "auto"
+PROMPT_OPENAI_DIRECT = "openai_direct"
+
+
+@dataclass(frozen=True)
+class ModelCapabilities:
+    family: str
+    # Model emits thoughts (2.5 / 3 families); thoughts are requested by default
+    thinking: bool = False
+    # Thoughts are hidden unless -max is used (flash-lite)
+    thoughts_off_by_default: bool = False
+    # Budgets used by the -nothinking / -max variants
+    min_thinking_budget: int = 0
+    max_thinking_budget: int = 24576
+    # Express keys must call the project-scoped global endpoint (needs project ID discovery)
+    express_project_endpoint: bool = False
+    # Image generation model (thoughts are not requested)
+    image_output: bool = False
+    # Max inputs per upstream embedding call (Vertex :predict instances); 0 = not an embedding model
+    embedding_batch_size: int = 0
+
+
+# Ordered most specific first; a family matches when its key occurs in the model name.
+MODEL_CAPABILITY_REGISTRY: Tuple[Tuple[str, ModelCapabilities], ...] = (
+    # Vertex 上 gemini-embedding 每次请求只接受一条输入
+    ("gemini-embedding", ModelCapabilities("gemini-embedding", embedding_batch_size=1)),
+    ("text-embedding", ModelCapabilities("text-embedding", embedding_batch_size=250)),
+    ("text-multilingual-embedding", ModelCapabilities("text-multilingual-embedding", embedding_batch_size=250)),
+    ("gemini-2.5-flash-lite", ModelCapabilities("gemini-2.5-flash-lite", thinking=True, thoughts_off_by_default=True,
+                                                express_project_endpoint=True)),
+    ("gemini-2.5-flash", ModelCapabilities("gemini-2.5-flash", thinking=True, express_project_endpoint=True)),
+    ("gemini-2.5-pro", ModelCapabilities("gemini-2.5-pro", thinking=True, min_thinking_budget=128,
+                                         max_thinking_budget=32768, express_project_endpoint=True)),
+    ("gemini-3-pro", ModelCapabilities("gemini-3-pro", thinking=True, min_thinking_budget=128,
+                                       max_thinking_budget=32768, express_project_endpoint=True)),
+    ("gemini-3", ModelCapabilities("gemini-3", thinking=True, express_project_endpoint=True)),
+)
+_DEFAULT_FAMILY = "default"
+
+
+@lru_cache(maxsize=256)
+def model_capabilities(model_name: str) -> ModelCapabilities:
+    """Look up capabilities for a bare model name (no prefixes/suffixes)."""
+    image_output = "image" in model_name
+    for key, caps in MODEL_CAPABILITY_REGISTRY:
+        if key in model_name:
+            if image_output:
+                return ModelCapabilities(**{**caps.__dict__, "image_output": True})
+            return caps
+    return ModelCapabilities(_DEFAULT_FAMILY, image_output=image_output)
+
+
+@dataclass(frozen=True)
+class ModelRoute:
+    model: str                      # model string as requested
+    base_model: str                 # model name sent to Vertex
+    auth_path: str                  # one of the AUTH_* constants
+    prompt_strategy: str            # one of the PROMPT_* constants
+    variant: Optional[str]          # suffix variant (auto, search, nothinking, ...) or None
+    express: bool                   # explicit [EXPRESS] prefix
+    pay: bool                       # [PAY] prefix
+    openai_search: bool             # -openaisearch (OpenAI direct path only)
+    capabilities: ModelCapabilities
+    # thinking_config contributions; None means "leave unset"
+    include_thoughts: Optional[bool] = None
+    thinking_budget: Optional[int] = None
+    thinking_level: Optional[str] = None
+    # image generation (-2k / -4k)
+    image_size: Optional[str] = None
+    # built-in tools to attach, e.g. ("google_search",)
+    tools: Tuple[str, ...] = ()
+    # output image format requested by suffix (-webp / -avif / -png)
+    image_format: Optional[str] = None
+
+    @property
+    def is_openai_direct(self) -> bool:
+        return self.prompt_strategy == PROMPT_OPENAI_DIRECT
+
+
+def _strip_prefixes(name: str) -> Tuple[str, bool, bool]:
+    express = pay = False
+    if name.startswith(EXPRESS_PREFIX):
+        express = True
+        name = name[len(EXPRESS_PREFIX):]
+    if name.startswith(PAY_PREFIX):
+        pay = True
+        name = name[len(PAY_PREFIX):]
+    return name, express, pay
+
+
+def split_image_format_suffix(model: str) -> Tuple[str, Optional[str]]:
+    """Strip an output image format suffix: ("gemini-2.5-flash-image-webp") -> ("gemini-2.5-flash-image", "webp")."""
+    for suffix, image_format in IMAGE_FORMAT_SUFFIXES:
+        if model.endswith(suffix):
+            return model[:-len(suffix)], image_format
+    return model, None
+
+
+def _compile(model: str) -> ModelRoute:
+    # OpenAI Direct: -openai / -openaisearch 且带 [PAY]、[EXPRESS] 前缀或 -exp- 标记
+    if model.endswith(OPENAI_DIRECT_SUFFIX) or model.endswith(OPENAI_SEARCH_SUFFIX):
+        openai_search = model.endswith(OPENAI_SEARCH_SUFFIX)
+        suffix = OPENAI_SEARCH_SUFFIX if openai_search else OPENAI_DIRECT_SUFFIX
+        without_suffix = model[:-len(suffix)]
+        if without_suffix.startswith(PAY_PREFIX) or without_suffix.startswith(EXPRESS_PREFIX) \
+                or EXPERIMENTAL_MARKER in without_suffix:
+            base_model, express, pay = _strip_prefixes(without_suffix)
+            return ModelRoute(
+                model=model,
+                base_model=base_model,
+                auth_path=AUTH_OPENAI_DIRECT_EXPRESS if express else AUTH_OPENAI_DIRECT_SA,
+                prompt_strategy=PROMPT_OPENAI_DIRECT,
+                variant="openaisearch" if openai_search else "openai",
+                express=express,
+                pay=pay,
+                openai_search=openai_search,
+                capabilities=model_capabilities(base_model),
+            )
+
+    requested_model = model
+    model, image_format = split_image_format_suffix(model)
+
+    # 别名模型只按完整名称匹配（带前缀的别名不解析）
+    base_model = model
+    thinking_level = None
+    if base_model in ALIAS_MODELS:
+        alias_config = ALIAS_MODELS[base_model]
+        base_model = alias_config["base_model"]
+        thinking_level = alias_config.get("thinking_level")
+
+    base_model, express, pay = _strip_prefixes(base_model)
+
+    variant = None
+    for suffix, name in VARIANT_SUFFIXES:
+        if model.endswith(suffix):
+            variant = name
+            if base_model.endswith(suffix):
+                base_model = base_model[:-len(suffix)]
+            break
+
+    caps = model_capabilities(base_model)
+
+    if variant == "auto":
+        prompt_strategy = PROMPT_AUTO
+    elif variant == "encrypt":
+        prompt_strategy = PROMPT_ENCRYPT
+    elif variant == "encrypt_full":
+        prompt_strategy = PROMPT_ENCRYPT_FULL
+    else:
+        prompt_strategy = PROMPT_STANDARD
+
+    thinking_budget = None
+    if prompt_strategy == PROMPT_AUTO:
+        # auto 模式只使用模型族的默认设置
+        include_thoughts = None
+        if caps.thinking or thinking_level:
+            include_thoughts = not caps.thoughts_off_by_default
+    else:
+        if caps.thoughts_off_by_default and variant == "max":
+            include_thoughts = True
+        elif caps.thoughts_off_by_default or caps.image_output:
+            include_thoughts = False
+        else:
+            include_thoughts = True
+        if variant == "nothinking":
+            thinking_budget = caps.min_thinking_budget
+        elif variant == "max":
+            thinking_budget = caps.max_thinking_budget
+        if thinking_budget == 0:
+            include_thoughts = False
+
+    return ModelRoute(
+        model=requested_model,
+        base_model=base_model,
+        auth_path=AUTH_EXPRESS if express else AUTH_SA_WITH_EXPRESS_FALLBACK,
+        prompt_strategy=prompt_strategy,
+        variant=variant,
+        express=express,
+        pay=pay,
+        openai_search=model.endswith(OPENAI_SEARCH_SUFFIX),
+        capabilities=caps,
+        include_thoughts=include_thoughts,
+        thinking_budget=thinking_budget,
+        thinking_level=thinking_level,
+        image_size=variant if variant in ("2k", "4k") else None,
+        tools=("google_search",) if variant == "search" else (),
+        image_format=image_format,
+    )
+
+
+@lru_cache(maxsize=app_config.MODEL_ROUTE_CACHE_SIZE)
+def compile_model_route(model: str) -> ModelRoute:
+    """Resolve a requested model string into its (cached, immutable) route."""
+    return _compile(model)
+
+
+OTHER_MODEL_LABEL = "other"
+# (目录版本, 已知的 base model 集合)
+_known_base_models: Tuple[int, frozenset] = (-1, frozenset())
+
+
+def model_label(base_model: str) -> str:
+    """Bounded label for per-model metrics and limiters: ``base_model`` if the catalog knows it, else "other"."""
+    global _known_base_models
+    version, names = _known_base_models
+    if version != catalog_version():
+        version = catalog_version()
+        names = {compile_model_route(name).base_model for name in known_model_names()}
+        # 运维显式配置的模型也视为已知
+        names.update(app_config.ADMISSION_MODEL_LIMITS)
+        names.update(app_config.IMAGE_PREPROCESS_MODEL_MAX_SIDE)
+        names.add(compile_model_route(app_config.IMAGES_DEFAULT_MODEL).base_model)
+        names = frozenset(names)
+        _known_base_models = (version, names)
+    return base_model if base_model in names else OTHER_MODEL_LABEL
@@ -39,4 +39,26 @@ class OpenAIRequest(BaseModel):
     tool_choice: Optional[Union[str, Dict[str, Any]]] = None
 
     # Allow extra fields to pass through without causing validation errors
-    model_config = ConfigDict(extra='allow')
\ No newline at end of file
+    model_config = ConfigDict(extra='allow')
+
+class EmbeddingRequest(BaseModel):
+    model: str
+    input: Union[str, List[str], List[int], List[List[int]]]
+    encoding_format: Optional[Literal["float", "base64"]] = "float"
+    dimensions: Optional[int] = None
+    user: Optional[str] = None
+    task_type: Optional[str] = None  # Vertex extension, e.g. RETRIEVAL_QUERY / RETRIEVAL_DOCUMENT
+
+    model_config = ConfigDict(extra='allow')
+
+class ImageGenerationRequest(BaseModel):
+    prompt: str
+    model: Optional[str] = None  # defaults to IMAGES_DEFAULT_MODEL
+    n: Optional[int] = 1
+    size: Optional[str] = None  # WIDTHxHEIGHT or auto, mapped to the nearest Gemini aspect ratio
+    response_format: Optional[Literal["url", "b64_json"]] = "url"
+    quality: Optional[str] = None
+    style: Optional[str] = None
+    user: Optional[str] = None
+
+    model_config = ConfigDict(extra='allow')
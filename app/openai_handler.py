@@ -21,6 +21,8 @@ from api_helpers import (
 from message_processing import extract_reasoning_by_tags
 from credentials_manager import _refresh_auth
 from project_id_discovery import discover_project_id
+import metrics
+import tracing
 
 
 # Wrapper classes to mimic OpenAI SDK responses for direct httpx calls
@@ -50,7 +52,7 @@ class ExpressClientWrapper:
         self.project_id = project_id
         self.api_key = api_key
         self.location = location
-        self.base_url = f"https://aiplatform.googleapis.com/v1beta1/projects/{self.project_id}/locations/{self.location}/endpoints/openapi"
+        self.base_url = f"{app_config.VERTEX_API_BASE}/v1beta1/projects/{self.project_id}/locations/{self.location}/endpoints/openapi"
         
         # The 'chat.completions' structure mimics the real OpenAI client
         self.chat = self
@@ -160,7 +162,7 @@ class OpenAIDirectHandler:
     def create_openai_client(self, project_id: str, gcp_token: str, location: str = "global") -> openai.AsyncOpenAI:
         """Create an OpenAI client configured for Vertex AI endpoint."""
         endpoint_url = (
-            f"https://aiplatform.googleapis.com/v1beta1/"
+            f"{app_config.VERTEX_API_BASE}/v1beta1/"
             f"projects/{project_id}/locations/{location}/endpoints/openapi"
         )
         
@@ -257,6 +259,8 @@ class OpenAIDirectHandler:
         try:
             # Ensure stream=True is explicitly passed for real streaming
             openai_params_for_stream = {**openai_params, "stream": True}
+            upstream_span = tracing.start_span("upstream.chat_completions_stream", model=openai_params.get("model", ""))
+            stream_started = time.perf_counter()
             stream_response = await openai_client.chat.completions.create(
                 **openai_params_for_stream,
                 extra_body=openai_extra_body
@@ -266,11 +270,17 @@ class OpenAIDirectHandler:
             reasoning_processor = StreamingReasoningProcessor(VERTEX_REASONING_TAG)
             chunk_count = 0
             has_sent_content = False
+            completion_tokens = 0
             
             async for chunk in stream_response:
+                if chunk_count == 0:
+                    ttft_ms = (time.perf_counter() - stream_started) * 1000
+                    upstream_span.set_attribute("upstream.ttft_ms", ttft_ms)
+                    tracing.add_phase_time("upstream_ttft", ttft_ms)
                 chunk_count += 1
                 try:
                     chunk_as_dict = chunk.model_dump(exclude_unset=True, exclude_none=True)
+                    completion_tokens = (chunk_as_dict.get('usage') or {}).get('completion_tokens') or completion_tokens
                     
                     choices = chunk_as_dict.get('choices')
                     if choices and isinstance(choices, list) and len(choices) > 0:
@@ -369,6 +379,10 @@ class OpenAIDirectHandler:
                 yield f"data: {json.dumps(content_flush_payload)}\n\n"
                 has_sent_content = True
             
+            metrics.record_output_tokens(completion_tokens)
+            upstream_span.set_attribute("stream.chunks", chunk_count)
+            upstream_span.end()
+
             # Always send a finish reason chunk
             finish_payload = {
                 "id": f"chatcmpl-final-{int(time.time())}", # Kilo Code: Changed ID for clarity
@@ -387,6 +401,7 @@ class OpenAIDirectHandler:
                 error_msg = error_msg[:1024] + "..."
             error_msg_full = f"Error during OpenAI streaming for {request.model}: {error_msg}"
             print(f"ERROR: {error_msg_full}")
+            metrics.record_upstream_error(stream_error)
             error_response = create_openai_error_response(500, error_msg_full, "server_error")
             yield f"data: {json.dumps(error_response)}\n\n"
             yield "data: [DONE]\n\n"
@@ -402,11 +417,13 @@ class OpenAIDirectHandler:
         try:
             # Ensure stream=False is explicitly passed
             openai_params_non_stream = {**openai_params, "stream": False}
-            response = await openai_client.chat.completions.create(
-                **openai_params_non_stream,
-                extra_body=openai_extra_body
-            )
+            with tracing.span("upstream.chat_completions", phase="upstream", model=openai_params.get("model", "")):
+                response = await openai_client.chat.completions.create(
+                    **openai_params_non_stream,
+                    extra_body=openai_extra_body
+                )
             response_dict = response.model_dump(exclude_unset=True, exclude_none=True)
+            metrics.record_output_tokens((response_dict.get('usage') or {}).get('completion_tokens') or 0)
             
             try:
                 choices = response_dict.get('choices')
@@ -442,6 +459,7 @@ class OpenAIDirectHandler:
         except Exception as e:
             error_msg = f"Error calling OpenAI client for {request.model}: {str(e)}"
             print(f"ERROR: {error_msg}")
+            metrics.record_upstream_error(e)
             return JSONResponse(
                 status_code=500, 
                 content=create_openai_error_response(500, error_msg, "server_error")
@@ -462,7 +480,8 @@ class OpenAIDirectHandler:
                 if not key_tuple:
                     raise Exception("OpenAI Express Mode requires an API key, but none were available.")
                 
-                _, express_api_key = key_tuple
+                key_idx, express_api_key = key_tuple
+                metrics.set_request_labels(auth_path="openai_direct", key=f"express:{key_idx}")
                 project_id = await discover_project_id(express_api_key)
                 
                 client = ExpressClientWrapper(project_id=project_id, api_key=express_api_key)
@@ -477,7 +496,9 @@ class OpenAIDirectHandler:
                     raise Exception("OpenAI Direct Mode requires GCP credentials, but none were available.")
 
                 print(f"INFO: [OpenAI Direct Path] Using credentials for project: {rotated_project_id}")
-                gcp_token = _refresh_auth(rotated_credentials)
+                metrics.set_request_labels(auth_path="openai_direct", key=f"sa:{rotated_project_id}")
+                with tracing.span("refresh_gcp_token", phase="token_refresh"):
+                    gcp_token = _refresh_auth(rotated_credentials)
                 if not gcp_token:
                     raise Exception(f"Failed to obtain valid GCP token for OpenAI client (Project: {rotated_project_id}).")
                 client = self.create_openai_client(rotated_project_id, gcp_token)
@@ -1,11 +1,22 @@
 import aiohttp
+import asyncio
 import json
 import re
 from typing import Dict, Optional
 import config
+import tracing
+import shared_state
 
 # Global cache for project IDs: {api_key: project_id}
+# 进程内一级缓存；共享状态中按 key 的哈希保存，其它 worker 无需重复探测
 PROJECT_ID_CACHE: Dict[str, str] = {}
+_SHARED_NAMESPACE = "project_id"
+
+
+async def _remember_project_id(api_key: str, project_id: str) -> None:
+    PROJECT_ID_CACHE[api_key] = project_id
+    if shared_state.backend.shared:
+        await asyncio.to_thread(shared_state.backend.set, _SHARED_NAMESPACE, shared_state.hash_key(api_key), project_id)
 
 
 def _get_proxy_url() -> Optional[str]:
@@ -31,9 +42,20 @@ async def discover_project_id(api_key: str) -> str:
     if api_key in PROJECT_ID_CACHE:
         print(f"INFO: Using cached project ID: {PROJECT_ID_CACHE[api_key]}")
         return PROJECT_ID_CACHE[api_key]
+    if shared_state.backend.shared:
+        project_id = await asyncio.to_thread(shared_state.backend.get, _SHARED_NAMESPACE, shared_state.hash_key(api_key))
+        if project_id:
+            PROJECT_ID_CACHE[api_key] = project_id
+            print(f"INFO: Using shared project ID: {project_id}")
+            return project_id
     
+    with tracing.span("discover_project_id", phase="project_discovery"):
+        return await _discover_project_id_uncached(api_key)
+
+
+async def _discover_project_id_uncached(api_key: str) -> str:
     # Use a non-existent model to trigger error
-    error_url = f"https://aiplatform.googleapis.com/v1/publishers/google/models/gemini-2.7-pro-preview-05-06:streamGenerateContent?key={api_key}"
+    error_url = f"{config.VERTEX_API_BASE}/v1/publishers/google/models/gemini-2.7-pro-preview-05-06:streamGenerateContent?key={api_key}"
     
     # Create minimal request payload
     payload = {
@@ -61,7 +83,7 @@ async def discover_project_id(api_key: str) -> str:
                         match = re.search(r'projects/(\d+)/locations/', error_message)
                         if match:
                             project_id = match.group(1)
-                            PROJECT_ID_CACHE[api_key] = project_id
+                            await _remember_project_id(api_key, project_id)
                             print(f"INFO: Discovered project ID: {project_id}")
                             return project_id
                 except json.JSONDecodeError:
@@ -69,7 +91,7 @@ async def discover_project_id(api_key: str) -> str:
                     match = re.search(r'projects/(\d+)/locations/', response_text)
                     if match:
                         project_id = match.group(1)
-                        PROJECT_ID_CACHE[api_key] = project_id
+                        await _remember_project_id(api_key, project_id)
                         print(f"INFO: Discovered project ID from raw response: {project_id}")
                         return project_id
                 
@@ -0,0 +1,191 @@
+import asyncio
+import os
+import shutil
+from typing import AsyncIterator, BinaryIO, Optional
+from fastapi import APIRouter, Depends, Request, Query
+from fastapi.responses import JSONResponse, FileResponse
+from starlette.formparsers import MultiPartException, MultiPartParser
+
+from auth import get_api_key
+from api_helpers import create_openai_error_response
+import config as app_config
+from batches import runner, BatchError
+
+router = APIRouter(prefix="/v1")
+
+_COPY_CHUNK = 1024 * 1024
+
+
+def _error(status_code: int, message: str) -> JSONResponse:
+    return JSONResponse(status_code=status_code,
+                        content=create_openai_error_response(status_code, message, "invalid_request_error"))
+
+
+def _list_page(items, limit: int, after: Optional[str]):
+    if after:
+        ids = [item["id"] for item in items]
+        items = items[ids.index(after) + 1:] if after in ids else []
+    page = items[:limit]
+    return {
+        "object": "list",
+        "data": page,
+        "first_id": page[0]["id"] if page else None,
+        "last_id": page[-1]["id"] if page else None,
+        "has_more": len(items) > limit,
+    }
+
+
+class _UploadTooLarge(Exception):
+    pass
+
+
+async def _capped_stream(request: Request, max_bytes: int) -> AsyncIterator[bytes]:
+    # 边接收边计数，超过上限立即中止（分块上传没有 Content-Length）
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_bytes:
+            raise _UploadTooLarge()
+        yield chunk
+
+
+def _copy_to_path(source: BinaryIO, path: str) -> None:
+    source.seek(0)
+    with open(path, "wb") as f:
+        shutil.copyfileobj(source, f, _COPY_CHUNK)
+
+
+def _discard(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+@router.post("/files")
+async def upload_file(request: Request, api_key: str = Depends(get_api_key)):
+    """
+    上传批处理输入文件。支持 OpenAI SDK 的 multipart/form-data（file + purpose），
+    也支持直接以请求体上传 JSONL（?purpose=batch&filename=...）。
+    请求体以流的方式写入磁盘，不会整体读入内存。
+    """
+    max_bytes = app_config.BATCH_MAX_FILE_MB * 1024 * 1024
+    too_large = _error(413, f"File exceeds BATCH_MAX_FILE_MB ({app_config.BATCH_MAX_FILE_MB} MB)")
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        return too_large
+
+    path = await asyncio.to_thread(runner.files.upload_path)
+    try:
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            # multipart 解析器把文件部分写入临时文件（超过 1MB 落盘），再复制到存储目录
+            try:
+                form = await MultiPartParser(request.headers, _capped_stream(request, max_bytes)).parse()
+            except MultiPartException as e:
+                return _error(400, e.message)
+            try:
+                upload = form.get("file")
+                purpose = form.get("purpose")
+                if upload is None or not hasattr(upload, "file"):
+                    return _error(400, "Missing 'file' field")
+                filename = upload.filename or "upload.jsonl"
+                if purpose == "batch":
+                    await asyncio.to_thread(_copy_to_path, upload.file, path)
+            finally:
+                await form.close()
+        else:
+            purpose = request.query_params.get("purpose")
+            filename = request.query_params.get("filename") or "upload.jsonl"
+            if purpose == "batch":
+                f = await asyncio.to_thread(open, path, "wb")
+                try:
+                    async for chunk in _capped_stream(request, max_bytes):
+                        await asyncio.to_thread(f.write, chunk)
+                finally:
+                    await asyncio.to_thread(f.close)
+    except _UploadTooLarge:
+        await asyncio.to_thread(_discard, path)
+        return too_large
+    except BaseException:
+        await asyncio.to_thread(_discard, path)
+        raise
+
+    if purpose != "batch":
+        await asyncio.to_thread(_discard, path)
+        return _error(400, f"Unsupported purpose '{purpose}'. Only 'batch' is supported")
+    file_object = await asyncio.to_thread(runner.files.create_from_path, filename, purpose, path)
+    print(f"INFO: Stored batch input file {file_object['id']} ({file_object['bytes']} bytes)")
+    return file_object
+
+
+@router.get("/files")
+async def list_files(purpose: Optional[str] = None, limit: int = Query(10000, ge=1, le=10000),
+                     after: Optional[str] = None, api_key: str = Depends(get_api_key)):
+    files = await asyncio.to_thread(runner.files.list, purpose)
+    return _list_page(files, limit, after)
+
+
+@router.get("/files/{file_id}")
+async def retrieve_file(file_id: str, api_key: str = Depends(get_api_key)):
+    file_object = await asyncio.to_thread(runner.files.get, file_id)
+    if file_object is None:
+        return _error(404, f"No such file: {file_id}")
+    return file_object
+
+
+@router.get("/files/{file_id}/content")
+async def retrieve_file_content(file_id: str, api_key: str = Depends(get_api_key)):
+    file_object = await asyncio.to_thread(runner.files.get, file_id)
+    if file_object is None:
+        return _error(404, f"No such file: {file_id}")
+    return FileResponse(runner.files.data_path(file_id), media_type="application/jsonl",
+                        filename=file_object["filename"])
+
+
+@router.delete("/files/{file_id}")
+async def delete_file(file_id: str, api_key: str = Depends(get_api_key)):
+    if not await asyncio.to_thread(runner.files.delete, file_id):
+        return _error(404, f"No such file: {file_id}")
+    return {"id": file_id, "object": "file", "deleted": True}
+
+
+@router.post("/batches")
+async def create_batch(request: Request, api_key: str = Depends(get_api_key)):
+    try:
+        body = await request.json()
+    except ValueError:
+        return _error(400, "Request body must be JSON")
+    if not isinstance(body, dict) or not body.get("input_file_id"):
+        return _error(400, "input_file_id is required")
+    try:
+        return await runner.create(
+            body["input_file_id"],
+            body.get("endpoint", "/v1/chat/completions"),
+            body.get("completion_window", "24h"),
+            body.get("metadata"),
+        )
+    except BatchError as e:
+        return _error(e.status_code, e.message)
+
+
+@router.get("/batches")
+async def list_batches(limit: int = Query(20, ge=1, le=100), after: Optional[str] = None,
+                       api_key: str = Depends(get_api_key)):
+    batches = await asyncio.to_thread(runner.batches.list)
+    return _list_page(batches, limit, after)
+
+
+@router.get("/batches/{batch_id}")
+async def retrieve_batch(batch_id: str, api_key: str = Depends(get_api_key)):
+    try:
+        return await runner.get(batch_id)
+    except BatchError as e:
+        return _error(e.status_code, e.message)
+
+
+@router.post("/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, api_key: str = Depends(get_api_key)):
+    try:
+        return await runner.cancel(batch_id)
+    except BatchError as e:
+        return _error(e.status_code, e.message)
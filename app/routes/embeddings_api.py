@@ -0,0 +1,56 @@
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import JSONResponse
+
+from models import EmbeddingRequest
+from auth import get_api_key
+from api_helpers import create_openai_error_response
+from model_routing import compile_model_route, model_label
+import metrics
+import admission
+import adaptive_concurrency
+import embeddings
+
+router = APIRouter()
+
+
+@router.post("/v1/embeddings")
+async def create_embeddings(fastapi_request: Request, request: EmbeddingRequest, api_key: str = Depends(get_api_key)):
+    metrics.set_request_labels(model=model_label(compile_model_route(request.model).base_model), stream=False)
+    texts = [request.input] if isinstance(request.input, str) else request.input
+    if not texts:
+        return JSONResponse(status_code=400, content=create_openai_error_response(
+            400, "'input' must not be empty", "invalid_request_error"))
+    if not all(isinstance(text, str) for text in texts):
+        return JSONResponse(status_code=400, content=create_openai_error_response(
+            400, "Token array inputs are not supported, send text", "invalid_request_error"))
+
+    try:
+        rejection = await admission.admit_model(compile_model_route(request.model).base_model, fastapi_request.url.path)
+        if rejection is not None:
+            return rejection
+
+        results = await embeddings.batcher.embed(
+            fastapi_request.app, request.model, texts,
+            task_type=request.task_type, dimensions=request.dimensions,
+        )
+    except adaptive_concurrency.ConcurrencyLimitExceeded as ce:
+        return JSONResponse(status_code=429, content=create_openai_error_response(429, str(ce), "rate_limit_error"),
+                            headers={"Retry-After": "1"})
+    except ValueError as ve:
+        return JSONResponse(status_code=400, content=create_openai_error_response(400, str(ve), "invalid_request_error"))
+    except Exception as e:
+        print(f"ERROR: Embeddings request failed: {e}")
+        return JSONResponse(status_code=500, content=create_openai_error_response(
+            500, f"Embedding request failed: {e}", "server_error"))
+
+    prompt_tokens = sum(token_count for _, token_count in results)
+    return JSONResponse(content={
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": i,
+             "embedding": embeddings.encode_embedding(values, request.encoding_format)}
+            for i, (values, _) in enumerate(results)
+        ],
+        "model": request.model,
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+    })
@@ -8,16 +8,31 @@ from pydantic import BaseModel, field_validator
 import asyncio
 
 from google.genai import types
-from google import genai
 
 from auth import get_api_key, validate_api_key
-from api_helpers import create_openai_error_response, retry_with_backoff, is_retryable_error
-from project_id_discovery import discover_project_id
-from config import API_KEY
-from model_loader import get_alias_models, ALIAS_MODELS
+from api_helpers import (
+    create_openai_error_response, retry_with_backoff, is_retryable_error, create_express_client, get_sa_client, PrecomputedJSONBody,
+)
+from config import API_KEY, COUNT_TOKENS_MODE
+from model_routing import compile_model_route, model_label, split_image_format_suffix, EXPRESS_PREFIX
+from model_loader import (
+    get_alias_models, ALIAS_MODELS, get_native_models, refresh_native_models_cache, catalog_version,
+)
+import metrics
+import tracing
+import admission
+import adaptive_concurrency
+import token_counting
+import embeddings
+import image_store
+import image_preprocessing
+import image_transcoding
 
 router = APIRouter(prefix="/gemini/v1beta", tags=["Gemini Native API"])
 
+# 序列化后的 /models 响应，仅在模型目录版本变化时重建
+_gemini_models_body = PrecomputedJSONBody()
+
 
 async def get_gemini_api_key(
     key: Optional[str] = Query(None, description="API key"),
@@ -46,6 +61,7 @@ async def get_gemini_api_key(
     if not validate_api_key(api_key):
         raise HTTPException(status_code=401, detail="Invalid API key")
     
+    tracing.mark_authenticated()
     return api_key
 
 
@@ -239,6 +255,12 @@ def build_contents(request: GeminiRequest) -> List[types.Content]:
                         data=data.get("data", ""),
                         mime_type=data.get("mimeType", data.get("mime_type", "application/octet-stream"))
                     ))
+            elif "fileData" in part or "file_data" in part:
+                # 之前响应中返回的本地图片链接，直接换回图片数据
+                data = part.get("fileData") or part.get("file_data") or {}
+                stored = image_store.resolve_url(data.get("fileUri", data.get("file_uri", "")))
+                if stored:
+                    parts.append(types.Part.from_bytes(data=stored[0], mime_type=stored[1]))
             elif "functionCall" in part or "function_call" in part:
                 fc = part.get("functionCall") or part.get("function_call")
                 if fc:
@@ -325,12 +347,20 @@ def convert_response_to_gemini_format(response: Any, model_name: str) -> Dict[st
                         
                         if hasattr(part, "inline_data") and part.inline_data:
                             data = part.inline_data.data
-                            if isinstance(data, bytes):
-                                data = base64.b64encode(data).decode('utf-8')
-                            part_dict["inlineData"] = {
-                                "mimeType": part.inline_data.mime_type,
-                                "data": data
-                            }
+                            stored_url = image_store.image_url(data, part.inline_data.mime_type)
+                            if stored_url:
+                                # URL 模式：图片存入本地存储，只返回链接
+                                part_dict["fileData"] = {
+                                    "mimeType": part.inline_data.mime_type,
+                                    "fileUri": stored_url
+                                }
+                            else:
+                                if isinstance(data, bytes):
+                                    data = base64.b64encode(data).decode('utf-8')
+                                part_dict["inlineData"] = {
+                                    "mimeType": part.inline_data.mime_type,
+                                    "data": data
+                                }
                         
                         if part_dict:
                             cand_dict["content"]["parts"].append(part_dict)
@@ -372,13 +402,9 @@ async def get_gemini_client(
     credential_manager = fastapi_request.app.state.credential_manager
     express_key_manager = fastapi_request.app.state.express_key_manager
     
-    EXPRESS_PREFIX = "[EXPRESS] "
-    is_express_explicit = model_name.startswith(EXPRESS_PREFIX)
-    
-    if is_express_explicit:
-        actual_model = model_name[len(EXPRESS_PREFIX):]
-    else:
-        actual_model = model_name
+    route = compile_model_route(model_name)
+    is_express_explicit = route.express
+    actual_model = model_name[len(EXPRESS_PREFIX):] if is_express_explicit else model_name
     
     has_sa_creds = credential_manager.get_total_credentials() > 0
     has_express_key = express_key_manager.get_total_keys() > 0
@@ -392,23 +418,25 @@ async def get_gemini_client(
         if not has_express_key:
             raise ValueError("Express API key required but not configured")
         
-        key_tuple = express_key_manager.get_express_api_key()
-        if not key_tuple:
-            raise ValueError("No Express API key available")
-        
-        _, key_val = key_tuple
-        
-        if "gemini-2.5-pro" in actual_model or "gemini-2.5-flash" in actual_model or "gemini-3" in actual_model:
-            project_id = await discover_project_id(key_val)
-            base_url = f"https://aiplatform.googleapis.com/v1/projects/{project_id}/locations/global"
-            client = genai.Client(
-                vertexai=True,
-                api_key=key_val,
-                http_options=types.HttpOptions(base_url=base_url)
-            )
-            client._api_client._http_options.api_version = None
+        # 跳过自适应并发上限已满的 Key，最后一个候选短暂等待
+        total_keys = express_key_manager.get_total_keys()
+        for attempt in range(total_keys):
+            key_tuple = express_key_manager.get_express_api_key()
+            if not key_tuple:
+                raise ValueError("No Express API key available")
+            key_idx, key_val = key_tuple
+            if await adaptive_concurrency.acquire(actual_model, f"express:{key_idx}", wait=attempt == total_keys - 1):
+                break
         else:
-            client = genai.Client(vertexai=True, api_key=key_val)
+            raise adaptive_concurrency.ConcurrencyLimitExceeded(
+                f"All Express keys for model '{actual_model}' are at their adaptive concurrency limit")
+        metrics.set_request_labels(auth_path="express", key=f"express:{key_idx}")
+        
+        try:
+            client = await create_express_client(key_val, actual_model)
+        except Exception:
+            adaptive_concurrency.release_current()
+            raise
         
         print(f"INFO: Using Express API key for model: {actual_model}")
         return client, actual_model
@@ -421,13 +449,16 @@ async def get_gemini_client(
         
         if not credentials or not project_id:
             raise ValueError("No SA credentials available")
+        if not await adaptive_concurrency.acquire(actual_model, f"sa:{project_id}", wait=True):
+            raise adaptive_concurrency.ConcurrencyLimitExceeded(
+                f"SA project for model '{actual_model}' is at its adaptive concurrency limit")
+        metrics.set_request_labels(auth_path="sa", key=f"sa:{project_id}")
         
-        client = genai.Client(
-            vertexai=True,
-            credentials=credentials,
-            project=project_id,
-            location="global"
-        )
+        try:
+            client = get_sa_client(credentials, project_id)
+        except Exception:
+            adaptive_concurrency.release_current()
+            raise
         
         print(f"INFO: Using SA credentials for model: {actual_model}")
         return client, actual_model
@@ -463,6 +494,11 @@ async def generate_content(
     api_key: str = Depends(get_gemini_api_key)
 ):
     """Gemini generateContent 端点 - 非流式"""
+    metrics.set_request_labels(model=model_label(compile_model_route(model).base_model), stream=False)
+    image_store.configure_request(fastapi_request)
+    # -webp / -avif / -png 后缀只决定输出图片格式，不传给上游
+    model, image_format = split_image_format_suffix(model)
+    image_transcoding.configure_request(fastapi_request, image_format)
     try:
         body = await fastapi_request.json()
         request = GeminiRequest(**body)
@@ -470,10 +506,17 @@ async def generate_content(
         # 解析别名模型
         resolved_model, request = resolve_alias_model(model, request)
         
+        # 单模型并发上限（未启用准入控制时直接放行）
+        rejection = await admission.admit_model(compile_model_route(resolved_model).base_model, fastapi_request.url.path)
+        if rejection is not None:
+            return rejection
+        
         client, actual_model = await get_gemini_client(fastapi_request, resolved_model)
         
         gen_config = build_generation_config(request)
-        contents = build_contents(request)
+        with tracing.span("build_contents", phase="prompt_conversion"):
+            contents = build_contents(request)
+        contents = await image_preprocessing.preprocessor.preprocess_contents(contents, actual_model)
         
         print(f"INFO: Gemini native generateContent for model: {actual_model}")
         
@@ -485,11 +528,21 @@ async def generate_content(
                 config=gen_config
             )
         
-        response = await retry_with_backoff(_generate_call, max_retries=10, delay=1.0)
+        with tracing.span("upstream.generate_content", phase="upstream", model=actual_model):
+            response = await retry_with_backoff(_generate_call, max_retries=10, delay=1.0)
+        metrics.record_output_tokens(metrics.output_tokens_from_usage(getattr(response, "usage_metadata", None)))
         
-        result = convert_response_to_gemini_format(response, actual_model)
+        await image_transcoding.transcode_images(response)
+        with tracing.span("convert_response_to_gemini_format", phase="response_conversion"):
+            result = convert_response_to_gemini_format(response, actual_model)
         return JSONResponse(content=result)
         
+    except adaptive_concurrency.ConcurrencyLimitExceeded as ce:
+        return JSONResponse(
+            status_code=429,
+            content={"error": {"code": 429, "message": str(ce), "status": "RESOURCE_EXHAUSTED"}},
+            headers={"Retry-After": "1"}
+        )
     except ValueError as ve:
         return JSONResponse(
             status_code=400,
@@ -511,6 +564,11 @@ async def stream_generate_content(
     api_key: str = Depends(get_gemini_api_key)
 ):
     """Gemini streamGenerateContent 端点 - 流式"""
+    metrics.set_request_labels(model=model_label(compile_model_route(model).base_model), stream=True)
+    image_store.configure_request(fastapi_request)
+    # -webp / -avif / -png 后缀只决定输出图片格式，不传给上游
+    model, image_format = split_image_format_suffix(model)
+    image_transcoding.configure_request(fastapi_request, image_format)
     try:
         body = await fastapi_request.json()
         request = GeminiRequest(**body)
@@ -518,10 +576,17 @@ async def stream_generate_content(
         # 解析别名模型
         resolved_model, request = resolve_alias_model(model, request)
         
+        # 单模型并发上限（未启用准入控制时直接放行）
+        rejection = await admission.admit_model(compile_model_route(resolved_model).base_model, fastapi_request.url.path)
+        if rejection is not None:
+            return rejection
+        
         client, actual_model = await get_gemini_client(fastapi_request, resolved_model)
         
         gen_config = build_generation_config(request)
-        contents = build_contents(request)
+        with tracing.span("build_contents", phase="prompt_conversion"):
+            contents = build_contents(request)
+        contents = await image_preprocessing.preprocessor.preprocess_contents(contents, actual_model)
         
         print(f"INFO: Gemini native streamGenerateContent for model: {actual_model}")
         
@@ -529,6 +594,9 @@ async def stream_generate_content(
             max_retries = 10
             retry_delay = 1.0
             for attempt in range(max_retries):
+                upstream_span = tracing.start_span("upstream.stream_generate_content", model=actual_model, attempt=attempt + 1)
+                stream_started = time.perf_counter()
+                conversion_ms = 0.0
                 try:
                     stream = await client.aio.models.generate_content_stream(
                         model=actual_model,
@@ -537,8 +605,15 @@ async def stream_generate_content(
                     )
                     
                     chunk_count = 0
+                    last_usage_metadata = None
                     async for chunk in stream:
+                        chunk_received = time.perf_counter()
+                        if chunk_count == 0:
+                            ttft_ms = (chunk_received - stream_started) * 1000
+                            upstream_span.set_attribute("upstream.ttft_ms", ttft_ms)
+                            tracing.add_phase_time("upstream_ttft", ttft_ms)
                         chunk_count += 1
+                        last_usage_metadata = getattr(chunk, "usage_metadata", None) or last_usage_metadata
                         # 调试：打印 thought 相关信息
                         if hasattr(chunk, 'candidates') and chunk.candidates:
                             for cand in chunk.candidates:
@@ -549,6 +624,7 @@ async def stream_generate_content(
                                         if thought_val:
                                             print(f"DEBUG chunk {chunk_count}: part[{i}] is THOUGHT, text={text_val[:50] if text_val else None}...")
                         
+                        await image_transcoding.transcode_images(chunk)
                         chunk_data = convert_response_to_gemini_format(chunk, actual_model)
                         
                         # 使用自定义 encoder 处理 bytes
@@ -558,13 +634,24 @@ async def stream_generate_content(
                                     return base64.b64encode(obj).decode('utf-8')
                                 return super().default(obj)
                         
-                        yield f"data: {json.dumps(chunk_data, cls=BytesEncoder)}\n\n"
+                        sse_chunk = f"data: {json.dumps(chunk_data, cls=BytesEncoder)}\n\n"
+                        conversion_ms += (time.perf_counter() - chunk_received) * 1000
+                        yield sse_chunk
                     
                     print(f"DEBUG: Stream completed, total chunks: {chunk_count}")
+                    metrics.record_output_tokens(metrics.output_tokens_from_usage(last_usage_metadata))
+                    upstream_span.set_attribute("stream.chunks", chunk_count)
+                    upstream_span.set_attribute("chunk_conversion_ms", conversion_ms)
+                    tracing.add_phase_time("chunk_conversion", conversion_ms)
+                    upstream_span.end()
                     return  # 成功完成
                     
                 except Exception as e:
                     last_error = e
+                    upstream_span.record_error(e)
+                    upstream_span.end()
+                    metrics.record_upstream_error(e)
+                    adaptive_concurrency.record_upstream_error(e)
                     
                     if not is_retryable_error(e):
                         print(f"ERROR: Stream error (non-retryable): {e}")
@@ -577,6 +664,7 @@ async def stream_generate_content(
                     if attempt < max_retries - 1:  # 还有重试机会
                         print(f"WARNING: Stream error (attempt {attempt + 1}/{max_retries}): {e}")
                         print(f"INFO: Retrying stream in {retry_delay}s...")
+                        metrics.record_retry("stream")
                         await asyncio.sleep(retry_delay)
                     else:
                         print(f"ERROR: Stream error (all {max_retries} retries exhausted): {e}")
@@ -591,6 +679,12 @@ async def stream_generate_content(
             media_type="text/event-stream"
         )
         
+    except adaptive_concurrency.ConcurrencyLimitExceeded as ce:
+        return JSONResponse(
+            status_code=429,
+            content={"error": {"code": 429, "message": str(ce), "status": "RESOURCE_EXHAUSTED"}},
+            headers={"Retry-After": "1"}
+        )
     except ValueError as ve:
         return JSONResponse(
             status_code=400,
@@ -604,6 +698,192 @@ async def stream_generate_content(
         )
 
 
+@router.post("/models/{model}:countTokens")
+async def count_tokens(
+    fastapi_request: Request,
+    model: str = Path(..., description="Model name"),
+    estimate: bool = Query(False, description="Answer with a local estimate instead of asking Vertex"),
+    api_key: str = Depends(get_gemini_api_key)
+):
+    """Gemini countTokens 端点 - 上游结果按内容哈希缓存，可选本地估算"""
+    metrics.set_request_labels(model=model_label(compile_model_route(model).base_model), stream=False)
+    try:
+        body = await fastapi_request.json()
+        # 与官方 API 一致，也接受 {"generateContentRequest": {...}} 形式
+        if isinstance(body, dict) and isinstance(body.get("generateContentRequest"), dict):
+            body = body["generateContentRequest"]
+        request = GeminiRequest(**body)
+        
+        resolved_model, request = resolve_alias_model(model, request)
+        
+        if estimate or COUNT_TOKENS_MODE == "estimate":
+            token_counting.COUNT_TOKENS_TOTAL.inc("estimate")
+            return JSONResponse(
+                content={"totalTokens": token_counting.estimate_tokens(body)},
+                headers={"X-Token-Count-Source": "estimate"}
+            )
+        
+        route = compile_model_route(resolved_model)
+        count_model = resolved_model[len(EXPRESS_PREFIX):] if route.express else resolved_model
+        cache_key = token_counting.cache_key(count_model, body)
+        cached = token_counting.cache.get(cache_key)
+        if cached is not None:
+            token_counting.COUNT_TOKENS_TOTAL.inc("cache")
+            return JSONResponse(content=cached, headers={"X-Token-Count-Source": "cache"})
+        
+        client, actual_model = await get_gemini_client(fastapi_request, resolved_model)
+        
+        gen_config = build_generation_config(request)
+        with tracing.span("build_contents", phase="prompt_conversion"):
+            contents = build_contents(request)
+        contents = await image_preprocessing.preprocessor.preprocess_contents(contents, actual_model)
+        count_config = types.CountTokensConfig(
+            system_instruction=gen_config.get("system_instruction"),
+            tools=gen_config.get("tools"),
+        )
+        
+        async def _count_call():
+            return await client.aio.models.count_tokens(
+                model=actual_model,
+                contents=contents,
+                config=count_config
+            )
+        
+        with tracing.span("upstream.count_tokens", phase="upstream", model=actual_model):
+            response = await retry_with_backoff(_count_call, max_retries=3, delay=1.0)
+        
+        result: Dict[str, Any] = {"totalTokens": response.total_tokens or 0}
+        if response.cached_content_token_count:
+            result["cachedContentTokenCount"] = response.cached_content_token_count
+        token_counting.cache.put(cache_key, result)
+        token_counting.COUNT_TOKENS_TOTAL.inc("upstream")
+        return JSONResponse(content=result, headers={"X-Token-Count-Source": "upstream"})
+        
+    except adaptive_concurrency.ConcurrencyLimitExceeded as ce:
+        return JSONResponse(
+            status_code=429,
+            content={"error": {"code": 429, "message": str(ce), "status": "RESOURCE_EXHAUSTED"}},
+            headers={"Retry-After": "1"}
+        )
+    except ValueError as ve:
+        return JSONResponse(
+            status_code=400,
+            content={"error": {"code": 400, "message": str(ve), "status": "INVALID_ARGUMENT"}}
+        )
+    except Exception as e:
+        print(f"ERROR: Gemini countTokens failed: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={"error": {"code": 500, "message": str(e), "status": "INTERNAL"}}
+        )
+
+
+def _embedding_text(content: Any) -> str:
+    if not isinstance(content, dict):
+        raise ValueError("content is required")
+    texts = []
+    for part in content.get("parts") or []:
+        if "text" not in part:
+            raise ValueError("Only text parts are supported for embeddings")
+        texts.append(part["text"])
+    return "\n".join(texts)
+
+
+async def _embed_requests(fastapi_request: Request, model: str, requests: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """每条输入单独提交给 embeddings.batcher，由它合并成上游批量调用"""
+    # 先校验并提取全部文本，避免后面的非法输入让已创建的协程无人 await
+    texts = [_embedding_text(req.get("content")) for req in requests]
+    results = await asyncio.gather(*(
+        embeddings.batcher.embed(
+            fastapi_request.app, model, [text],
+            task_type=req.get("taskType"), title=req.get("title"),
+            dimensions=req.get("outputDimensionality"),
+        )
+        for req, text in zip(requests, texts)
+    ))
+    return [{"values": embeddings.encode_embedding(result[0][0])} for result in results]
+
+
+def _embedding_error_response(e: Exception) -> JSONResponse:
+    if isinstance(e, adaptive_concurrency.ConcurrencyLimitExceeded):
+        return JSONResponse(
+            status_code=429,
+            content={"error": {"code": 429, "message": str(e), "status": "RESOURCE_EXHAUSTED"}},
+            headers={"Retry-After": "1"}
+        )
+    if isinstance(e, ValueError):
+        return JSONResponse(
+            status_code=400,
+            content={"error": {"code": 400, "message": str(e), "status": "INVALID_ARGUMENT"}}
+        )
+    print(f"ERROR: Gemini embedding request failed: {e}")
+    return JSONResponse(
+        status_code=500,
+        content={"error": {"code": 500, "message": str(e), "status": "INTERNAL"}}
+    )
+
+
+@router.post("/models/{model}:embedContent")
+async def embed_content(
+    fastapi_request: Request,
+    model: str = Path(..., description="Model name"),
+    api_key: str = Depends(get_gemini_api_key)
+):
+    """Gemini embedContent 端点"""
+    metrics.set_request_labels(model=model_label(compile_model_route(model).base_model), stream=False)
+    try:
+        rejection = await admission.admit_model(compile_model_route(model).base_model, fastapi_request.url.path)
+        if rejection is not None:
+            return rejection
+        body = await fastapi_request.json()
+        embedding, = await _embed_requests(fastapi_request, model, [body])
+        return JSONResponse(content={"embedding": embedding})
+    except Exception as e:
+        return _embedding_error_response(e)
+
+
+@router.post("/models/{model}:batchEmbedContents")
+async def batch_embed_contents(
+    fastapi_request: Request,
+    model: str = Path(..., description="Model name"),
+    api_key: str = Depends(get_gemini_api_key)
+):
+    """Gemini batchEmbedContents 端点"""
+    metrics.set_request_labels(model=model_label(compile_model_route(model).base_model), stream=False)
+    try:
+        body = await fastapi_request.json()
+        requests = body.get("requests") if isinstance(body, dict) else None
+        if not requests:
+            raise ValueError("requests must be a non-empty list")
+        rejection = await admission.admit_model(compile_model_route(model).base_model, fastapi_request.url.path)
+        if rejection is not None:
+            return rejection
+        return JSONResponse(content={"embeddings": await _embed_requests(fastapi_request, model, requests)})
+    except Exception as e:
+        return _embedding_error_response(e)
+
+
+def _build_gemini_model_list(native_models: List[str]) -> Dict[str, Any]:
+    models = []
+    for model_id in native_models:
+        models.append({
+            "name": f"models/{model_id}",
+            "displayName": model_id,
+            "description": f"Gemini model: {model_id}",
+            "supportedGenerationMethods": ["generateContent", "streamGenerateContent", "countTokens"]
+        })
+    
+    # 添加别名模型到列表
+    for alias_name, alias_config in ALIAS_MODELS.items():
+        models.append({
+            "name": f"models/{alias_name}",
+            "displayName": alias_name,
+            "description": f"Alias for {alias_config['base_model']} with thinking_level={alias_config.get('thinking_level', 'default')}",
+            "supportedGenerationMethods": ["generateContent", "streamGenerateContent", "countTokens"]
+        })
+    return {"models": models}
+
+
 @router.get("/models")
 async def list_models(
     fastapi_request: Request,
@@ -611,8 +891,6 @@ async def list_models(
 ):
     """列出可用的 Gemini 模型"""
     try:
-        from model_loader import get_native_models, refresh_native_models_cache
-        
         credential_manager = fastapi_request.app.state.credential_manager
         express_key_manager = fastapi_request.app.state.express_key_manager
         
@@ -623,25 +901,10 @@ async def list_models(
             await refresh_native_models_cache(credential_manager, express_key_manager)
             native_models = await get_native_models(credential_manager, express_key_manager)
         
-        models = []
-        for model_id in native_models:
-            models.append({
-                "name": f"models/{model_id}",
-                "displayName": model_id,
-                "description": f"Gemini model: {model_id}",
-                "supportedGenerationMethods": ["generateContent", "streamGenerateContent"]
-            })
-        
-        # 添加别名模型到列表
-        for alias_name, alias_config in ALIAS_MODELS.items():
-            models.append({
-                "name": f"models/{alias_name}",
-                "displayName": alias_name,
-                "description": f"Alias for {alias_config['base_model']} with thinking_level={alias_config.get('thinking_level', 'default')}",
-                "supportedGenerationMethods": ["generateContent", "streamGenerateContent"]
-            })
-        
-        return JSONResponse(content={"models": models})
+        # 序列化结果按模型目录版本缓存
+        return _gemini_models_body.get(
+            catalog_version(), lambda: _build_gemini_model_list(native_models)
+        ).response(fastapi_request)
         
     except Exception as e:
         print(f"ERROR: List models failed: {e}")
@@ -661,5 +924,5 @@ async def get_model(
         "name": f"models/{model}",
         "displayName": model,
         "description": f"Gemini model: {model}",
-        "supportedGenerationMethods": ["generateContent", "streamGenerateContent"]
+        "supportedGenerationMethods": ["generateContent", "streamGenerateContent", "countTokens"]
     })
\ No newline at end of file
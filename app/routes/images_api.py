@@ -0,0 +1,92 @@
+import asyncio
+import base64
+import time
+from fastapi import APIRouter, Depends, Path, Request
+from fastapi.responses import JSONResponse, Response
+
+import config as app_config
+import image_store
+import image_generation
+import image_transcoding
+import metrics
+import admission
+import adaptive_concurrency
+from models import ImageGenerationRequest
+from auth import get_api_key
+from api_helpers import create_openai_error_response
+from model_routing import compile_model_route, model_label
+
+router = APIRouter()
+
+
+@router.get("/v1/files/images/{name}")
+async def get_stored_image(name: str = Path(..., description="Stored image name (img-<hash>.<ext>)")):
+    """
+    返回图片存储中的图片。链接本身即凭证（内容哈希），不要求 API key，
+    以便客户端的 markdown 渲染器可以直接加载。
+    """
+    data = await asyncio.to_thread(image_store.store.get, name)
+    if data is None:
+        return JSONResponse(status_code=404, content=create_openai_error_response(
+            404, f"Image {name} not found or expired", "invalid_request_error"))
+    return Response(
+        content=data,
+        media_type=image_store.mime_type_for(name),
+        headers={
+            # 内容寻址：同一链接的内容永不变化
+            "Cache-Control": f"public, max-age={int(app_config.IMAGE_STORE_TTL)}, immutable",
+            "ETag": f'"{name.split(".", 1)[0]}"',
+        },
+    )
+
+
+@router.post("/v1/images/generations")
+async def create_images(fastapi_request: Request, request: ImageGenerationRequest, api_key: str = Depends(get_api_key)):
+    model = request.model or app_config.IMAGES_DEFAULT_MODEL
+    route = compile_model_route(model)
+    metrics.set_request_labels(model=model_label(route.base_model), stream=False)
+    n = request.n or 1
+    if not route.capabilities.image_output:
+        return JSONResponse(status_code=400, content=create_openai_error_response(
+            400, f"Model '{model}' is not an image generation model", "invalid_request_error"))
+    if not 1 <= n <= app_config.IMAGES_MAX_N:
+        return JSONResponse(status_code=400, content=create_openai_error_response(
+            400, f"'n' must be between 1 and {app_config.IMAGES_MAX_N}", "invalid_request_error"))
+    try:
+        aspect_ratio = image_generation.aspect_ratio_for_size(request.size)
+    except ValueError as ve:
+        return JSONResponse(status_code=400, content=create_openai_error_response(400, str(ve), "invalid_request_error"))
+    image_transcoding.configure_request(fastapi_request, route.image_format)
+
+    try:
+        rejection = await admission.admit_model(route.base_model, fastapi_request.url.path)
+        if rejection is not None:
+            return rejection
+
+        images = await image_generation.generate_images(fastapi_request.app, route, request.prompt, n, aspect_ratio)
+    except adaptive_concurrency.ConcurrencyLimitExceeded as ce:
+        return JSONResponse(status_code=429, content=create_openai_error_response(429, str(ce), "rate_limit_error"),
+                            headers={"Retry-After": "1"})
+    except ValueError as ve:
+        return JSONResponse(status_code=400, content=create_openai_error_response(400, str(ve), "invalid_request_error"))
+    except Exception as e:
+        print(f"ERROR: Image generation request failed: {e}")
+        return JSONResponse(status_code=500, content=create_openai_error_response(
+            500, f"Image generation failed: {e}", "server_error"))
+
+    data = []
+    for image in images:
+        if request.response_format == "b64_json":
+            item = {"b64_json": base64.b64encode(image.data).decode("ascii")}
+        else:
+            item = {"url": image_store.stored_image_url(fastapi_request, image.data, image.mime_type)}
+        data.append(item)
+
+    input_tokens = sum((image.usage.prompt_token_count or 0) for image in images if image.usage)
+    output_tokens = sum((image.usage.candidates_token_count or 0) for image in images if image.usage)
+    return JSONResponse(content={
+        "created": int(time.time()),
+        "data": data,
+        "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                  "total_tokens": input_tokens + output_tokens},
+    })
@@ -2,23 +2,16 @@ import time
 from fastapi import APIRouter, Depends, Request
 from typing import List, Dict, Any
 from auth import get_api_key
-from model_loader import get_native_models, refresh_native_models_cache, get_alias_models
+from api_helpers import PrecomputedJSONBody
+from model_loader import get_native_models, refresh_native_models_cache, get_alias_models, catalog_version
 
 router = APIRouter()
 
-@router.get("/v1/models")
-async def list_models(fastapi_request: Request, api_key: str = Depends(get_api_key)):
-    """返回简洁的模型列表，与 Gemini 端口共用"""
-    credential_manager = fastapi_request.app.state.credential_manager
-    express_key_manager = fastapi_request.app.state.express_key_manager
+# 序列化后的模型列表，仅在模型目录版本变化时重建
+_models_body = PrecomputedJSONBody()
 
-    # 获取原生模型列表
-    native_models = await get_native_models(credential_manager, express_key_manager)
-    
-    if not native_models:
-        await refresh_native_models_cache(credential_manager, express_key_manager)
-        native_models = await get_native_models(credential_manager, express_key_manager)
-    
+
+def _build_model_list(native_models: List[str]) -> Dict[str, Any]:
     current_time = int(time.time())
     
     # 直接返回基础模型列表，不添加任何前后缀
@@ -48,3 +41,19 @@ async def list_models(fastapi_request: Request, api_key: str = Depends(get_api_k
         })
 
     return {"object": "list", "data": model_list}
+
+
+@router.get("/v1/models")
+async def list_models(fastapi_request: Request, api_key: str = Depends(get_api_key)):
+    """返回简洁的模型列表，与 Gemini 端口共用"""
+    credential_manager = fastapi_request.app.state.credential_manager
+    express_key_manager = fastapi_request.app.state.express_key_manager
+
+    # 获取原生模型列表
+    native_models = await get_native_models(credential_manager, express_key_manager)
+    
+    if not native_models:
+        await refresh_native_models_cache(credential_manager, express_key_manager)
+        native_models = await get_native_models(credential_manager, express_key_manager)
+    
+    return _models_body.get(catalog_version(), lambda: _build_model_list(native_models)).response(fastapi_request)
@@ -0,0 +1,206 @@
+"""
+Cross-worker shared state.
+
+With several uvicorn workers every process otherwise keeps its own round-robin
+positions, project-ID cache and model catalog, so key rotation is only fair per
+worker and each worker repeats project discovery and models.list().
+
+Two backends share one small interface:
+    incr(name) -> int                        atomic counter (used for rotation)
+    next_index(name, n) -> int               incr() mapped onto 0..n-1
+    get(namespace, key) -> Optional[str]
+    set(namespace, key, value, ttl=None)
+
+- "memory" (default): plain dicts, per process - the previous behaviour.
+- "sqlite": one SQLite database in WAL mode shared by all workers on the host
+  (SHARED_STATE_PATH). Counters are a single UPSERT ... RETURNING statement, so
+  increments are atomic across processes without an explicit lock.
+
+incr() / next_index() are called synchronously on the request path (key
+rotation), where a SQLite write waiting on another worker's lock would stall
+the event loop. The sqlite backend therefore reserves counter values in
+blocks of SHARED_STATE_COUNTER_BLOCK with one statement and hands them out
+from memory; the next block is reserved in a background thread once half of
+the current one is used. Each worker still rotates through every index in
+order, and across workers the values stay unique. get() / set() are called
+from async code through asyncio.to_thread().
+
+Backend errors never fail a request: they are logged and the call falls back to
+the process-local state.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, Optional, Set, Tuple
+
+import config as app_config
+
+
+def hash_key(secret: str) -> str:
+    """Stable identifier for an API key; raw keys are never written to shared storage."""
+    return hashlib.sha256(secret.encode("utf-8")).hexdigest()[:32]
+
+
+class InProcessStateBackend:
+    shared = False
+
+    def __init__(self):
+        self._counters: Dict[str, int] = {}
+        self._values: Dict[Tuple[str, str], Tuple[str, Optional[float]]] = {}
+
+    def incr(self, name: str) -> int:
+        value = self._counters.get(name, 0) + 1
+        self._counters[name] = value
+        return value
+
+    def next_index(self, name: str, n: int) -> int:
+        return (self.incr(name) - 1) % n
+
+    def get(self, namespace: str, key: str) -> Optional[str]:
+        entry = self._values.get((namespace, key))
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            del self._values[(namespace, key)]
+            return None
+        return value
+
+    def set(self, namespace: str, key: str, value: str, ttl: Optional[float] = None) -> None:
+        self._values[(namespace, key)] = (value, time.time() + ttl if ttl else None)
+
+
+class SQLiteStateBackend:
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid: Optional[int] = None
+        self._fallback = InProcessStateBackend()
+        # 每个计数器在本进程预留的值，以及正在后台预留下一批的计数器
+        self._blocks: Dict[str, Deque[int]] = {}
+        self._refilling: Set[str] = set()
+        self._blocks_lock = threading.Lock()
+        self._blocks_pid = os.getpid()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # 连接不能跨 fork 复用：每个 worker 进程各自打开
+        if self._conn is None or self._conn_pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+                " expires_at REAL, PRIMARY KEY (namespace, key))"
+            )
+            try:
+                os.chmod(self.path, 0o600)
+            except OSError:
+                pass
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def _reserve(self, name: str, count: int) -> range:
+        with self._lock:
+            row = self._connection().execute(
+                "INSERT INTO counters (name, value) VALUES (?, ?)"
+                " ON CONFLICT(name) DO UPDATE SET value = value + excluded.value RETURNING value",
+                (name, count),
+            ).fetchone()
+        return range(row[0] - count + 1, row[0] + 1)
+
+    def _refill(self, name: str, count: int) -> None:
+        try:
+            reserved = self._reserve(name, count)
+        except sqlite3.Error as e:
+            print(f"WARNING: Shared state counter '{name}' could not reserve values in the background: {e}")
+            reserved = range(0)
+        with self._blocks_lock:
+            self._blocks.setdefault(name, deque()).extend(reserved)
+            self._refilling.discard(name)
+
+    def _schedule_refill(self, name: str, count: int) -> None:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+        self._executor.submit(self._refill, name, count)
+
+    def incr(self, name: str) -> int:
+        block = max(1, app_config.SHARED_STATE_COUNTER_BLOCK)
+        with self._blocks_lock:
+            if self._blocks_pid != os.getpid():
+                # fork 之后父进程预留的值与线程池都不能沿用
+                self._blocks, self._refilling, self._executor = {}, set(), None
+                self._blocks_pid = os.getpid()
+            values = self._blocks.setdefault(name, deque())
+            value = values.popleft() if values else None
+        if value is None:
+            # 首次调用，或后台预留尚未完成：同步预留一批
+            try:
+                reserved = self._reserve(name, block)
+            except sqlite3.Error as e:
+                print(f"WARNING: Shared state counter '{name}' unavailable, using process-local counter: {e}")
+                return self._fallback.incr(name)
+            value = reserved[0]
+            with self._blocks_lock:
+                values.extend(reserved[1:])
+        with self._blocks_lock:
+            refill = block > 1 and len(values) < block // 2 and name not in self._refilling
+            if refill:
+                self._refilling.add(name)
+        if refill:
+            self._schedule_refill(name, block)
+        return value
+
+    def next_index(self, name: str, n: int) -> int:
+        return (self.incr(name) - 1) % n
+
+    def get(self, namespace: str, key: str) -> Optional[str]:
+        try:
+            with self._lock:
+                row = self._connection().execute(
+                    "SELECT value, expires_at FROM kv WHERE namespace = ? AND key = ?", (namespace, key)
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"WARNING: Shared state read {namespace}/{key} failed, using process-local value: {e}")
+            return self._fallback.get(namespace, key)
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return row[0]
+
+    def set(self, namespace: str, key: str, value: str, ttl: Optional[float] = None) -> None:
+        expires_at = time.time() + ttl if ttl else None
+        try:
+            with self._lock:
+                self._connection().execute(
+                    "INSERT INTO kv (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+                    (namespace, key, value, expires_at),
+                )
+        except sqlite3.Error as e:
+            print(f"WARNING: Shared state write {namespace}/{key} failed, keeping it process-local: {e}")
+            self._fallback.set(namespace, key, value, ttl)
+
+
+def _create_backend():
+    backend_name = app_config.SHARED_STATE_BACKEND
+    if backend_name == "sqlite":
+        print(f"INFO: Using SQLite shared state at {app_config.SHARED_STATE_PATH}")
+        return SQLiteStateBackend(app_config.SHARED_STATE_PATH)
+    if backend_name != "memory":
+        print(f"WARNING: Unknown SHARED_STATE_BACKEND '{backend_name}', using in-process state")
+    return InProcessStateBackend()
+
+
+backend = _create_backend()
@@ -0,0 +1,111 @@
+"""
+Token counting for the Gemini ``:countTokens`` endpoint.
+
+Upstream counts are exact but cost a Vertex round trip, so they are kept in an
+LRU keyed by a hash of (model, contents, systemInstruction, tools): clients
+that re-count the same history before every turn only pay for it once.
+
+The local estimator answers without any upstream call. It is meant for
+pre-flight budgeting, not billing:
+
+- text: one token per CJK / kana / hangul character, one per ~4 other characters;
+- inline images and file references: a flat 258 tokens (Gemini's cost for an
+  image tile);
+- function calls / responses: their JSON length, ~4 characters per token.
+"""
+import hashlib
+import json
+import math
+import re
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional
+
+import config as app_config
+from metrics import REGISTRY
+
+COUNT_TOKENS_TOTAL = REGISTRY.counter(
+    "vertex2openai_count_tokens_total", "countTokens requests by how they were answered.", ("source",))
+
+# 与 Gemini 计费一致：每个图片 tile 258 token
+MEDIA_PART_TOKENS = 258
+_CHARS_PER_TOKEN = 4
+_WIDE_CHAR_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿＀-￯]")
+
+
+def cache_key(model: str, body: Dict[str, Any]) -> str:
+    """Hash of everything that affects the count; dict key order does not matter."""
+    relevant = {
+        "model": model,
+        "contents": body.get("contents"),
+        "systemInstruction": body.get("systemInstruction"),
+        "tools": body.get("tools"),
+    }
+    payload = json.dumps(relevant, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class TokenCountCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        result = self._entries.get(key)
+        if result is not None:
+            self._entries.move_to_end(key)
+        return result
+
+    def put(self, key: str, result: Dict[str, Any]) -> None:
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+cache = TokenCountCache(app_config.COUNT_TOKENS_CACHE_SIZE)
+
+
+def estimate_text_tokens(text: str) -> int:
+    if not text:
+        return 0
+    wide = len(_WIDE_CHAR_RE.findall(text))
+    return wide + math.ceil((len(text) - wide) / _CHARS_PER_TOKEN)
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Gemini's image cost: 258 tokens up to 384x384, else 258 per tile of min(side)/1.5 clamped to 256..768."""
+    if width <= 384 and height <= 384:
+        return MEDIA_PART_TOKENS
+    tile = min(768, max(256, int(min(width, height) / 1.5)))
+    return math.ceil(width / tile) * math.ceil(height / tile) * MEDIA_PART_TOKENS
+
+
+def _estimate_parts(parts: Iterable[Dict[str, Any]]) -> int:
+    total = 0
+    for part in parts or []:
+        if not isinstance(part, dict):
+            continue
+        if "text" in part:
+            total += estimate_text_tokens(part.get("text") or "")
+        elif any(k in part for k in ("inlineData", "inline_data", "fileData", "file_data")):
+            total += MEDIA_PART_TOKENS
+        else:
+            # functionCall / functionResponse / executableCode 等按 JSON 长度估算
+            total += estimate_text_tokens(json.dumps(part, ensure_ascii=False, separators=(",", ":")))
+    return total
+
+
+def estimate_tokens(body: Dict[str, Any]) -> int:
+    """Approximate prompt token count of a countTokens / generateContent body."""
+    total = 0
+    for content in body.get("contents") or []:
+        if isinstance(content, dict):
+            total += _estimate_parts(content.get("parts"))
+    system_instruction = body.get("systemInstruction")
+    if isinstance(system_instruction, dict):
+        total += _estimate_parts(system_instruction.get("parts"))
+    if body.get("tools"):
+        total += estimate_text_tokens(json.dumps(body["tools"], ensure_ascii=False, separators=(",", ":")))
+    return total
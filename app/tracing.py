@@ -0,0 +1,442 @@
+"""
+Lightweight OpenTelemetry-compatible request tracing.
+
+TracingMiddleware opens a root span per HTTP request (continuing an incoming
+W3C `traceparent` if present). Code on the request path opens child spans with
+`tracing.span("name")` (or `start_span()` inside async generators, where a
+context variable must not be reset across yields). Span durations are also
+accumulated per phase.
+
+With SERVER_TIMING_ENABLED, responses to authenticated requests (the auth
+dependencies call mark_authenticated()) carry a `Server-Timing` header. Its
+phases do not overlap: every instant covered by finished phase spans is
+counted once, for the innermost phase (client_selection contains
+client_init, parallel image fetches count as wall time), so the phases add
+up to at most `total`.
+
+Sampled traces are handed to a background batch processor and written to the
+configured exporter: OTLP/HTTP JSON, a local JSONL file, or an in-memory list
+(for tests). Exporting never happens on the request path.
+"""
+import asyncio
+import json
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+import config as app_config
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_SERVICE_NAME = "vertex2openai"
+
+
+def _new_id(num_bytes: int) -> str:
+    return os.urandom(num_bytes).hex()
+
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "kind", "phase",
+                 "start_ns", "end_ns", "attributes", "status", "status_message")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str],
+                 kind: int = SPAN_KIND_INTERNAL, phase: Optional[str] = None):
+        self.trace = trace
+        self.name = name
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.phase = phase
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes: Dict[str, Any] = {}
+        self.status = STATUS_OK
+        self.status_message = ""
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def record_error(self, error: BaseException) -> None:
+        self.status = STATUS_ERROR
+        self.status_message = f"{type(error).__name__}: {str(error)[:200]}"
+
+    def end(self) -> None:
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if self.phase:
+            self.trace.add_phase_time(self.phase, (self.end_ns - self.start_ns) / 1e6)
+
+    def to_otlp(self) -> Dict[str, Any]:
+        otlp = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [_otlp_attribute(k, v) for k, v in self.attributes.items()],
+            "status": {"code": self.status, "message": self.status_message} if self.status == STATUS_ERROR else {"code": self.status},
+        }
+        if self.parent_id:
+            otlp["parentSpanId"] = self.parent_id
+        return otlp
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class Trace:
+    """All spans of one request plus the per-phase totals used for Server-Timing."""
+
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans: List[Span] = []
+        # phase name -> accumulated milliseconds, in first-seen order
+        self.phases: Dict[str, float] = {}
+        self.started_at = time.perf_counter()
+        self.authenticated = False
+
+    def start_span(self, name: str, parent_id: Optional[str], kind: int = SPAN_KIND_INTERNAL,
+                   phase: Optional[str] = None) -> Span:
+        new_span = Span(self, name, parent_id, kind, phase)
+        self.spans.append(new_span)
+        return new_span
+
+    def add_phase_time(self, phase: str, duration_ms: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + duration_ms
+
+    def exclusive_phase_times(self) -> Dict[str, float]:
+        """Milliseconds per phase from finished phase spans, each instant attributed to the innermost active span."""
+        events = []
+        for s in self.spans:
+            if s.phase and s.end_ns is not None:
+                events.append((s.start_ns, 1, s))
+                events.append((s.end_ns, 0, s))
+        # 同一时刻先处理结束再处理开始
+        events.sort(key=lambda event: (event[0], event[1]))
+        totals: Dict[str, float] = {}
+        active: List[Span] = []
+        last_ns = 0
+        for ts, is_start, s in events:
+            if active and ts > last_ns:
+                phase = active[-1].phase
+                totals[phase] = totals.get(phase, 0.0) + (ts - last_ns) / 1e6
+            last_ns = ts
+            if is_start:
+                totals.setdefault(s.phase, 0.0)
+                active.append(s)
+            else:
+                active.remove(s)
+        return totals
+
+    def server_timing_header(self) -> str:
+        entries = [f"{name};dur={duration:.1f}" for name, duration in self.exclusive_phase_times().items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.started_at) * 1000:.1f}")
+        return ", ".join(entries)
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("vertex2openai_trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("vertex2openai_span", default=None)
+
+
+class _NoopSpan:
+    """Returned when no trace is active so call sites never need to check."""
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def record_error(self, error: BaseException) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def start_span(name: str, phase: Optional[str] = None, **attributes: Any):
+    """
+    Start a child of the current span without making it current. Use this in
+    async generators and end it explicitly with span.end().
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return _NOOP_SPAN
+    parent = _current_span.get()
+    new_span = trace.start_span(name, parent.span_id if parent else None, phase=phase)
+    new_span.attributes.update(attributes)
+    return new_span
+
+
+@contextmanager
+def span(name: str, phase: Optional[str] = None, **attributes: Any):
+    """Run a block inside a child span that is current for nested spans."""
+    new_span = start_span(name, phase=phase, **attributes)
+    if new_span is _NOOP_SPAN:
+        yield new_span
+        return
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        new_span.end()
+
+
+def mark_authenticated() -> None:
+    """Called once the request's API key is validated; only such responses get a Server-Timing header."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.authenticated = True
+
+
+def add_phase_time(phase: str, duration_ms: float) -> None:
+    """Accumulate time for a phase that is too fine-grained for its own spans (e.g. per-chunk conversion)."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_phase_time(phase, duration_ms)
+
+
+# --- Exporters ---------------------------------------------------------------
+
+class InMemorySpanExporter:
+    """Keeps exported spans in memory; intended for tests."""
+
+    def __init__(self):
+        self.spans: List[Dict[str, Any]] = []
+
+    async def export(self, spans: List[Dict[str, Any]]) -> None:
+        self.spans.extend(spans)
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class JsonlFileSpanExporter:
+    """Appends one OTLP-shaped span per line to a local file."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _write(self, lines: str) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+    async def export(self, spans: List[Dict[str, Any]]) -> None:
+        lines = "".join(json.dumps(s, ensure_ascii=False) + "\n" for s in spans)
+        await asyncio.to_thread(self._write, lines)
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class OtlpHttpSpanExporter:
+    """Sends spans to an OTLP/HTTP collector using the JSON encoding."""
+
+    def __init__(self, endpoint: str, headers: Optional[Dict[str, str]] = None):
+        self.url = endpoint.rstrip("/")
+        if not self.url.endswith("/v1/traces"):
+            self.url += "/v1/traces"
+        self.headers = headers or {}
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def export(self, spans: List[Dict[str, Any]]) -> None:
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=10)
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [_otlp_attribute("service.name", _SERVICE_NAME)]},
+                "scopeSpans": [{"scope": {"name": _SERVICE_NAME}, "spans": spans}],
+            }]
+        }
+        response = await self._client.post(self.url, json=payload, headers=self.headers)
+        response.raise_for_status()
+
+    async def shutdown(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class BatchSpanProcessor:
+    """Buffers finished traces and exports them from a background task."""
+
+    def __init__(self, exporter, max_queue_size: int = 2048, max_batch_size: int = 512,
+                 flush_interval: float = 2.0):
+        self.exporter = exporter
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self._queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize=max_queue_size)
+        self._task: Optional[asyncio.Task] = None
+        self.dropped = 0
+
+    def on_trace_end(self, trace: Trace) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        for finished in trace.spans:
+            try:
+                self._queue.put_nowait(finished.to_otlp())
+            except asyncio.QueueFull:
+                self.dropped += 1
+
+    async def _export_batch(self, batch: List[Dict[str, Any]]) -> None:
+        try:
+            await self.exporter.export(batch)
+        except Exception as e:
+            print(f"WARNING: Span export failed ({len(batch)} spans dropped): {e}")
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            await self._export_batch(batch)
+
+    async def flush(self) -> None:
+        batch: List[Dict[str, Any]] = []
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        if batch:
+            await self._export_batch(batch)
+
+    async def shutdown(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        await self.exporter.shutdown()
+
+
+def create_exporter(kind: str):
+    kind = (kind or "none").lower()
+    if kind == "otlp":
+        return OtlpHttpSpanExporter(app_config.TRACING_OTLP_ENDPOINT)
+    if kind == "jsonl":
+        return JsonlFileSpanExporter(app_config.TRACING_JSONL_PATH)
+    if kind == "memory":
+        return InMemorySpanExporter()
+    return None
+
+
+_exporter = create_exporter(app_config.TRACING_EXPORTER)
+span_processor: Optional[BatchSpanProcessor] = BatchSpanProcessor(_exporter) if _exporter else None
+
+
+def _parse_traceparent(value: str):
+    """Return (trace_id, parent_span_id, sampled) from a W3C traceparent header, or None."""
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3], 16)
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2], bool(flags & 0x01)
+
+
+def _should_sample(trace_id: str) -> bool:
+    # Same idea as OpenTelemetry's TraceIdRatioBased sampler: a stable decision per trace id.
+    rate = app_config.TRACING_SAMPLE_RATE
+    if rate >= 1.0:
+        return True
+    if rate <= 0.0:
+        return False
+    return int(trace_id[-16:], 16) < rate * (1 << 64)
+
+
+class TracingMiddleware:
+    """Pure ASGI middleware: root span, Server-Timing header and hand-off to the exporter."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        parent_span_id = None
+        sampled = None
+        trace_id = None
+        for name, value in scope.get("headers", []):
+            if name == b"traceparent":
+                parsed = _parse_traceparent(value.decode("latin-1"))
+                if parsed:
+                    trace_id, parent_span_id, sampled = parsed
+                break
+        if trace_id is None:
+            trace_id = _new_id(16)
+        if sampled is None:
+            sampled = _should_sample(trace_id)
+
+        trace = Trace(trace_id, sampled)
+        root = trace.start_span(f"{scope.get('method', 'HTTP')} {scope.get('path', '')}",
+                                parent_span_id, kind=SPAN_KIND_SERVER)
+        root.set_attribute("http.method", scope.get("method", ""))
+        root.set_attribute("http.target", scope.get("path", ""))
+        trace_token = _current_trace.set(trace)
+        span_token = _current_span.set(root)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                root.set_attribute("http.status_code", message["status"])
+                if message["status"] >= 500:
+                    root.status = STATUS_ERROR
+                if app_config.SERVER_TIMING_ENABLED and trace.authenticated:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", trace.server_timing_header().encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        except BaseException as e:
+            root.record_error(e)
+            raise
+        finally:
+            _current_span.reset(span_token)
+            _current_trace.reset(trace_token)
+            route_path = getattr(scope.get("route"), "path", None)
+            if route_path:
+                root.name = f"{scope.get('method', 'HTTP')} {route_path}"
+                root.set_attribute("http.route", route_path)
+            for unfinished in trace.spans:
+                unfinished.end()
+            if trace.sampled and span_processor is not None:
+                span_processor.on_trace_end(trace)
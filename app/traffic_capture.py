@@ -0,0 +1,309 @@
+"""
+Opt-in traffic capture to rotating JSONL files.
+
+CaptureMiddleware records one line per sampled HTTP request: the sanitized
+request body, the routing decisions made by the handlers (model, auth path, key
+label, stream mode - taken from the metrics context), the per-phase timings
+collected by tracing, and the response status, size and timing. The files are
+the input format of benchmarks/replay.py.
+
+The request path only copies bytes and enqueues a small dict. JSON parsing,
+redaction, serialization and file I/O happen in a background writer that
+drains a bounded queue in batches (and does the blocking work in a thread).
+When the queue is full, records are dropped and counted; capture never applies
+back-pressure to requests.
+
+Record schema (version 1), one JSON object per line:
+    v, id, ts, method, path, route, query, headers, body, body_bytes,
+    body_truncated, status, response_bytes, ttfb_ms, duration_ms,
+    routing {model, auth_path, key, stream}, phases {name: ms}
+"""
+import asyncio
+import glob
+import json
+import os
+import random
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qsl
+
+import config as app_config
+import metrics
+import tracing
+
+CAPTURE_FORMAT_VERSION = 1
+REDACTED = "[REDACTED]"
+
+# 请求头白名单：只保存重放需要的头，认证相关的头永远不会写入文件
+_HEADER_ALLOWLIST = {
+    b"content-type", b"accept", b"accept-encoding", b"user-agent", b"traceparent",
+    # 影响调度与响应格式的请求头，重放时需要原样带上
+    b"x-request-priority", b"x-request-timeout", b"x-image-response", b"x-image-format",
+}
+
+# Query 参数与 JSON 字段中出现即视为凭证的名字（小写比较）
+_SECRET_NAMES = {
+    "key", "api_key", "apikey", "x-goog-api-key", "authorization", "token", "access_token",
+    "refresh_token", "id_token", "secret", "client_secret", "password", "private_key",
+    "private_key_id", "credentials", "credential",
+}
+
+# 开启内容脱敏时替换为占位符的字段（消息文本、图片数据、工具参数等）
+_CONTENT_STRING_KEYS = {"content", "text", "data", "url", "arguments", "prompt", "input", "system_instruction"}
+_CONTENT_TREE_KEYS = {"args", "response", "functionResponse", "function_response", "systemInstruction"}
+
+
+def redaction_marker(value: str) -> str:
+    """Placeholder that keeps the original length so replays can synthesise a same-size payload."""
+    return f"[REDACTED len={len(value)}]"
+
+
+def _redact_all_strings(value: Any) -> Any:
+    if isinstance(value, str):
+        return redaction_marker(value)
+    if isinstance(value, dict):
+        return {k: _redact_all_strings(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_redact_all_strings(v) for v in value]
+    return value
+
+
+def sanitize(value: Any, redact_content: bool) -> Any:
+    """Recursively drop credential-looking fields and, optionally, message content."""
+    if isinstance(value, dict):
+        cleaned = {}
+        for k, v in value.items():
+            lowered = k.lower() if isinstance(k, str) else k
+            if lowered in _SECRET_NAMES:
+                cleaned[k] = REDACTED
+            elif redact_content and k in _CONTENT_TREE_KEYS:
+                cleaned[k] = _redact_all_strings(v)
+            elif redact_content and k in _CONTENT_STRING_KEYS and isinstance(v, str):
+                cleaned[k] = redaction_marker(v)
+            else:
+                cleaned[k] = sanitize(v, redact_content)
+        return cleaned
+    if isinstance(value, list):
+        return [sanitize(v, redact_content) for v in value]
+    return value
+
+
+def _sanitize_query(query_string: bytes) -> Dict[str, str]:
+    query = {}
+    for k, v in parse_qsl(query_string.decode("latin-1"), keep_blank_values=True):
+        query[k] = REDACTED if k.lower() in _SECRET_NAMES else v
+    return query
+
+
+def _finalize_record(raw: Dict[str, Any], redact_content: bool) -> str:
+    """Runs in the writer thread: parse, sanitize and serialize one record."""
+    body_bytes = raw.pop("_body")
+    body = None
+    if body_bytes and not raw["body_truncated"]:
+        try:
+            body = sanitize(json.loads(body_bytes), redact_content)
+        except (ValueError, UnicodeDecodeError):
+            body = None
+    raw["body"] = body
+    raw["query"] = _sanitize_query(raw["query"])
+    return json.dumps(raw, ensure_ascii=False, separators=(",", ":"))
+
+
+class RotatingJsonlWriter:
+    """Appends lines to size-rotated files and keeps at most `max_files` of them."""
+
+    def __init__(self, directory: str, max_file_bytes: int, max_files: int):
+        self.directory = directory
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self._file = None
+        self._size = 0
+
+    def _open_new_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"capture-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{uuid.uuid4().hex[:6]}.jsonl"
+        self._file = open(os.path.join(self.directory, name), "a", encoding="utf-8")
+        self._size = 0
+        self._prune()
+
+    def _prune(self) -> None:
+        files = sorted(glob.glob(os.path.join(self.directory, "capture-*.jsonl")), key=os.path.getmtime)
+        for old in files[:-self.max_files] if self.max_files > 0 else []:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    def write_lines(self, lines: List[str]) -> None:
+        if self._file is None or self._size >= self.max_file_bytes:
+            self._open_new_file()
+        data = "".join(line + "\n" for line in lines)
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data.encode("utf-8"))
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class CaptureWriter:
+    """Bounded queue plus a lazily started background task that writes batches."""
+
+    def __init__(self, writer: RotatingJsonlWriter, redact_content: bool, max_queue_size: int = 10000,
+                 max_batch_size: int = 256, flush_interval: float = 1.0):
+        self.writer = writer
+        self.redact_content = redact_content
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self._queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize=max_queue_size)
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.dropped = 0
+
+    def submit(self, raw: Dict[str, Any]) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        try:
+            self._queue.put_nowait(raw)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                print(f"WARNING: Traffic capture queue full, {self.dropped} records dropped so far")
+
+    def _write_batch_sync(self, batch: List[Dict[str, Any]]) -> None:
+        lines = []
+        for raw in batch:
+            try:
+                lines.append(_finalize_record(raw, self.redact_content))
+            except Exception as e:
+                print(f"WARNING: Failed to serialize capture record: {e}")
+        if lines:
+            self.writer.write_lines(lines)
+            self.written += len(lines)
+
+    async def _write_batch(self, batch: List[Dict[str, Any]]) -> None:
+        try:
+            await asyncio.to_thread(self._write_batch_sync, batch)
+        except Exception as e:
+            print(f"WARNING: Traffic capture write failed ({len(batch)} records dropped): {e}")
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            await self._write_batch(batch)
+
+    async def flush(self) -> None:
+        batch: List[Dict[str, Any]] = []
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        if batch:
+            await self._write_batch(batch)
+
+    async def shutdown(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        await asyncio.to_thread(self.writer.close)
+
+
+capture_writer: Optional[CaptureWriter] = None
+if app_config.CAPTURE_ENABLED:
+    capture_writer = CaptureWriter(
+        RotatingJsonlWriter(app_config.CAPTURE_DIR, app_config.CAPTURE_MAX_FILE_MB * 1024 * 1024,
+                            app_config.CAPTURE_MAX_FILES),
+        redact_content=app_config.CAPTURE_REDACT_CONTENT,
+        max_queue_size=app_config.CAPTURE_QUEUE_SIZE,
+    )
+
+
+class CaptureMiddleware:
+    """Pure ASGI middleware that hands one raw record per sampled request to the capture writer."""
+
+    def __init__(self, app):
+        self.app = app
+        self.max_body_bytes = app_config.CAPTURE_MAX_BODY_KB * 1024
+        self.exclude_paths = set(app_config.CAPTURE_EXCLUDE_PATHS)
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or capture_writer is None
+                or scope.get("path") in self.exclude_paths
+                or random.random() >= app_config.CAPTURE_SAMPLE_RATE):
+            await self.app(scope, receive, send)
+            return
+
+        started_wall = time.time()
+        started = time.perf_counter()
+        body_chunks: List[bytes] = []
+        state = {"body_bytes": 0, "truncated": False, "status": 0, "response_bytes": 0, "ttfb": None}
+
+        async def capture_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                state["body_bytes"] += len(chunk)
+                if state["body_bytes"] <= self.max_body_bytes:
+                    body_chunks.append(chunk)
+                else:
+                    state["truncated"] = True
+                    body_chunks.clear()
+            return message
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                body = message.get("body", b"")
+                if body and state["ttfb"] is None:
+                    state["ttfb"] = time.perf_counter()
+                state["response_bytes"] += len(body)
+            await send(message)
+
+        try:
+            await self.app(scope, capture_receive, capture_send)
+        finally:
+            finished = time.perf_counter()
+            request_ctx = metrics.current_request()
+            trace = tracing.current_trace()
+            headers = {}
+            for name, value in scope.get("headers", []):
+                if name in _HEADER_ALLOWLIST:
+                    headers[name.decode("latin-1")] = value.decode("latin-1")
+            capture_writer.submit({
+                "v": CAPTURE_FORMAT_VERSION,
+                "id": uuid.uuid4().hex,
+                "ts": round(started_wall, 6),
+                "method": scope.get("method", ""),
+                "path": scope.get("path", ""),
+                "route": getattr(scope.get("route"), "path", None),
+                "query": scope.get("query_string", b""),
+                "headers": headers,
+                "_body": b"".join(body_chunks),
+                "body_bytes": state["body_bytes"],
+                "body_truncated": state["truncated"],
+                "status": state["status"],
+                "response_bytes": state["response_bytes"],
+                "ttfb_ms": round((state["ttfb"] - started) * 1000, 3) if state["ttfb"] is not None else None,
+                "duration_ms": round((finished - started) * 1000, 3),
+                "routing": {
+                    "model": request_ctx.model,
+                    "auth_path": request_ctx.auth_path,
+                    "key": request_ctx.key,
+                    "stream": request_ctx.stream,
+                } if request_ctx is not None else None,
+                "phases": {k: round(v, 3) for k, v in trace.phases.items()} if trace is not None else {},
+            })
@@ -0,0 +1,101 @@
+"""
+Per-worker warmup hooks.
+
+Hooks run from the app's startup event, i.e. inside each worker's event loop and
+before uvicorn starts accepting connections on that worker. They prefill the
+caches the first requests would otherwise pay for. Failures and timeouts are
+logged and never prevent the worker from starting.
+
+Register extra hooks with @startup_hook; each receives the FastAPI app.
+"""
+import asyncio
+from typing import Awaitable, Callable, List
+
+import config as app_config
+from model_loader import DEFAULT_GEMINI_MODELS, ALIAS_MODELS, get_models_config
+from model_routing import compile_model_route, model_capabilities
+from project_id_discovery import discover_project_id
+from api_helpers import create_express_client, get_sa_client
+
+StartupHook = Callable[[object], Awaitable[None]]
+_hooks: List[StartupHook] = []
+
+
+def startup_hook(func: StartupHook) -> StartupHook:
+    _hooks.append(func)
+    return func
+
+
+async def run_startup_hooks(app) -> None:
+    if not app_config.WARMUP_ENABLED:
+        return
+    for hook in _hooks:
+        try:
+            await asyncio.wait_for(hook(app), app_config.WARMUP_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"WARNING: Warmup hook {hook.__name__} timed out after {app_config.WARMUP_TIMEOUT}s")
+        except Exception as e:
+            print(f"WARNING: Warmup hook {hook.__name__} failed: {e}")
+
+
+@startup_hook
+async def prime_model_routes(app) -> None:
+    """预编译常用模型名的路由，并加载模型配置缓存"""
+    await get_models_config()
+    for model in list(DEFAULT_GEMINI_MODELS) + list(ALIAS_MODELS):
+        compile_model_route(model)
+
+
+@startup_hook
+async def prefetch_sa_tokens(app) -> None:
+    """刷新内存中 SA 凭证（GOOGLE_CREDENTIALS_JSON）的 access token；文件凭证每次使用时重新加载，无需预取"""
+    from google.auth.transport.requests import Request as AuthRequest
+
+    credential_manager = app.state.credential_manager
+    pending = [entry["credentials"] for entry in credential_manager.in_memory_credentials
+               if entry.get("credentials") is not None and not entry["credentials"].valid]
+    for credentials in pending:
+        await asyncio.to_thread(credentials.refresh, AuthRequest())
+    if pending:
+        print(f"INFO: Warmup prefetched tokens for {len(pending)} SA credential(s)")
+
+
+@startup_hook
+async def discover_express_project_ids(app) -> None:
+    """提前探测 Express Key 的项目 ID（需要项目端点的模型会用到）"""
+    if not any(model_capabilities(m).express_project_endpoint for m in DEFAULT_GEMINI_MODELS):
+        return
+    keys = [key for _, key in app.state.express_key_manager.get_all_keys_indexed()]
+    if not keys:
+        return
+    results = await asyncio.gather(*(discover_project_id(key) for key in keys), return_exceptions=True)
+    ok = sum(1 for r in results if not isinstance(r, Exception))
+    print(f"INFO: Warmup discovered project IDs for {ok}/{len(keys)} Express key(s)")
+
+
+@startup_hook
+async def prebuild_clients(app) -> None:
+    """为每个 Express Key 与 SA 项目预先构造本 worker 复用的 genai 客户端（见 api_helpers._client_pool）"""
+    # 每种端点各取一个代表模型；项目端点依赖上一个钩子探测到的项目 ID
+    models = {}
+    for model in DEFAULT_GEMINI_MODELS:
+        models.setdefault(model_capabilities(model).express_project_endpoint, model)
+    built = 0
+    for _, key in app.state.express_key_manager.get_all_keys_indexed():
+        for model in models.values():
+            try:
+                await create_express_client(key, model)
+                built += 1
+            except Exception as e:
+                print(f"WARNING: Warmup could not build Express client for {model}: {e}")
+            await asyncio.sleep(0)  # 构造是同步的 CPU 开销：让出事件循环以便超时生效
+
+    credential_manager = app.state.credential_manager
+    for source in credential_manager._get_all_credential_sources():
+        credentials, project_id = await asyncio.to_thread(credential_manager._load_credential_from_source, source)
+        if credentials and project_id:
+            get_sa_client(credentials, project_id)
+            built += 1
+            await asyncio.sleep(0)
+    if built:
+        print(f"INFO: Warmup built {built} pooled genai client(s)")
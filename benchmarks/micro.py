@@ -0,0 +1,381 @@
+"""
+Micro-benchmarks for the per-message / per-chunk conversion hot paths.
+
+Each case times one function on a synthetic fixture (built locally, no network) and
+reports pytest-benchmark style statistics per call. Results can be saved as a baseline
+and later compared against it; ``--threshold`` makes the run fail when any case got
+slower than the baseline by more than the given percentage.
+
+Examples::
+
+    python benchmarks/micro.py --save benchmarks/baselines/micro.json
+    python benchmarks/micro.py --compare benchmarks/baselines/micro.json --threshold 15
+
+Baselines are only comparable on the same machine and Python version; regenerate the
+checked-in one when either changes.
+"""
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "app"))
+
+from google.genai import types  # noqa: E402
+
+from api_helpers import StreamingReasoningProcessor  # noqa: E402
+from config import VERTEX_REASONING_TAG  # noqa: E402
+from message_processing import (  # noqa: E402
+    _extract_markdown_images_to_parts,
+    convert_chunk_to_openai,
+    create_gemini_prompt,
+    process_gemini_response_to_openai_dict,
+)
+from models import OpenAIMessage  # noqa: E402
+from routes.gemini_api import GeminiRequest, build_contents, convert_response_to_gemini_format  # noqa: E402
+
+SEED = 20240601
+WORDS = (
+    "the model request stream token vertex gemini adapter latency chunk message history "
+    "function image response reasoning content express project key quota region cache"
+).split()
+
+
+# ---------------------------------------------------------------------------
+# Synthetic fixtures
+# ---------------------------------------------------------------------------
+
+def _sentence(rng: random.Random, n_words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n_words)).capitalize() + "."
+
+
+def _paragraph(rng: random.Random, n_chars: int) -> str:
+    out = []
+    size = 0
+    while size < n_chars:
+        s = _sentence(rng, rng.randint(6, 18))
+        out.append(s)
+        size += len(s) + 1
+    return " ".join(out)
+
+
+def _fake_image_b64(rng: random.Random, n_bytes: int) -> str:
+    # PNG 文件头 + 随机字节，只用于解码/拷贝开销，不需要是合法图片
+    payload = b"\x89PNG\r\n\x1a\n" + bytes(rng.getrandbits(8) for _ in range(n_bytes))
+    return base64.b64encode(payload).decode("ascii")
+
+
+def fixture_long_history(rng: random.Random) -> List[OpenAIMessage]:
+    messages = [OpenAIMessage(role="system", content=_paragraph(rng, 800))]
+    for i in range(200):
+        role = "user" if i % 2 == 0 else "assistant"
+        messages.append(OpenAIMessage(role=role, content=_paragraph(rng, rng.randint(200, 1200))))
+    return messages
+
+
+def fixture_image_heavy(rng: random.Random) -> List[OpenAIMessage]:
+    messages = []
+    for i in range(12):
+        image = _fake_image_b64(rng, 48 * 1024)
+        if i % 2 == 0:
+            content = [
+                {"type": "text", "text": _paragraph(rng, 300)},
+                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image}"}},
+                {"type": "text", "text": f"See ![diagram](data:image/jpeg;base64,{_fake_image_b64(rng, 16 * 1024)}) above."},
+            ]
+            messages.append(OpenAIMessage(role="user", content=content))
+        else:
+            text = f"{_paragraph(rng, 400)}\n\n![generated](data:image/png;base64,{image})\n\n{_paragraph(rng, 120)}"
+            messages.append(OpenAIMessage(role="assistant", content=text))
+    return messages
+
+
+def fixture_tool_chain(rng: random.Random) -> List[OpenAIMessage]:
+    messages = [OpenAIMessage(role="user", content=_paragraph(rng, 400))]
+    for i in range(40):
+        call_id = f"call_{i}"
+        args = {"query": _sentence(rng, 8), "limit": rng.randint(1, 50), "filters": {"region": rng.choice(WORDS)}}
+        messages.append(OpenAIMessage(role="assistant", content=None, tool_calls=[{
+            "id": call_id, "type": "function", "function": {"name": f"tool_{i % 5}", "arguments": json.dumps(args)},
+        }]))
+        result = {"items": [{"id": j, "title": _sentence(rng, 6), "score": rng.random()} for j in range(8)]}
+        messages.append(OpenAIMessage(role="tool", name=f"tool_{i % 5}", tool_call_id=call_id, content=json.dumps(result)))
+    messages.append(OpenAIMessage(role="assistant", content=_paragraph(rng, 600)))
+    return messages
+
+
+def fixture_markdown_text(rng: random.Random) -> str:
+    pieces = []
+    for _ in range(6):
+        pieces.append(_paragraph(rng, 500))
+        pieces.append(f"![img](data:image/png;base64,{_fake_image_b64(rng, 24 * 1024)})")
+    return "\n\n".join(pieces)
+
+
+def fixture_markdown_plain(rng: random.Random) -> str:
+    return _paragraph(rng, 4000)
+
+
+def fixture_stream_chunk(rng: random.Random) -> types.GenerateContentResponse:
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(
+            content=types.Content(role="model", parts=[types.Part(text=_paragraph(rng, 80))]),
+            index=0,
+        )],
+    )
+
+
+def fixture_stream_chunk_thought(rng: random.Random) -> types.GenerateContentResponse:
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(
+            content=types.Content(role="model", parts=[
+                types.Part(text=_paragraph(rng, 120), thought=True),
+                types.Part(text=_paragraph(rng, 60)),
+            ]),
+            index=0,
+        )],
+    )
+
+
+def fixture_full_response(rng: random.Random) -> types.GenerateContentResponse:
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(
+            content=types.Content(role="model", parts=[
+                types.Part(text=_paragraph(rng, 1500), thought=True, thought_signature=b"sig" * 64),
+                types.Part(text=_paragraph(rng, 3000)),
+            ]),
+            finish_reason=types.FinishReason.STOP,
+            index=0,
+        )],
+        usage_metadata=types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=1200, candidates_token_count=900, total_token_count=2100, thoughts_token_count=400,
+        ),
+        model_version="gemini-2.5-flash",
+    )
+
+
+def fixture_function_call_response(rng: random.Random) -> types.GenerateContentResponse:
+    parts = [
+        types.Part(function_call=types.FunctionCall(name=f"tool_{i}", args={"query": _sentence(rng, 10), "page": i}))
+        for i in range(4)
+    ]
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=parts), finish_reason=types.FinishReason.STOP, index=0)],
+    )
+
+
+def fixture_image_response(rng: random.Random) -> types.GenerateContentResponse:
+    image = base64.b64decode(_fake_image_b64(rng, 256 * 1024))
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(
+            content=types.Content(role="model", parts=[
+                types.Part(text=_paragraph(rng, 200)),
+                types.Part(inline_data=types.Blob(mime_type="image/png", data=image)),
+            ]),
+            finish_reason=types.FinishReason.STOP,
+            index=0,
+        )],
+    )
+
+
+def fixture_reasoning_stream(rng: random.Random) -> List[str]:
+    # 推理标签被随机切分在 chunk 边界上
+    text = (
+        f"<{VERTEX_REASONING_TAG}>{_paragraph(rng, 3000)}</{VERTEX_REASONING_TAG}>"
+        f"{_paragraph(rng, 3000)}"
+    )
+    chunks = []
+    pos = 0
+    while pos < len(text):
+        size = rng.randint(3, 40)
+        chunks.append(text[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def fixture_gemini_request(rng: random.Random) -> GeminiRequest:
+    contents = []
+    for i in range(60):
+        if i % 10 == 3:
+            contents.append({"role": "model", "parts": [{"functionCall": {"name": "lookup", "args": {"q": _sentence(rng, 6)}}}]})
+            contents.append({"role": "user", "parts": [{"functionResponse": {"name": "lookup", "response": {"result": _paragraph(rng, 300)}}}]})
+        elif i % 10 == 7:
+            contents.append({"role": "user", "parts": [
+                {"text": _paragraph(rng, 200)},
+                {"inlineData": {"mimeType": "image/png", "data": _fake_image_b64(rng, 32 * 1024)}},
+            ]})
+        else:
+            contents.append({"role": "user" if i % 2 == 0 else "model", "parts": [{"text": _paragraph(rng, rng.randint(200, 1200))}]})
+    return GeminiRequest(contents=contents)
+
+
+# ---------------------------------------------------------------------------
+# Cases
+# ---------------------------------------------------------------------------
+
+def _process_reasoning_stream(chunks: List[str]) -> None:
+    processor = StreamingReasoningProcessor(VERTEX_REASONING_TAG)
+    for chunk in chunks:
+        processor.process_chunk(chunk)
+
+
+def build_cases() -> List[Tuple[str, Callable[[], Any]]]:
+    rng = random.Random(SEED)
+    long_history = fixture_long_history(rng)
+    image_heavy = fixture_image_heavy(rng)
+    tool_chain = fixture_tool_chain(rng)
+    markdown_text = fixture_markdown_text(rng)
+    markdown_plain = fixture_markdown_plain(rng)
+    stream_chunk = fixture_stream_chunk(rng)
+    stream_chunk_thought = fixture_stream_chunk_thought(rng)
+    full_response = fixture_full_response(rng)
+    function_call_response = fixture_function_call_response(rng)
+    image_response = fixture_image_response(rng)
+    reasoning_chunks = fixture_reasoning_stream(rng)
+    gemini_request = fixture_gemini_request(rng)
+
+    return [
+        ("create_gemini_prompt[long_history]", lambda: create_gemini_prompt(long_history)),
+        ("create_gemini_prompt[image_heavy]", lambda: create_gemini_prompt(image_heavy)),
+        ("create_gemini_prompt[tool_chain]", lambda: create_gemini_prompt(tool_chain)),
+        ("_extract_markdown_images_to_parts[images]", lambda: _extract_markdown_images_to_parts(markdown_text)),
+        ("_extract_markdown_images_to_parts[plain]", lambda: _extract_markdown_images_to_parts(markdown_plain)),
+        ("convert_chunk_to_openai[text]", lambda: convert_chunk_to_openai(stream_chunk, "gemini-2.5-flash", "chatcmpl-bench")),
+        ("convert_chunk_to_openai[thought]", lambda: convert_chunk_to_openai(stream_chunk_thought, "gemini-2.5-flash", "chatcmpl-bench")),
+        ("process_gemini_response_to_openai_dict[text]", lambda: process_gemini_response_to_openai_dict(full_response, "gemini-2.5-flash")),
+        ("process_gemini_response_to_openai_dict[tool_calls]", lambda: process_gemini_response_to_openai_dict(function_call_response, "gemini-2.5-flash")),
+        ("StreamingReasoningProcessor.process_chunk[stream]", lambda: _process_reasoning_stream(reasoning_chunks)),
+        ("convert_response_to_gemini_format[text]", lambda: convert_response_to_gemini_format(full_response, "gemini-2.5-flash")),
+        ("convert_response_to_gemini_format[image]", lambda: convert_response_to_gemini_format(image_response, "gemini-2.5-flash")),
+        ("convert_response_to_gemini_format[chunk]", lambda: convert_response_to_gemini_format(stream_chunk, "gemini-2.5-flash")),
+        ("build_contents[mixed]", lambda: build_contents(gemini_request)),
+    ]
+
+
+# ---------------------------------------------------------------------------
+# Runner
+# ---------------------------------------------------------------------------
+
+def _calibrate(func: Callable[[], Any], min_round_time: float) -> int:
+    iterations = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_round_time or iterations >= 1_000_000:
+            return iterations
+        iterations = max(iterations * 2, int(iterations * min_round_time / max(elapsed, 1e-9)))
+
+
+def measure(func: Callable[[], Any], rounds: int, min_round_time: float) -> Dict[str, Any]:
+    # 被测函数自带大量 print，计时期间丢弃输出（print 本身的开销仍计入）
+    with contextlib.redirect_stdout(io.StringIO()) as sink:
+        func()  # warm-up
+        iterations = _calibrate(func, min_round_time)
+        per_call = []
+        for _ in range(rounds):
+            sink.seek(0)
+            sink.truncate()
+            started = time.perf_counter()
+            for _ in range(iterations):
+                func()
+            per_call.append((time.perf_counter() - started) / iterations * 1e6)
+    return {
+        "min_us": round(min(per_call), 3),
+        "median_us": round(statistics.median(per_call), 3),
+        "mean_us": round(statistics.fmean(per_call), 3),
+        "stddev_us": round(statistics.stdev(per_call), 3) if len(per_call) > 1 else 0.0,
+        "rounds": rounds,
+        "iterations": iterations,
+    }
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], metric: str,
+            threshold: Optional[float]) -> List[str]:
+    regressions = []
+    print(f"{'case':<55} {'baseline':>12} {'current':>12} {'change':>9}", file=sys.stderr)
+    for name, stats in results.items():
+        base = baseline.get(name)
+        if not base or not base.get(metric):
+            print(f"{name:<55} {'-':>12} {stats[metric]:>12.2f} {'new':>9}", file=sys.stderr)
+            continue
+        change = (stats[metric] - base[metric]) / base[metric] * 100
+        flag = ""
+        if threshold is not None and change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<55} {base[metric]:>12.2f} {stats[metric]:>12.2f} {change:>+8.1f}%{flag}", file=sys.stderr)
+    return regressions
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for message conversion and chunk translation")
+    parser.add_argument("--filter", "-k", help="Only run cases whose name contains this substring")
+    parser.add_argument("--rounds", type=int, default=7)
+    parser.add_argument("--min-round-time", type=float, default=0.1, help="Seconds per round used for calibration")
+    parser.add_argument("--save", help="Write results as JSON to this path (e.g. a new baseline)")
+    parser.add_argument("--compare", help="Baseline JSON to compare against")
+    parser.add_argument("--metric", choices=["min_us", "median_us", "mean_us"], default="min_us",
+                        help="Statistic compared against the baseline (min is the least noisy)")
+    parser.add_argument("--threshold", type=float, help="Fail if any case is slower than the baseline by more than this percentage")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.threshold is not None and not args.compare:
+        print("ERROR: --threshold requires --compare", file=sys.stderr)
+        return 2
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        cases = build_cases()
+    if args.filter:
+        cases = [(name, func) for name, func in cases if args.filter in name]
+
+    results: Dict[str, Dict[str, Any]] = {}
+    for name, func in cases:
+        results[name] = measure(func, args.rounds, args.min_round_time)
+        print(f"INFO: {name}: median {results[name]['median_us']:.2f} us ({results[name]['iterations']} x {args.rounds})", file=sys.stderr)
+
+    report = {
+        "benchmark": "micro",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            f.write(text + "\n")
+        print(f"INFO: Results written to {args.save}", file=sys.stderr)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("python") != report["python"] or baseline.get("machine") != report["machine"]:
+            print(f"WARNING: Baseline was recorded on Python {baseline.get('python')} / {baseline.get('machine')}; "
+                  f"numbers may not be comparable.", file=sys.stderr)
+        regressions = compare(results, baseline.get("results", {}), args.metric, args.threshold)
+        if regressions:
+            print(f"ERROR: {len(regressions)} case(s) slower than baseline by more than {args.threshold}%: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
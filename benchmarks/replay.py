@@ -0,0 +1,319 @@
+"""
+Replay captured traffic against a running instance.
+
+Reads the JSONL files written by the capture middleware (``CAPTURE_ENABLED=true``,
+see ``app/traffic_capture.py``) and re-sends the requests:
+
+- ``--mode open`` (default) sends each request at its recorded offset from the first
+  one, divided by ``--speed``, regardless of how long earlier requests take.
+- ``--mode closed`` keeps ``--concurrency`` requests in flight and sends the next one
+  as soon as a slot frees up, ignoring the recorded timing.
+
+Content redacted at capture time (``[REDACTED len=N]``) is replaced with synthetic
+text or base64 data of the same length. The report groups latency and TTFT by the
+model-name route (``[EXPRESS]``, ``-openai``, ``-search``, ``-nothinking``, ``-max``,
+...) plus the Gemini native endpoints.
+
+Example::
+
+    python benchmarks/replay.py captures/*.jsonl --base-url http://127.0.0.1:8050 \\
+        --api-key $API_KEY --speed 4 -o replay.json
+"""
+import argparse
+import asyncio
+import base64
+import glob
+import json
+import os
+import re
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from run_e2e import summarize
+
+REDACTED_RE = re.compile(r"^\[REDACTED len=(\d+)\]$")
+FILLER = "Replay filler text for a redacted message. "
+# 原样重放的请求头（认证头由 --api-key 重新生成）
+REPLAYED_HEADERS = (
+    "content-type", "accept", "x-request-priority", "x-request-timeout", "x-image-response", "x-image-format",
+)
+
+# 模型名前缀/后缀 -> 路由分组，与 routes/chat_api.py 的解析规则一致
+MODEL_PREFIXES = ["[EXPRESS] ", "[PAY]"]
+MODEL_SUFFIXES = [
+    "-openaisearch", "-openai", "-encrypt-full", "-encrypt", "-search", "-nothinking",
+    "-max", "-auto", "-2k", "-4k",
+]
+GEMINI_NATIVE_RE = re.compile(r"^/gemini/v1beta/models/([^/:]+):(\w+)$")
+
+
+def load_records(paths: List[str]) -> List[Dict[str, Any]]:
+    files: List[str] = []
+    for pattern in paths:
+        matched = sorted(glob.glob(pattern))
+        files.extend(matched if matched else [pattern])
+    records = []
+    for path in files:
+        with open(path, encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print(f"WARNING: Skipping malformed line {path}:{line_no}", file=sys.stderr)
+    records.sort(key=lambda r: r.get("ts", 0))
+    return records
+
+
+def _synthetic_text(n: int) -> str:
+    return (FILLER * (n // len(FILLER) + 1))[:n]
+
+
+def _synthetic_b64(n: int) -> str:
+    raw = os.urandom(max(1, n * 3 // 4))
+    return base64.b64encode(raw).decode("ascii")[:n]
+
+
+def restore_redacted(value: Any, key: Optional[str] = None) -> Any:
+    """Replace length placeholders with same-size synthetic content."""
+    if isinstance(value, str):
+        match = REDACTED_RE.match(value)
+        if not match:
+            return value
+        n = int(match.group(1))
+        if key == "data":
+            return _synthetic_b64(n)
+        if key == "url":
+            prefix = "data:image/png;base64,"
+            return prefix + _synthetic_b64(max(0, n - len(prefix)))
+        if key == "arguments":
+            return json.dumps({"input": _synthetic_text(max(0, n - 13))})
+        return _synthetic_text(n)
+    if isinstance(value, dict):
+        restored = {k: restore_redacted(v, k) for k, v in value.items()}
+        # 工具参数被整体脱敏后只能还原为普通对象
+        for tree_key in ("args", "response"):
+            if isinstance(restored.get(tree_key), str):
+                restored[tree_key] = {"value": restored[tree_key]}
+        return restored
+    if isinstance(value, list):
+        return [restore_redacted(v, key) for v in value]
+    return value
+
+
+def classify(record: Dict[str, Any]) -> Tuple[str, bool]:
+    """Return (route group, is_stream) for a captured request."""
+    path = record.get("path", "")
+    body = record.get("body") or {}
+    native = GEMINI_NATIVE_RE.match(path)
+    if native:
+        return f"gemini:{native.group(2)}", native.group(2) == "streamGenerateContent"
+    if path != "/v1/chat/completions":
+        return f"{record.get('method', 'GET')} {path}", False
+
+    model = str(body.get("model", ""))
+    tags = []
+    for prefix in MODEL_PREFIXES:
+        if model.startswith(prefix):
+            tags.append(prefix.strip())
+            model = model[len(prefix):]
+    for suffix in MODEL_SUFFIXES:
+        if model.endswith(suffix):
+            tags.append(suffix)
+            break
+    stream = bool(body.get("stream"))
+    group = "chat:" + ("".join(tags) if tags else "base") + (":stream" if stream else "")
+    return group, stream
+
+
+def build_request(record: Dict[str, Any], api_key: str) -> Optional[Dict[str, Any]]:
+    method = record.get("method", "POST")
+    if record.get("body_truncated") or (record.get("body") is None and record.get("body_bytes")):
+        return None
+    headers = {k: v for k, v in (record.get("headers") or {}).items() if k in REPLAYED_HEADERS}
+    if record.get("path", "").startswith("/gemini/"):
+        headers["x-goog-api-key"] = api_key
+    else:
+        headers["Authorization"] = f"Bearer {api_key}"
+    params = {k: v for k, v in (record.get("query") or {}).items() if k != "key"}
+    body = restore_redacted(record["body"]) if record.get("body") is not None else None
+    group, stream = classify(record)
+    return {
+        "method": method, "path": record.get("path", "/"), "params": params, "headers": headers,
+        "json": body, "group": group, "stream": stream, "ts": record.get("ts", 0.0),
+    }
+
+
+async def send(client: httpx.AsyncClient, spec: Dict[str, Any]) -> Dict[str, Any]:
+    started = time.perf_counter()
+    ttft = None
+    try:
+        async with client.stream(spec["method"], spec["path"], params=spec["params"], headers=spec["headers"],
+                                 json=spec["json"]) as response:
+            async for chunk in response.aiter_bytes():
+                if ttft is None and chunk:
+                    ttft = (time.perf_counter() - started) * 1000
+            status = response.status_code
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    latency = (time.perf_counter() - started) * 1000
+    return {"group": spec["group"], "stream": spec["stream"], "status": status,
+            "ok": status == 200, "latency_ms": latency, "ttft_ms": ttft}
+
+
+async def replay_open_loop(client: httpx.AsyncClient, specs: List[Dict[str, Any]], speed: float,
+                           max_in_flight: int) -> Tuple[List[Dict[str, Any]], List[float]]:
+    results: List[Dict[str, Any]] = []
+    lags: List[float] = []
+    slots = asyncio.Semaphore(max_in_flight)
+    first_ts = specs[0]["ts"]
+    started = time.perf_counter()
+
+    async def fire(spec):
+        try:
+            results.append(await send(client, spec))
+        finally:
+            slots.release()
+
+    tasks = []
+    for spec in specs:
+        due = (spec["ts"] - first_ts) / speed
+        delay = due - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await slots.acquire()
+        # 调度滞后：实际发出时间晚于计划时间的毫秒数（压测端自身是否跟得上）
+        lags.append(max(0.0, (time.perf_counter() - started - due) * 1000))
+        tasks.append(asyncio.create_task(fire(spec)))
+    await asyncio.gather(*tasks)
+    return results, lags
+
+
+async def replay_closed_loop(client: httpx.AsyncClient, specs: List[Dict[str, Any]],
+                             concurrency: int) -> List[Dict[str, Any]]:
+    results: List[Dict[str, Any]] = []
+    queue = list(reversed(specs))
+
+    async def worker():
+        while queue:
+            results.append(await send(client, queue.pop()))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results
+
+
+def report(results: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for r in results:
+        groups.setdefault(r["group"], []).append(r)
+
+    per_group = {}
+    for group, items in sorted(groups.items()):
+        ok = [r for r in items if r["ok"]]
+        errors: Dict[str, int] = {}
+        for r in items:
+            if not r["ok"]:
+                errors[str(r["status"])] = errors.get(str(r["status"]), 0) + 1
+        streamed = [r["ttft_ms"] for r in ok if r["stream"] and r["ttft_ms"] is not None]
+        per_group[group] = {
+            "requests": len(items),
+            "ok": len(ok),
+            "errors": errors,
+            "latency_ms": summarize([r["latency_ms"] for r in ok]),
+            "ttft_ms": summarize(streamed) if streamed else None,
+        }
+    ok_all = [r for r in results if r["ok"]]
+    return {
+        "requests": len(results),
+        "ok": len(ok_all),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(ok_all) / elapsed, 2) if elapsed > 0 else None,
+        "latency_ms": summarize([r["latency_ms"] for r in ok_all]),
+        "routes": per_group,
+    }
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    records = load_records(args.files)
+    specs = []
+    skipped = 0
+    for record in records:
+        if args.path_filter and not re.search(args.path_filter, record.get("path", "")):
+            continue
+        spec = build_request(record, args.api_key)
+        if spec is None:
+            skipped += 1
+            continue
+        specs.append(spec)
+    if args.limit:
+        specs = specs[:args.limit]
+    if not specs:
+        raise SystemExit("ERROR: No replayable requests found")
+    specs = specs * args.repeat if args.mode == "closed" else specs
+    print(f"INFO: Replaying {len(specs)} requests ({skipped} skipped) in {args.mode}-loop mode", file=sys.stderr)
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=httpx.Timeout(args.timeout)) as client:
+        started = time.perf_counter()
+        lags: List[float] = []
+        if args.mode == "open":
+            results, lags = await replay_open_loop(client, specs, args.speed, args.max_in_flight)
+        else:
+            results = await replay_closed_loop(client, specs, args.concurrency)
+        elapsed = time.perf_counter() - started
+
+    result = {
+        "benchmark": "replay",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {
+            "files": args.files, "base_url": args.base_url, "mode": args.mode, "speed": args.speed,
+            "concurrency": args.concurrency, "max_in_flight": args.max_in_flight,
+        },
+        "recorded_span_s": round(specs[-1]["ts"] - specs[0]["ts"], 3) if args.mode == "open" else None,
+        "skipped": skipped,
+        **report(results, elapsed),
+    }
+    if lags:
+        result["schedule_lag_ms"] = summarize(lags)
+    return result
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Replay captured JSONL traffic against a running instance")
+    parser.add_argument("files", nargs="+", help="Capture files or glob patterns")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8050")
+    parser.add_argument("--api-key", default=os.environ.get("API_KEY", ""), help="Adapter API key (default: $API_KEY)")
+    parser.add_argument("--mode", choices=["open", "closed"], default="open")
+    parser.add_argument("--speed", type=float, default=1.0, help="Open loop: replay N times faster than recorded")
+    parser.add_argument("--max-in-flight", type=int, default=1000, help="Open loop: cap on concurrent requests")
+    parser.add_argument("--concurrency", type=int, default=16, help="Closed loop: requests kept in flight")
+    parser.add_argument("--repeat", type=int, default=1, help="Closed loop: replay the capture this many times")
+    parser.add_argument("--limit", type=int, default=0, help="Only replay the first N requests")
+    parser.add_argument("--path-filter", help="Regex; only replay requests whose path matches")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--output", "-o", help="Write the JSON report here (default: stdout)")
+    args = parser.parse_args(argv)
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+    return args
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    result = asyncio.run(run(args))
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        print(f"INFO: Report written to {args.output}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+"""
+Offline end-to-end benchmark for the adapter.
+
+Starts ``stub_vertex.py`` and the app (uvicorn, Express-key mode pointed at the stub via
+``VERTEX_API_BASE``), drives ``/v1/chat/completions`` and ``/gemini/v1beta/...`` at a
+fixed concurrency and writes a JSON report with throughput, latency / TTFT percentiles
+and the app process' CPU time and RSS.
+
+Example::
+
+    python benchmarks/run_e2e.py --concurrency 32 --requests 500 --output bench.json
+
+CPU and RSS are read from ``/proc`` and are therefore only reported on Linux.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(REPO_ROOT, "app")
+STUB_SCRIPT = os.path.join(REPO_ROOT, "benchmarks", "stub_vertex.py")
+
+BENCH_API_KEY = "bench-api-key"
+BENCH_EXPRESS_KEY = "bench-express-key"
+
+# 场景名 -> (HTTP 路径模板, 是否流式)
+SCENARIOS = {
+    "chat": ("/v1/chat/completions", False),
+    "chat-stream": ("/v1/chat/completions", True),
+    "chat-openai": ("/v1/chat/completions", False),
+    "chat-openai-stream": ("/v1/chat/completions", True),
+    "gemini": ("/gemini/v1beta/models/{model}:generateContent", False),
+    "gemini-stream": ("/gemini/v1beta/models/{model}:streamGenerateContent?alt=sse", True),
+}
+DEFAULT_SCENARIOS = ["chat", "chat-stream", "chat-openai-stream", "gemini", "gemini-stream"]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    ordered = sorted(values)
+    if not ordered:
+        return {"count": 0, "mean": None, "p50": None, "p90": None, "p99": None, "max": None}
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 3),
+        "p50": round(_percentile(ordered, 50), 3),
+        "p90": round(_percentile(ordered, 90), 3),
+        "p99": round(_percentile(ordered, 99), 3),
+        "max": round(ordered[-1], 3),
+    }
+
+
+class ProcessSampler:
+    """Samples CPU time and RSS of a process from /proc (Linux only)."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self.peak_rss_mb = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def cpu_seconds(self) -> Optional[float]:
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            # utime / stime are fields 14 and 15 (1-based) of /proc/<pid>/stat
+            return (int(fields[11]) + int(fields[12])) / self.clock_ticks
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def rss_mb(self) -> Optional[float]:
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) / 1024
+        except (OSError, ValueError):
+            pass
+        return None
+
+    async def _sample_loop(self, interval: float) -> None:
+        while True:
+            rss = self.rss_mb()
+            if rss is not None:
+                self.peak_rss_mb = max(self.peak_rss_mb, rss)
+            await asyncio.sleep(interval)
+
+    def start(self, interval: float = 0.1) -> None:
+        self.peak_rss_mb = self.rss_mb() or 0.0
+        self._task = asyncio.create_task(self._sample_loop(interval))
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def build_request(scenario: str, model: str, prompt_chars: int) -> Dict[str, Any]:
+    path_template, stream = SCENARIOS[scenario]
+    prompt = ("benchmark " * (prompt_chars // 10 + 1))[:prompt_chars]
+    if scenario.startswith("chat"):
+        request_model = f"[EXPRESS] {model}-openai" if scenario.startswith("chat-openai") else model
+        body = {"model": request_model, "messages": [{"role": "user", "content": prompt}], "stream": stream}
+        headers = {"Authorization": f"Bearer {BENCH_API_KEY}"}
+    else:
+        body = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+        headers = {"x-goog-api-key": BENCH_API_KEY}
+    return {"path": path_template.format(model=model), "stream": stream, "json": body, "headers": headers}
+
+
+async def one_request(client: httpx.AsyncClient, spec: Dict[str, Any]) -> Dict[str, Any]:
+    started = time.perf_counter()
+    ttft = None
+    size = 0
+    try:
+        if spec["stream"]:
+            async with client.stream("POST", spec["path"], json=spec["json"], headers=spec["headers"]) as response:
+                async for chunk in response.aiter_bytes():
+                    if ttft is None and chunk:
+                        ttft = (time.perf_counter() - started) * 1000
+                    size += len(chunk)
+                status = response.status_code
+                # 流式错误以 SSE 形式返回，状态码仍为 200
+                failed = status != 200
+        else:
+            response = await client.post(spec["path"], json=spec["json"], headers=spec["headers"])
+            size = len(response.content)
+            status = response.status_code
+            failed = status != 200
+    except httpx.HTTPError as e:
+        return {"ok": False, "status": type(e).__name__, "latency_ms": (time.perf_counter() - started) * 1000, "ttft_ms": None, "bytes": 0}
+    return {"ok": not failed, "status": status, "latency_ms": (time.perf_counter() - started) * 1000, "ttft_ms": ttft, "bytes": size}
+
+
+async def run_scenario(client: httpx.AsyncClient, sampler: Optional[ProcessSampler], scenario: str,
+                       args: argparse.Namespace) -> Dict[str, Any]:
+    spec = build_request(scenario, args.model, args.prompt_chars)
+
+    for _ in range(args.warmup):
+        await one_request(client, spec)
+
+    results: List[Dict[str, Any]] = []
+    remaining = args.requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            results.append(await one_request(client, spec))
+
+    cpu_before = sampler.cpu_seconds() if sampler else None
+    rss_before = sampler.rss_mb() if sampler else None
+    if sampler:
+        sampler.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    if sampler:
+        await sampler.stop()
+    cpu_after = sampler.cpu_seconds() if sampler else None
+
+    ok = [r for r in results if r["ok"]]
+    errors: Dict[str, int] = {}
+    for r in results:
+        if not r["ok"]:
+            errors[str(r["status"])] = errors.get(str(r["status"]), 0) + 1
+
+    cpu_seconds = None
+    if cpu_before is not None and cpu_after is not None:
+        cpu_seconds = round(cpu_after - cpu_before, 3)
+
+    return {
+        "scenario": scenario,
+        "path": spec["path"],
+        "stream": spec["stream"],
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed > 0 else None,
+        "latency_ms": summarize([r["latency_ms"] for r in ok]),
+        "ttft_ms": summarize([r["ttft_ms"] for r in ok if r["ttft_ms"] is not None]) if spec["stream"] else None,
+        "response_bytes_mean": round(sum(r["bytes"] for r in ok) / len(ok), 1) if ok else None,
+        "cpu_seconds": cpu_seconds,
+        "cpu_percent": round(cpu_seconds / elapsed * 100, 1) if cpu_seconds is not None and elapsed > 0 else None,
+        "rss_mb": {
+            "start": round(rss_before, 1) if rss_before is not None else None,
+            "peak": round(sampler.peak_rss_mb, 1) if sampler else None,
+            "end": round(sampler.rss_mb(), 1) if sampler and sampler.rss_mb() is not None else None,
+        },
+    }
+
+
+async def wait_until_ready(url: str, timeout: float, proc: subprocess.Popen) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"Process exited early with code {proc.returncode} while waiting for {url}")
+            try:
+                response = await client.get(url, timeout=1.0)
+                if response.status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"Timed out waiting for {url}")
+
+
+def stub_command(args: argparse.Namespace, port: int) -> List[str]:
+    return [
+        sys.executable, STUB_SCRIPT,
+        "--port", str(port),
+        "--latency-ms", str(args.stub_latency_ms),
+        "--jitter-ms", str(args.stub_jitter_ms),
+        "--chunks", str(args.stub_chunks),
+        "--chunk-interval-ms", str(args.stub_chunk_interval_ms),
+        "--chunk-chars", str(args.stub_chunk_chars),
+        "--response-chars", str(args.stub_response_chars),
+    ]
+
+
+def app_env(args: argparse.Namespace, stub_port: int, credentials_dir: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    for name in ("GOOGLE_CREDENTIALS_JSON", "PROXY_URL", "SSL_CERT_FILE", "HUGGINGFACE"):
+        env.pop(name, None)
+    env.update({
+        "API_KEY": BENCH_API_KEY,
+        "VERTEX_EXPRESS_API_KEY": BENCH_EXPRESS_KEY,
+        "VERTEX_API_BASE": f"http://127.0.0.1:{stub_port}",
+        "CREDENTIALS_DIR": credentials_dir,
+        "PYTHONUNBUFFERED": "1",
+    })
+    for item in args.app_env:
+        name, _, value = item.partition("=")
+        env[name] = value
+    return env
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    stub_port = args.stub_port or _free_port()
+    app_port = args.app_port or _free_port()
+    log_path = args.app_log or os.devnull
+
+    with tempfile.TemporaryDirectory() as credentials_dir, open(log_path, "w") as app_log:
+        stub = subprocess.Popen(stub_command(args, stub_port), stdout=subprocess.DEVNULL)
+        app = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(app_port),
+             "--log-level", "warning", "--no-access-log"],
+            cwd=APP_DIR, env=app_env(args, stub_port, credentials_dir), stdout=app_log, stderr=subprocess.STDOUT,
+        )
+        try:
+            await wait_until_ready(f"http://127.0.0.1:{stub_port}/health", 15, stub)
+            await wait_until_ready(f"http://127.0.0.1:{app_port}/health", 30, app)
+
+            sampler = ProcessSampler(app.pid) if os.path.exists(f"/proc/{app.pid}") else None
+            limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+            timeout = httpx.Timeout(args.timeout)
+            scenario_results = []
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{app_port}", limits=limits, timeout=timeout) as client:
+                for scenario in args.scenarios:
+                    print(f"INFO: Running scenario '{scenario}' ({args.requests} requests, concurrency {args.concurrency})", file=sys.stderr)
+                    result = await run_scenario(client, sampler, scenario, args)
+                    print(f"INFO: {scenario}: {result['throughput_rps']} req/s, p50 {result['latency_ms']['p50']} ms, "
+                          f"p99 {result['latency_ms']['p99']} ms, errors {result['errors'] or 0}", file=sys.stderr)
+                    scenario_results.append(result)
+
+            async with httpx.AsyncClient() as client:
+                upstream_calls = (await client.get(f"http://127.0.0.1:{stub_port}/stats")).json()
+        finally:
+            for proc in (app, stub):
+                proc.terminate()
+            for proc in (app, stub):
+                try:
+                    proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+
+    return {
+        "benchmark": "e2e",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "model": args.model,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "prompt_chars": args.prompt_chars,
+            "stub": {
+                "latency_ms": args.stub_latency_ms,
+                "jitter_ms": args.stub_jitter_ms,
+                "chunks": args.stub_chunks,
+                "chunk_interval_ms": args.stub_chunk_interval_ms,
+                "chunk_chars": args.stub_chunk_chars,
+                "response_chars": args.stub_response_chars,
+            },
+        },
+        "scenarios": scenario_results,
+        "upstream_calls": upstream_calls,
+    }
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark against a local Vertex stand-in")
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=DEFAULT_SCENARIOS)
+    parser.add_argument("--model", default="gemini-2.5-flash")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="Measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=5, help="Unmeasured requests per scenario")
+    parser.add_argument("--prompt-chars", type=int, default=512)
+    parser.add_argument("--timeout", type=float, default=60.0, help="Client timeout per request (seconds)")
+    parser.add_argument("--stub-latency-ms", type=float, default=50.0)
+    parser.add_argument("--stub-jitter-ms", type=float, default=0.0)
+    parser.add_argument("--stub-chunks", type=int, default=20)
+    parser.add_argument("--stub-chunk-interval-ms", type=float, default=10.0)
+    parser.add_argument("--stub-chunk-chars", type=int, default=64)
+    parser.add_argument("--stub-response-chars", type=int, default=1024)
+    parser.add_argument("--stub-port", type=int, default=0, help="0 picks a free port")
+    parser.add_argument("--app-port", type=int, default=0, help="0 picks a free port")
+    parser.add_argument("--app-env", action="append", default=[], metavar="NAME=VALUE",
+                        help="Extra environment for the app process (repeatable)")
+    parser.add_argument("--app-log", help="Write the app's stdout/stderr to this file")
+    parser.add_argument("--output", "-o", help="Write the JSON report here (default: stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        print(f"INFO: Report written to {args.output}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
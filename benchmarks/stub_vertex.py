@@ -0,0 +1,283 @@
+"""
+Local Vertex AI stand-in used by the offline benchmarks.
+
+Mimics the parts of the Vertex API the adapter talks to in Express mode:
+
+- ``.../models/{model}:generateContent``
+- ``.../models/{model}:streamGenerateContent`` (``alt=sse``)
+- ``.../models/{model}:countTokens`` (about 4 characters of request text per token)
+- ``.../models/{model}:predict`` and ``:embedContent`` (embeddings derived from a hash of the text)
+- ``.../projects/{project}/locations/{location}/endpoints/openapi/chat/completions``
+  (streaming and non-streaming)
+- the project-ID discovery probe: requesting a model matching ``--missing-model``
+  returns the same 404 whose message contains ``projects/<number>/locations/...``
+  that the real API returns for an Express key.
+- image models (names containing ``image``): the final response part carries an
+  ``inlineData`` PNG of ``--image-kb`` KB.
+- quota exhaustion: with ``--quota-concurrency N`` model calls beyond N concurrent
+  ones are answered with 429 ``RESOURCE_EXHAUSTED``.
+
+Latency, chunk cadence and payload sizes are configurable so that the adapter's own
+overhead can be measured without network access or real credentials.
+
+Run the adapter with ``VERTEX_API_BASE=http://127.0.0.1:<port>`` to point it here.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import re
+import time
+from collections import Counter
+
+from aiohttp import web
+
+MODEL_CALL_RE = re.compile(r"models/([^/:]+):(generateContent|streamGenerateContent|countTokens|predict|embedContent)$")
+OPENAPI_CHAT_RE = re.compile(r"projects/([^/]+)/locations/([^/]+)/endpoints/openapi/chat/completions$")
+
+FILLER = "The quick brown fox jumps over the lazy dog. "
+
+
+class StubConfig:
+    def __init__(self, args: argparse.Namespace):
+        self.latency_ms = args.latency_ms
+        self.jitter_ms = args.jitter_ms
+        self.chunks = max(1, args.chunks)
+        self.chunk_interval_ms = args.chunk_interval_ms
+        self.chunk_chars = args.chunk_chars
+        self.response_chars = args.response_chars
+        self.project_number = args.project_number
+        self.missing_model = re.compile(args.missing_model)
+        self.quota_concurrency = args.quota_concurrency
+        self.image_kb = args.image_kb
+
+
+def _text(n_chars: int) -> str:
+    if n_chars <= 0:
+        return ""
+    repeats = n_chars // len(FILLER) + 1
+    return (FILLER * repeats)[:n_chars]
+
+
+def _approx_tokens(n_chars: int) -> int:
+    return max(1, n_chars // 4)
+
+
+async def _upstream_delay(cfg: StubConfig) -> None:
+    delay = cfg.latency_ms
+    if cfg.jitter_ms:
+        delay += random.uniform(-cfg.jitter_ms, cfg.jitter_ms)
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+
+
+def _embedding(text: str, dimensions: int) -> list:
+    seed = hashlib.sha256(text.encode("utf-8")).digest()
+    return [round(seed[i % len(seed)] / 255 - 0.5, 6) for i in range(dimensions)]
+
+
+def _usage(cfg: StubConfig, completion_chars: int) -> dict:
+    candidates = _approx_tokens(completion_chars)
+    return {"promptTokenCount": 16, "candidatesTokenCount": candidates, "totalTokenCount": 16 + candidates}
+
+
+def _gemini_response(model: str, text: str, finish: bool, usage: dict = None) -> dict:
+    candidate = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+    if finish:
+        candidate["finishReason"] = "STOP"
+    payload = {"candidates": [candidate], "modelVersion": model, "responseId": f"stub-{time.time_ns()}"}
+    if usage:
+        payload["usageMetadata"] = usage
+    return payload
+
+
+def _with_image(cfg: StubConfig, model: str, payload: dict) -> dict:
+    if "image" in model:
+        # PNG 文件头 + 填充字节，足以测试图片的传输与存储
+        data = b"\x89PNG\r\n\x1a\n" + hashlib.sha256(model.encode()).digest() * (cfg.image_kb * 1024 // 32)
+        payload["candidates"][0]["content"]["parts"].append(
+            {"inlineData": {"mimeType": "image/png", "data": base64.b64encode(data).decode("ascii")}})
+    return payload
+
+
+def _project_not_found(cfg: StubConfig, model: str) -> web.Response:
+    # 与真实 Express 接口一致：错误信息中包含 projects/<number>/locations/...
+    message = (
+        f"Publisher Model `projects/{cfg.project_number}/locations/us-central1/publishers/google/models/{model}` "
+        "was not found or your project does not have access to it."
+    )
+    body = [{"error": {"code": 404, "message": message, "status": "NOT_FOUND"}}]
+    return web.json_response(body, status=404)
+
+
+async def handle_model_call(request: web.Request, model: str, method: str) -> web.StreamResponse:
+    cfg: StubConfig = request.app["config"]
+    stats: Counter = request.app["stats"]
+    await request.read()
+
+    if cfg.missing_model.search(model):
+        stats["project_discovery"] += 1
+        return _project_not_found(cfg, model)
+
+    if cfg.quota_concurrency and request.app["active_calls"] >= cfg.quota_concurrency:
+        stats["resource_exhausted"] += 1
+        body = [{"error": {"code": 429, "message": "Resource exhausted. Please try again later.", "status": "RESOURCE_EXHAUSTED"}}]
+        return web.json_response(body, status=429)
+    request.app["active_calls"] += 1
+    try:
+        return await _model_response(request, cfg, stats, model, method)
+    finally:
+        request.app["active_calls"] -= 1
+
+
+async def _model_response(request: web.Request, cfg: StubConfig, stats: Counter, model: str,
+                          method: str) -> web.StreamResponse:
+    if method == "predict":
+        body = await request.json()
+        instances = body.get("instances", [])
+        stats["predict"] += 1
+        stats["predict_instances"] += len(instances)
+        await _upstream_delay(cfg)
+        dimensions = (body.get("parameters") or {}).get("outputDimensionality") or 768
+        return web.json_response({"predictions": [
+            {"embeddings": {"values": _embedding(inst.get("content", ""), dimensions),
+                            "statistics": {"token_count": _approx_tokens(len(inst.get("content", ""))), "truncated": False}}}
+            for inst in instances
+        ]})
+
+    if method == "embedContent":
+        body = await request.json()
+        stats["embed_content"] += 1
+        await _upstream_delay(cfg)
+        text = "".join(part.get("text", "") for part in body.get("content", {}).get("parts", []))
+        dimensions = (body.get("embedContentConfig") or {}).get("outputDimensionality") or 3072
+        return web.json_response({"embedding": {"values": _embedding(text, dimensions)},
+                                  "usageMetadata": {"promptTokenCount": _approx_tokens(len(text))}})
+
+    if method == "countTokens":
+        stats["count_tokens"] += 1
+        await _upstream_delay(cfg)
+        body = await request.json()
+        texts = [part.get("text", "") for content in body.get("contents", []) for part in content.get("parts", [])]
+        return web.json_response({"totalTokens": _approx_tokens(sum(len(t) for t in texts))})
+
+    if method == "generateContent":
+        stats["generate_content"] += 1
+        await _upstream_delay(cfg)
+        usage = _usage(cfg, cfg.response_chars)
+        return web.json_response(_with_image(cfg, model, _gemini_response(model, _text(cfg.response_chars), True, usage)))
+
+    stats["stream_generate_content"] += 1
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    await _upstream_delay(cfg)
+    chunk_text = _text(cfg.chunk_chars)
+    for i in range(cfg.chunks):
+        if i and cfg.chunk_interval_ms > 0:
+            await asyncio.sleep(cfg.chunk_interval_ms / 1000)
+        last = i == cfg.chunks - 1
+        usage = _usage(cfg, cfg.chunk_chars * cfg.chunks) if last else None
+        payload = _gemini_response(model, chunk_text, last, usage)
+        if last:
+            payload = _with_image(cfg, model, payload)
+        await response.write(f"data: {json.dumps(payload)}\r\n\r\n".encode())
+    await response.write_eof()
+    return response
+
+
+async def handle_openapi_chat(request: web.Request) -> web.StreamResponse:
+    cfg: StubConfig = request.app["config"]
+    stats: Counter = request.app["stats"]
+    body = await request.json()
+    model = body.get("model", "stub-model")
+    created = int(time.time())
+
+    if not body.get("stream"):
+        stats["openapi_chat"] += 1
+        await _upstream_delay(cfg)
+        completion_tokens = _approx_tokens(cfg.response_chars)
+        return web.json_response({
+            "id": f"chatcmpl-stub-{time.time_ns()}",
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": _text(cfg.response_chars)}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 16, "completion_tokens": completion_tokens, "total_tokens": 16 + completion_tokens},
+        })
+
+    stats["openapi_chat_stream"] += 1
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    await _upstream_delay(cfg)
+    chunk_text = _text(cfg.chunk_chars)
+    for i in range(cfg.chunks):
+        if i and cfg.chunk_interval_ms > 0:
+            await asyncio.sleep(cfg.chunk_interval_ms / 1000)
+        chunk = {
+            "id": "chatcmpl-stub-stream",
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": {"content": chunk_text}, "finish_reason": None}],
+        }
+        if i == cfg.chunks - 1:
+            completion_tokens = _approx_tokens(cfg.chunk_chars * cfg.chunks)
+            chunk["usage"] = {"prompt_tokens": 16, "completion_tokens": completion_tokens, "total_tokens": 16 + completion_tokens}
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+async def dispatch(request: web.Request) -> web.StreamResponse:
+    path = request.path
+    match = MODEL_CALL_RE.search(path)
+    if match and request.method == "POST":
+        return await handle_model_call(request, match.group(1), match.group(2))
+    if OPENAPI_CHAT_RE.search(path) and request.method == "POST":
+        return await handle_openapi_chat(request)
+    if path == "/stats":
+        return web.json_response(dict(request.app["stats"]))
+    if path == "/health":
+        return web.json_response({"status": "ok"})
+    request.app["stats"]["unhandled"] += 1
+    return web.json_response({"error": {"code": 404, "message": f"Stub has no handler for {request.method} {path}", "status": "NOT_FOUND"}}, status=404)
+
+
+def build_app(cfg: StubConfig) -> web.Application:
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app["config"] = cfg
+    app["stats"] = Counter()
+    app["active_calls"] = 0
+    app.router.add_route("*", "/{tail:.*}", dispatch)
+    return app
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Local Vertex AI stand-in for offline benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8970)
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Delay before the response / first chunk")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Uniform +/- jitter applied to --latency-ms")
+    parser.add_argument("--chunks", type=int, default=20, help="Chunks per streamed response")
+    parser.add_argument("--chunk-interval-ms", type=float, default=10.0, help="Gap between streamed chunks")
+    parser.add_argument("--chunk-chars", type=int, default=64, help="Characters of text per streamed chunk")
+    parser.add_argument("--response-chars", type=int, default=1024, help="Characters of text in non-streamed responses")
+    parser.add_argument("--project-number", default="123456789012", help="Project number reported by the discovery probe")
+    parser.add_argument("--quota-concurrency", type=int, default=0,
+                        help="Answer model calls beyond this many concurrent ones with 429 RESOURCE_EXHAUSTED (0 = unlimited)")
+    parser.add_argument("--image-kb", type=int, default=256, help="Size of the PNG returned by image models")
+    parser.add_argument("--missing-model", default=r"^gemini-2\.7-", help="Regex of model names answered with the project-ID 404")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    print(f"INFO: Vertex stub listening on http://{args.host}:{args.port}")
+    web.run_app(build_app(StubConfig(args)), host=args.host, port=args.port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# app/ 下的模块使用扁平导入（与 uvicorn main:app 的运行方式一致）
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
@@ -0,0 +1,148 @@
+import asyncio
+import gzip
+import json
+import tracemalloc
+
+import pytest
+
+import config as app_config
+import compression
+
+brotli = pytest.importorskip("brotli")
+zstandard = pytest.importorskip("zstandard")
+
+BOMB_MB = 256
+LIMIT_MB = 1
+
+
+def _compress_zeros(encoding: str, megabytes: int) -> bytes:
+    block = bytes(1024 * 1024)
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=1)
+        return b"".join(compressor.process(block) for _ in range(megabytes)) + compressor.finish()
+    if encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=1).compressobj()
+        return b"".join(compressor.compress(block) for _ in range(megabytes)) + compressor.flush()
+    compressor = compression.zlib.compressobj(9, compression.zlib.DEFLATED, 31)
+    return b"".join(compressor.compress(block) for _ in range(megabytes)) + compressor.flush()
+
+
+async def _echo_app(scope, receive, send):
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    payload = json.dumps({"received": len(body)}).encode()
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": payload})
+
+
+def _call(app, headers, body: bytes = b"", chunk_size: int = 64 * 1024, method: str = "POST"):
+    scope = {"type": "http", "method": method, "path": "/v1/chat/completions", "headers": headers}
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] or [b""]
+    messages = [{"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+                for i, chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(compression.CompressionMiddleware(app)(scope, receive, send))
+    body = b"".join(m.get("body", b"") for m in sent if m["type"] == "http.response.body")
+    return sent[0]["status"], dict(sent[0]["headers"]), body
+
+
+def _post(body: bytes, encoding: str, chunk_size: int = 64 * 1024):
+    headers = [(b"content-encoding", encoding.encode()), (b"content-length", str(len(body)).encode())]
+    status, _, response_body = _call(_echo_app, headers, body, chunk_size)
+    return status, response_body
+
+
+def _json_app(payload: bytes, status: int = 200):
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json"), (b"etag", b'"abc"'),
+                                (b"content-length", str(len(payload)).encode())]})
+        await send({"type": "http.response.body", "body": payload})
+    return app
+
+
+@pytest.fixture(autouse=True)
+def _limit(monkeypatch):
+    monkeypatch.setattr(app_config, "COMPRESSION_MAX_REQUEST_MB", LIMIT_MB)
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "br", "zstd"])
+def test_request_bomb_is_rejected_without_large_allocation(encoding):
+    bomb = _compress_zeros(encoding, BOMB_MB)
+    assert len(bomb) < 1024 * 1024
+
+    tracemalloc.start()
+    try:
+        status, body = _post(bomb, encoding)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert status == 413
+    assert "exceeds" in json.loads(body)["error"]["message"]
+    # 上限 1 MB + 单步输出；远小于 256 MB 的解压结果
+    assert peak < 8 * 1024 * 1024
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "br", "zstd"])
+def test_request_body_under_limit_is_decompressed(encoding):
+    payload = json.dumps({"messages": [{"role": "user", "content": "x" * 200_000}]}).encode()
+    if encoding == "gzip":
+        encoded = gzip.compress(payload)
+    elif encoding == "br":
+        encoded = brotli.compress(payload)
+    else:
+        encoded = zstandard.ZstdCompressor().compress(payload)
+
+    status, body = _post(encoded, encoding, chunk_size=100)
+
+    assert status == 200
+    assert json.loads(body) == {"received": len(payload)}
+
+
+def test_unknown_request_encoding_is_rejected():
+    status, _ = _post(b"data", "compress")
+    assert status == 415
+
+
+def test_compressed_response_gets_suffixed_etag_and_vary():
+    payload = json.dumps({"data": ["x" * 10] * 500}).encode()
+    status, headers, body = _call(_json_app(payload), [(b"accept-encoding", b"gzip")], method="GET")
+
+    assert status == 200
+    assert headers[b"content-encoding"] == b"gzip"
+    assert headers[b"etag"] == b'"abc-gzip"'
+    assert headers[b"vary"] == b"Accept-Encoding"
+    assert gzip.decompress(body) == payload
+
+
+@pytest.mark.parametrize("accept_encoding", [b"gzip", b"identity"])
+def test_uncompressed_negotiable_response_still_varies(accept_encoding):
+    # 低于阈值（gzip）或客户端不接受任何编码（identity）时不压缩，但仍带 Vary
+    status, headers, body = _call(_json_app(b'{"ok":true}'), [(b"accept-encoding", accept_encoding)], method="GET")
+
+    assert status == 200
+    assert b"content-encoding" not in headers
+    assert headers[b"etag"] == b'"abc"'
+    assert headers[b"vary"] == b"Accept-Encoding"
+    assert body == b'{"ok":true}'
+
+
+def test_matching_etag_ignores_encoding_suffix():
+    assert compression.matching_etag('"abc-br"', '"abc"') == '"abc-br"'
+    assert compression.matching_etag('W/"abc-zstd", "other"', '"abc"') == 'W/"abc-zstd"'
+    assert compression.matching_etag('"abc"', '"abc"') == '"abc"'
+    assert compression.matching_etag("*", '"abc"') == '"abc"'
+    assert compression.matching_etag('"abd-gzip"', '"abc"') is None
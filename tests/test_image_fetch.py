@@ -0,0 +1,150 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import config as app_config
+import image_fetch
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 512
+LARGE = b"\x89PNG\r\n\x1a\n" + b"\x00" * 4096
+
+
+class _Handler(BaseHTTPRequestHandler):
+    hits = {}
+    if_none_match = []
+
+    def log_message(self, *args):
+        pass
+
+    def _image(self, data: bytes, etag: str = None, content_length: bool = True):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        if etag:
+            self.send_header("ETag", etag)
+        if content_length:
+            self.send_header("Content-Length", str(len(data)))
+        else:
+            # 无 Content-Length：以关闭连接结束响应体
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        _Handler.hits[self.path] = _Handler.hits.get(self.path, 0) + 1
+        if self.path == "/image.png":
+            self._image(PNG)
+        elif self.path == "/large.png":
+            self._image(LARGE)
+        elif self.path == "/large-streamed.png":
+            self._image(LARGE, content_length=False)
+        elif self.path == "/etag.png":
+            _Handler.if_none_match.append(self.headers.get("If-None-Match"))
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.send_response(304)
+                self.send_header("ETag", '"v1"')
+                self.end_headers()
+            else:
+                self._image(PNG, etag='"v1"')
+        elif self.path == "/slow.png":
+            time.sleep(0.3)
+            self._image(PNG)
+        elif self.path == "/redirect-private":
+            self.send_response(302)
+            self.send_header("Location", f"http://127.0.0.1:{self.server.server_port}/image.png")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def _config(monkeypatch):
+    monkeypatch.setattr(app_config, "IMAGE_FETCH_ALLOW_PRIVATE", True)
+    monkeypatch.setattr(app_config, "IMAGE_FETCH_TIMEOUT", 5)
+    monkeypatch.setattr(app_config, "IMAGE_FETCH_MAX_MB", 2048 / (1024 * 1024))
+    _Handler.hits.clear()
+    _Handler.if_none_match.clear()
+
+
+def _run(coro_factory):
+    async def main():
+        fetcher = image_fetch.RemoteImageFetcher()
+        try:
+            return await coro_factory(fetcher)
+        finally:
+            await fetcher.close()
+    return asyncio.run(main())
+
+
+def test_fetches_image(server):
+    result = _run(lambda fetcher: fetcher.fetch(f"{server}/image.png"))
+    assert result == (PNG, "image/png")
+
+
+@pytest.mark.parametrize("path", ["/large.png", "/large-streamed.png"])
+def test_size_cap(server, path):
+    # 2 KB 上限：有 Content-Length 时直接拒绝，无 Content-Length 时边读边检查
+    assert _run(lambda fetcher: fetcher.fetch(f"{server}{path}")) is None
+
+
+def test_redirect_to_private_address_is_blocked(server, monkeypatch):
+    monkeypatch.setattr(app_config, "IMAGE_FETCH_ALLOW_PRIVATE", False)
+    real_resolve = image_fetch._resolve_public
+
+    async def resolve(host, port):
+        # images.example 视为公网主机（实际指向本地测试服务器）；重定向目标 127.0.0.1 走真实检查
+        if host == "images.example":
+            return "127.0.0.1"
+        return await real_resolve(host, port)
+
+    monkeypatch.setattr(image_fetch, "_resolve_public", resolve)
+    port = server.rsplit(":", 1)[1]
+
+    assert _run(lambda fetcher: fetcher.fetch(f"http://images.example:{port}/image.png")) == (PNG, "image/png")
+    assert _run(lambda fetcher: fetcher.fetch(f"http://images.example:{port}/redirect-private")) is None
+    assert _Handler.hits == {"/image.png": 1, "/redirect-private": 1}
+
+
+def test_private_address_is_blocked(server, monkeypatch):
+    monkeypatch.setattr(app_config, "IMAGE_FETCH_ALLOW_PRIVATE", False)
+    assert _run(lambda fetcher: fetcher.fetch(f"{server}/image.png")) is None
+    assert _Handler.hits == {}
+
+
+def test_etag_revalidation(server, monkeypatch):
+    monkeypatch.setattr(app_config, "IMAGE_FETCH_CACHE_TTL", 0)
+
+    async def fetch_twice(fetcher):
+        first = await fetcher.fetch(f"{server}/etag.png")
+        await asyncio.sleep(0.01)
+        second = await fetcher.fetch(f"{server}/etag.png")
+        return first, second
+
+    first, second = _run(fetch_twice)
+    assert first == second == (PNG, "image/png")
+    assert _Handler.if_none_match == [None, '"v1"']
+
+
+def test_concurrent_fetches_share_one_download(server):
+    async def fetch_many(fetcher):
+        return await asyncio.gather(*(fetcher.fetch(f"{server}/slow.png") for _ in range(5)))
+
+    results = _run(fetch_many)
+    assert results == [(PNG, "image/png")] * 5
+    assert _Handler.hits == {"/slow.png": 1}